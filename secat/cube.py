@@ -0,0 +1,200 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import uuid
+import click
+import numpy as np
+import pandas as pd
+
+from .database import writer
+
+CUBE_VERSION = 1
+
+# Index arrays stored next to the intensity array of the cube
+INDEX_ARRAYS = ['condition_id', 'replicate_id', 'sec_id', 'protein_id', 'protein_offset', 'protein_count', 'peptide_id', 'peptide_protein_id', 'peptide_count', 'peptide_rank', 'monomer_sec_id']
+
+def cube_dir(outfile):
+    return outfile + ".cube"
+
+def cube_index(con):
+    # Runs are identified by condition and replicate, SEC fractions by their offset to the first fraction
+    sec = pd.read_sql('SELECT run_id, condition_id, replicate_id, sec_id FROM SEC;', con)
+    runs = sec[['condition_id','replicate_id']].drop_duplicates().sort_values(['condition_id','replicate_id']).reset_index(drop=True)
+    sec = pd.merge(sec, runs.reset_index().rename(columns={'index': 'run'}), on=['condition_id','replicate_id'])
+    sec_min = sec['sec_id'].min()
+    num_fractions = int(sec['sec_id'].max() - sec_min + 1)
+
+    run_lookup = np.full(sec['run_id'].max() + 1, -1, dtype=np.int64)
+    run_lookup[sec['run_id'].values] = sec['run'].values
+    fraction_lookup = np.full(sec['run_id'].max() + 1, -1, dtype=np.int64)
+    fraction_lookup[sec['run_id'].values] = sec['sec_id'].values - sec_min
+
+    # Peptide rows are grouped by protein and restricted to proteins with meta data and monomer thresholds
+    peptides = pd.read_sql('SELECT DISTINCT QUANTIFICATION.protein_id, QUANTIFICATION.peptide_id, peptide_count, peptide_rank FROM QUANTIFICATION INNER JOIN PROTEIN_META ON QUANTIFICATION.protein_id = PROTEIN_META.protein_id INNER JOIN PEPTIDE_META ON QUANTIFICATION.peptide_id = PEPTIDE_META.peptide_id WHERE QUANTIFICATION.protein_id IN (SELECT DISTINCT protein_id FROM MONOMER);', con)
+    peptides = peptides.sort_values(['protein_id','peptide_id']).reset_index(drop=True)
+
+    proteins, protein_offsets, protein_counts = np.unique(peptides['protein_id'].values, return_index=True, return_counts=True)
+
+    # Monomer thresholds per run and protein; -1 if not available
+    monomers = pd.merge(pd.read_sql('SELECT condition_id, replicate_id, protein_id, sec_id FROM MONOMER;', con), runs.reset_index().rename(columns={'index': 'run'}), on=['condition_id','replicate_id'])
+    monomers = monomers[monomers['protein_id'].isin(proteins)]
+    monomer_sec_id = np.full((runs.shape[0], len(proteins)), -1, dtype=np.int64)
+    monomer_sec_id[monomers['run'].values, np.searchsorted(proteins, monomers['protein_id'].values)] = monomers['sec_id'].values
+
+    index = {'condition_id': np.asarray(runs['condition_id'], dtype=str), 'replicate_id': np.asarray(runs['replicate_id'], dtype=str), 'sec_id': np.arange(sec_min, sec_min + num_fractions), 'protein_id': proteins, 'protein_offset': protein_offsets, 'protein_count': protein_counts, 'peptide_id': peptides['peptide_id'].values, 'peptide_protein_id': peptides['protein_id'].values, 'peptide_count': peptides['peptide_count'].values, 'peptide_rank': peptides['peptide_rank'].values, 'monomer_sec_id': monomer_sec_id}
+
+    return index, run_lookup, fraction_lookup
+
+def fill_cube(con, intensity, index, run_lookup, fraction_lookup, chunksize=1000000):
+    # Stream quantification data into the cube
+    num_peptide_ids = int(index['peptide_id'].max()) + 1 if len(index['peptide_id']) > 0 else 1
+    row_keys = index['peptide_protein_id'] * num_peptide_ids + index['peptide_id']
+
+    for chunk in pd.read_sql('SELECT run_id, protein_id, peptide_id, peptide_intensity FROM QUANTIFICATION;', con, chunksize=chunksize):
+        keys = chunk['protein_id'].values * num_peptide_ids + chunk['peptide_id'].values
+        rows = np.searchsorted(row_keys, keys)
+        run = run_lookup[chunk['run_id'].values]
+
+        # Keep data points of cube peptides in runs with a monomer threshold for the protein
+        valid = (rows < len(row_keys)) & (run >= 0)
+        valid[valid] = row_keys[rows[valid]] == keys[valid]
+        valid[valid] = index['monomer_sec_id'][run[valid], np.searchsorted(index['protein_id'], chunk['protein_id'].values[valid])] >= 0
+
+        intensity[run[valid], rows[valid], fraction_lookup[chunk['run_id'].values[valid]]] = chunk['peptide_intensity'].values[valid]
+
+def build_cube(outfile, infile=None, chunksize=1000000):
+    # Peptide chromatograms of all runs as dense float32 [run, peptide, sec] array; missing data points are NaN
+    con = sqlite3.connect(outfile)
+
+    # Tables missing in the SECAT file, e.g. a shard file, are read from the input file
+    if infile is not None and infile != outfile:
+        con.execute('ATTACH DATABASE ? AS input;', (infile,))
+
+    index, run_lookup, fraction_lookup = cube_index(con)
+    shape = (len(index['condition_id']), len(index['peptide_id']), len(index['sec_id']))
+
+    cubedir = cube_dir(outfile)
+    shutil.rmtree(cubedir, ignore_errors=True)
+    os.makedirs(cubedir)
+
+    intensity = np.lib.format.open_memmap(os.path.join(cubedir, 'intensity.npy'), mode='w+', dtype=np.float32, shape=shape)
+    intensity[:] = np.nan
+    fill_cube(con, intensity, index, run_lookup, fraction_lookup, chunksize)
+
+    con.close()
+
+    intensity.flush()
+    del intensity
+
+    np.savez(os.path.join(cubedir, 'index.npz'), **index)
+
+    # The cube is linked to the SECAT file by a random identifier; the manifest is written last
+    cube_id = uuid.uuid4().hex
+    db = writer(outfile)
+    db.write('CHROMATOGRAM_CUBE', pd.DataFrame({'cube_id': [cube_id]}), if_exists='replace')
+    db.close()
+
+    with open(os.path.join(cubedir, 'manifest.json'), 'w') as f:
+        json.dump({'format': 'secat-cube', 'version': CUBE_VERSION, 'id': cube_id, 'shape': list(shape)}, f, indent=2)
+
+    click.echo("Info: Peptide chromatogram cube with %s runs, %s peptides and %s SEC fractions stored in %s." % (shape[0], shape[1], shape[2], cubedir))
+
+def cube_current(outfile):
+    # The cube belongs to the SECAT file if the identifiers of its manifest and the CHROMATOGRAM_CUBE table match
+    manifest_file = os.path.join(cube_dir(outfile), 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return False
+
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    con = sqlite3.connect(outfile)
+    if con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='CHROMATOGRAM_CUBE';").fetchone()[0] == 1:
+        cube_id = con.execute('SELECT cube_id FROM CHROMATOGRAM_CUBE;').fetchone()[0]
+    else:
+        cube_id = None
+    con.close()
+
+    return manifest.get('format') == 'secat-cube' and manifest.get('version') == CUBE_VERSION and manifest.get('id') == cube_id
+
+class chromatogram_cube:
+    def __init__(self, outfile, fallback=False):
+        self.cubedir = cube_dir(outfile)
+
+        if cube_current(outfile):
+            index = np.load(os.path.join(self.cubedir, 'index.npz'))
+
+            # Read-only memory map shared by all processes through the page cache
+            self.intensity = np.load(os.path.join(self.cubedir, 'intensity.npy'), mmap_mode='r')
+        elif fallback:
+            # Read-only consumers of files without a current cube fill an in-memory cube from the SQLite tables
+            click.echo("Info: No current peptide chromatogram cube found for %s. Read peptide chromatograms from SQLite tables." % outfile)
+            con = sqlite3.connect(outfile)
+            index, run_lookup, fraction_lookup = cube_index(con)
+            self.intensity = np.full((len(index['condition_id']), len(index['peptide_id']), len(index['sec_id'])), np.nan, dtype=np.float32)
+            fill_cube(con, self.intensity, index, run_lookup, fraction_lookup)
+            con.close()
+        else:
+            # The cube is only built by 'secat score' and 'secat merge'
+            sys.exit("Error: Peptide chromatogram cube %s is missing or does not belong to %s. Rerun 'secat score'." % (self.cubedir, outfile))
+
+        self.runs = pd.DataFrame({'condition_id': index['condition_id'].astype(object), 'replicate_id': index['replicate_id'].astype(object)})
+        self.sec_id = index['sec_id']
+        self.protein_id = index['protein_id']
+        self.protein_offset = index['protein_offset']
+        self.protein_count = index['protein_count']
+        self.peptide_id = index['peptide_id']
+        self.peptide_protein_id = index['peptide_protein_id']
+        self.peptide_count = index['peptide_count']
+        self.peptide_rank = index['peptide_rank']
+        self.monomer_sec_id = index['monomer_sec_id']
+
+    def peptides(self, minimum_peptides=None, maximum_peptides=None):
+        # Peptide rows passing the protein-level peptide count and peptide rank filters
+        rows = np.ones(len(self.peptide_id), dtype=bool)
+        if minimum_peptides is not None:
+            rows &= self.peptide_count >= minimum_peptides
+        if maximum_peptides is not None:
+            rows &= self.peptide_rank <= maximum_peptides
+        return rows.nonzero()[0]
+
+    def rows(self, protein_id):
+        # Row slice of the peptides of a protein; empty if the protein is not part of the cube
+        ix = np.searchsorted(self.protein_id, protein_id)
+        if ix == len(self.protein_id) or self.protein_id[ix] != protein_id:
+            return slice(0, 0)
+        return slice(self.protein_offset[ix], self.protein_offset[ix] + self.protein_count[ix])
+
+    def protein(self, run, protein_id):
+        # Zero-copy view of the peptide chromatograms of a protein in a run
+        return self.intensity[run, self.rows(protein_id)]
+
+    def to_df(self, protein_ids, minimum_peptides=None, maximum_peptides=None):
+        # Long-format peptide chromatograms of the proteins, read from their per-protein slices
+        passing = np.zeros(len(self.peptide_id), dtype=bool)
+        passing[self.peptides(minimum_peptides, maximum_peptides)] = True
+
+        dfs = []
+        for run in range(self.runs.shape[0]):
+            for protein_id in np.unique(protein_ids):
+                rows = self.rows(protein_id)
+                selected = passing[rows].nonzero()[0]
+                intensity = self.protein(run, protein_id)[selected]
+                peptide, fraction = (~np.isnan(intensity)).nonzero()
+                if len(peptide) == 0:
+                    continue
+                dfs.append(pd.DataFrame({
+                    'condition_id': self.runs['condition_id'].values[run],
+                    'replicate_id': self.runs['replicate_id'].values[run],
+                    'sec_id': self.sec_id[fraction],
+                    'protein_id': protein_id,
+                    'peptide_id': self.peptide_id[rows][selected][peptide],
+                    'peptide_intensity': intensity[peptide, fraction].astype(np.float64),
+                    'monomer_sec_id': self.monomer_sec_id[run, np.searchsorted(self.protein_id, protein_id)]
+                }))
+
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=['condition_id','replicate_id','sec_id','protein_id','peptide_id','peptide_intensity','monomer_sec_id'])
+        return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,195 @@
+import sqlite3
+import threading
+import queue
+import numpy as np
+import pandas as pd
+
+from pandas.api.types import is_bool_dtype, is_integer_dtype, is_float_dtype, is_datetime64_any_dtype
+
+# Page cache in KiB (negative values) and memory-mapped I/O limit in bytes used while loading
+CACHE_SIZE = -1048576
+MMAP_SIZE = 2**34
+
+# Index sorts run in memory up to the page cache size; small sorter runs with external merging are faster
+INDEX_CACHE_SIZE = -2000
+
+def sqlite_type(dtype):
+    # Column affinities follow the pandas SQLite backend
+    if is_bool_dtype(dtype) or is_integer_dtype(dtype):
+        return 'INTEGER'
+    elif is_float_dtype(dtype):
+        return 'REAL'
+    elif is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    else:
+        return 'TEXT'
+
+def sqlite_values(values):
+    # Native Python values are bound directly by sqlite3; NaN is stored as NULL
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biuf':
+        return values.to_numpy().tolist()
+    values = values.to_numpy(dtype=object)
+    return np.where(pd.isna(values), None, values).tolist()
+
+def check_sqlite_table(con, table):
+    table_present = False
+    c = con.cursor()
+    c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="%s"' % table)
+    if c.fetchone()[0] == 1:
+        table_present = True
+    else:
+        table_present = False
+    c.fetchall()
+
+    return(table_present)
+
+def decode_ids(con, df):
+    # Run, protein and peptide identifiers are stored as integer keys and translated back to their labels for reporting
+    if df is None or not check_sqlite_table(con, 'PROTEIN_DICT'):
+        return df
+
+    df = df.copy()
+    tables = {'run_id': 'RUN', 'protein_id': 'PROTEIN', 'bait_id': 'PROTEIN', 'prey_id': 'PROTEIN', 'peptide_id': 'PEPTIDE'}
+    labels = {}
+    for column in df.columns.intersection(list(tables.keys())):
+        table = tables[column]
+        if table not in labels:
+            labels[table] = pd.read_sql('SELECT %s_key, %s_id FROM %s_DICT;' % (table.lower(), table.lower(), table), con).set_index('%s_key' % table.lower())['%s_id' % table.lower()]
+        df[column] = df[column].map(labels[table])
+
+    if 'interaction_id' in df.columns:
+        df['interaction_id'] = df['bait_id'] + "_" + df['prey_id']
+
+    return df
+
+def encode_protein_ids(con, protein_ids):
+    # Integer keys of protein labels; labels without key are dropped
+    if not check_sqlite_table(con, 'PROTEIN_DICT'):
+        return protein_ids
+
+    return pd.read_sql('SELECT protein_key FROM PROTEIN_DICT WHERE protein_id IN (%s);' % ','.join(['?'] * len(protein_ids)), con, params=list(protein_ids))['protein_key'].values
+
+class writer:
+    def __init__(self, outfile):
+        self.con = sqlite3.connect(outfile)
+        self.indices = []
+
+        # Bulk loading: write-ahead log without syncing, large page cache and memory-mapped I/O
+        self.con.execute('PRAGMA journal_mode=WAL;')
+        self.con.execute('PRAGMA synchronous=OFF;')
+        self.con.execute('PRAGMA cache_size=%s;' % CACHE_SIZE)
+        self.con.execute('PRAGMA mmap_size=%s;' % MMAP_SIZE)
+
+    def write(self, table, df, if_exists='fail', batch_size=100000, commit=True):
+        exists = self.con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?;", (table,)).fetchone()[0] == 1
+        if exists and if_exists == 'fail':
+            raise ValueError("Table '%s' already exists." % table)
+        if exists and if_exists == 'replace':
+            self.con.execute('DROP TABLE "%s";' % table)
+        if not exists or if_exists == 'replace':
+            self.con.execute('CREATE TABLE "%s" (%s);' % (table, ', '.join('"%s" %s' % (column, sqlite_type(dtype)) for column, dtype in df.dtypes.items())))
+
+        insert = 'INSERT INTO "%s" (%s) VALUES (%s);' % (table, ', '.join('"%s"' % column for column in df.columns), ', '.join('?' * df.shape[1]))
+        for start in range(0, df.shape[0], batch_size):
+            batch = df.iloc[start:start+batch_size]
+            self.con.executemany(insert, zip(*[sqlite_values(batch[column]) for column in batch.columns]))
+        if commit:
+            self.con.commit()
+
+    def commit(self):
+        self.con.commit()
+
+    def copy(self, infile, table, if_exists='fail'):
+        # Bulk copy of a table from another SQLite file without loading it into memory; missing tables are skipped
+        self.con.commit()
+        self.con.execute('ATTACH DATABASE ? AS source;', (infile,))
+        try:
+            schema = self.con.execute("SELECT sql FROM source.sqlite_master WHERE type='table' AND name=?;", (table,)).fetchone()
+            if schema is None:
+                return
+
+            exists = self.con.execute("SELECT count(name) FROM main.sqlite_master WHERE type='table' AND name=?;", (table,)).fetchone()[0] == 1
+            if exists and if_exists == 'fail':
+                raise ValueError("Table '%s' already exists." % table)
+            if exists and if_exists == 'replace':
+                self.con.execute('DROP TABLE main."%s";' % table)
+            if not exists or if_exists == 'replace':
+                self.con.execute(schema[0])
+
+            columns = ', '.join('"%s"' % column[1] for column in self.con.execute('PRAGMA source.table_info("%s");' % table))
+            self.con.execute('INSERT INTO main."%s" (%s) SELECT %s FROM source."%s";' % (table, columns, columns, table))
+            self.con.commit()
+        finally:
+            self.con.rollback()
+            self.con.execute('DETACH DATABASE source;')
+
+    def execute(self, sql):
+        self.con.execute(sql)
+        self.con.commit()
+
+    def index(self, table, columns):
+        # Indices are created once all data is loaded
+        self.indices.append((table, columns))
+
+    def close(self):
+        self.con.execute('PRAGMA cache_size=%s;' % INDEX_CACHE_SIZE)
+        for table, columns in self.indices:
+            self.con.execute('CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s (%s);' % (table.lower(), '_'.join(columns), table, ', '.join(columns)))
+        self.con.commit()
+
+        # Merge the write-ahead log and return to a single, durable database file
+        self.con.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        self.con.execute('PRAGMA journal_mode=DELETE;')
+        self.con.execute('PRAGMA synchronous=FULL;')
+        self.con.close()
+
+class background_writer:
+    def __init__(self, outfile, max_pending=4):
+        # Tables are written by a separate thread that owns the connection; pending batches are bounded
+        self.outfile = outfile
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        db = None
+        try:
+            db = writer(self.outfile)
+        except Exception as e:
+            self.error = e
+
+        # Transactions after an error are discarded; the error is raised in the producer
+        while True:
+            transaction = self.pending.get()
+            if transaction is None:
+                break
+            if self.error is None:
+                try:
+                    for table, df, if_exists in transaction:
+                        db.write(table, df, if_exists=if_exists, commit=False)
+                    db.commit()
+                except Exception as e:
+                    self.error = e
+
+        if db is not None:
+            try:
+                db.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def write(self, table, df, if_exists='fail'):
+        self.transaction([(table, df, if_exists)])
+
+    def transaction(self, writes):
+        # Tables of (table, df, if_exists) writes are committed together
+        if self.error is not None:
+            raise self.error
+        self.pending.put(writes)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
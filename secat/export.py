@@ -8,7 +8,8 @@ from os import path
 import sys
 from sqlite3 import connect
 from tqdm import tqdm
-from .plot import check_sqlite_table
+from .database import check_sqlite_table, decode_ids, encode_protein_ids
+from .cube import chromatogram_cube
 
 class export_tables:
     def __init__(self, infile, level, id, max_qvalue, min_abs_log2fx, mode, combined, peptide_rank, extra=True):
@@ -32,7 +33,7 @@ class export_tables:
             
             # Read peptide and feature data
             self.feature_data = self.read_features(con)
-            self.peptide_data = self.read_peptides(con)
+            self.cube = chromatogram_cube(self.infile, fallback=True)
             self.protein_data = self.read_proteins(con)
 
             # Read meta data if available
@@ -72,25 +73,25 @@ class export_tables:
         outfile_proteins_level = path.splitext(self.infile)[0] + "_differential_proteins_level.csv"
         
         if check_sqlite_table(con, 'FEATURE_SCORED_COMBINED'):
-            interaction_data = pd.read_sql('SELECT DISTINCT bait_id, prey_id FROM FEATURE_SCORED_COMBINED WHERE decoy == 0 and qvalue <= %s;' % self.max_qvalue , con)
+            interaction_data = decode_ids(con, pd.read_sql('SELECT DISTINCT bait_id, prey_id FROM FEATURE_SCORED_COMBINED WHERE decoy == 0 and qvalue <= %s;' % self.max_qvalue , con))
             interaction_data.to_csv(outfile_interactions, index=False)
         if check_sqlite_table(con, 'FEATURE_SCORED_COMBINED') and check_sqlite_table(con, 'MONOMER_QM'):
-            network_data = pd.read_sql('SELECT DISTINCT bait_id, prey_id FROM FEATURE_SCORED_COMBINED WHERE decoy == 0 and qvalue <= %s UNION SELECT DISTINCT bait_id, prey_id FROM MONOMER_QM;' % self.max_qvalue , con)
+            network_data = decode_ids(con, pd.read_sql('SELECT DISTINCT bait_id, prey_id FROM FEATURE_SCORED_COMBINED WHERE decoy == 0 and qvalue <= %s UNION SELECT DISTINCT bait_id, prey_id FROM MONOMER_QM;' % self.max_qvalue , con))
             network_data.to_csv(outfile_network, index=False)
         if check_sqlite_table(con, 'NODE'):
-            node_data = pd.read_sql('SELECT * FROM NODE LEFT OUTER JOIN PROTEIN ON bait_id = protein_id;' , con)
+            node_data = decode_ids(con, pd.read_sql('SELECT * FROM NODE LEFT OUTER JOIN PROTEIN ON bait_id = protein_id;' , con))
             node_data.sort_values(by=['pvalue']).to_csv(outfile_nodes, index=False)
         if check_sqlite_table(con, 'NODE_LEVEL'):
-            node_level_data = pd.read_sql('SELECT * FROM NODE_LEVEL LEFT OUTER JOIN PROTEIN ON bait_id = protein_id;' , con)
+            node_level_data = decode_ids(con, pd.read_sql('SELECT * FROM NODE_LEVEL LEFT OUTER JOIN PROTEIN ON bait_id = protein_id;' , con))
             node_level_data.sort_values(by=['pvalue']).to_csv(outfile_nodes_level, index=False)
         if check_sqlite_table(con, 'EDGE'):
-            edge_data = pd.read_sql('SELECT * FROM EDGE;' , con)
+            edge_data = decode_ids(con, pd.read_sql('SELECT * FROM EDGE;' , con))
             edge_data.sort_values(by=['pvalue']).to_csv(outfile_edges, index=False)
         if check_sqlite_table(con, 'EDGE_LEVEL'):
-            edge_level_data = pd.read_sql('SELECT * FROM EDGE_LEVEL;' , con)
+            edge_level_data = decode_ids(con, pd.read_sql('SELECT * FROM EDGE_LEVEL;' , con))
             edge_level_data.sort_values(by=['pvalue']).to_csv(outfile_edges_level, index=False)
         if check_sqlite_table(con, 'PROTEIN_LEVEL'):
-            protein_level_data = pd.read_sql('SELECT * FROM PROTEIN_LEVEL LEFT OUTER JOIN PROTEIN ON bait_id = protein_id;' , con)
+            protein_level_data = decode_ids(con, pd.read_sql('SELECT * FROM PROTEIN_LEVEL LEFT OUTER JOIN PROTEIN ON bait_id = protein_id;' , con))
             protein_level_data.sort_values(by=['pvalue']).to_csv(outfile_proteins_level, index=False)
             
     
@@ -98,13 +99,11 @@ class export_tables:
         feature_data = self.feature_data
         protein_data = self.protein_data
         protein_data['picked'] = True
-        peptide_data = self.peptide_data
 
         bait_id, prey_id = interaction_id.split("_")
 
         feature_data = feature_data[feature_data['interaction_id'] == interaction_id]
-        proteins = pd.DataFrame({"protein_id": [bait_id, prey_id]}).drop_duplicates()
-        peptide_data = pd.merge(peptide_data, proteins, how='inner', on='protein_id')
+        peptide_data = self.read_peptides([bait_id, prey_id])
 
         peptide_data = pd.merge(peptide_data, protein_data, on=['condition_id', 'replicate_id', 'protein_id', 'sec_id'], how='left')
         peptide_data.loc[peptide_data['picked'].isnull(), 'picked'] = False
@@ -123,14 +122,15 @@ class export_tables:
         feature_data = self.feature_data
         protein_data = self.protein_data
         protein_data['picked'] = True
-        peptide_data = self.peptide_data
-
-        peptide_data = pd.merge(peptide_data, protein_data, on=['condition_id', 'replicate_id', 'protein_id', 'sec_id'], how='left')
-        peptide_data.loc[peptide_data['picked'].isnull(), 'picked'] = False
 
         interaction_data = self.interactions_dmeta[['bait_id','prey_id','interaction_id']].drop_duplicates()
         interaction_data = interaction_data[(interaction_data['bait_id'] == bait_id) | (interaction_data['prey_id'] == bait_id)]
 
+        # Peptides of the bait and its interactors
+        peptide_data = self.read_peptides([bait_id] + interaction_data['bait_id'].tolist() + interaction_data['prey_id'].tolist())
+        peptide_data = pd.merge(peptide_data, protein_data, on=['condition_id', 'replicate_id', 'protein_id', 'sec_id'], how='left')
+        peptide_data.loc[peptide_data['picked'].isnull(), 'picked'] = False
+
         # Add monomer
         interaction_data = pd.concat([pd.DataFrame({'bait_id': [bait_id], 'prey_id': [bait_id], 'interaction_id': [bait_id + "_" + bait_id]}), interaction_data], sort=False)
         peptide_dfs = []
@@ -184,32 +184,18 @@ class export_tables:
             """, 
             con
         )
-        return df
+        return decode_ids(con, df)
 
     def read_proteins(self, con):
         df = pd.read_sql('SELECT * FROM PROTEIN_PEAKS;', con)
-        return df
+        return decode_ids(con, df)
 
-    def read_peptides(self, con):
-        df = pd.read_sql(
-            """
-            SELECT 
-                SEC.condition_id || "_" || SEC.replicate_id AS tag, 
-                SEC.condition_id, SEC.replicate_id,
-                SEC.sec_id, 
-                QUANTIFICATION.protein_id, 
-                QUANTIFICATION.peptide_id, 
-                peptide_intensity, 
-                MONOMER.sec_id AS monomer_sec_id 
-            FROM QUANTIFICATION 
-            INNER JOIN PROTEIN_META ON QUANTIFICATION.protein_id = PROTEIN_META.protein_id 
-            INNER JOIN PEPTIDE_META ON QUANTIFICATION.peptide_id = PEPTIDE_META.peptide_id 
-            INNER JOIN SEC ON QUANTIFICATION.RUN_ID = SEC.RUN_ID 
-            INNER JOIN MONOMER ON QUANTIFICATION.protein_id = MONOMER.protein_id AND SEC.condition_id = MONOMER.condition_id AND SEC.replicate_id = MONOMER.replicate_id 
-            WHERE peptide_rank <= %s;
-            """ % (self.peptide_rank), 
-            con
-        )
+    def read_peptides(self, protein_ids):
+        con = connect(self.infile)
+        df = self.cube.to_df(encode_protein_ids(con, list(set(protein_ids))), maximum_peptides=self.peptide_rank)
+        df.insert(0, 'tag', df['condition_id'] + "_" + df['replicate_id'])
+        df = decode_ids(con, df)
+        con.close()
         return df
 
     def read_interactions(self, con):
@@ -219,12 +205,14 @@ class export_tables:
             table = 'EDGE_LEVEL'
 
         if check_sqlite_table(con, 'EDGE') and self.mode == 'quantitative':
-            df = pd.read_sql('SELECT DISTINCT bait_id || "_" || prey_id AS interaction_id, 0 as decoy FROM %s WHERE pvalue_adjusted < %s AND abs_log2fx > %s ORDER BY pvalue ASC;' % (table, self.max_qvalue, self.min_abs_log2fx), con)
+            df = pd.read_sql('SELECT DISTINCT bait_id, prey_id, bait_id || "_" || prey_id AS interaction_id, 0 as decoy FROM %s WHERE pvalue_adjusted < %s AND abs_log2fx > %s ORDER BY pvalue ASC;' % (table, self.max_qvalue, self.min_abs_log2fx), con)
         elif self.mode == 'detection':
-            df = pd.read_sql('SELECT DISTINCT bait_id || "_" || prey_id AS interaction_id, decoy FROM FEATURE_SCORED_COMBINED WHERE qvalue < %s GROUP BY bait_id, prey_id ORDER BY qvalue ASC;' % (self.max_qvalue), con)
+            df = pd.read_sql('SELECT DISTINCT bait_id, prey_id, bait_id || "_" || prey_id AS interaction_id, decoy FROM FEATURE_SCORED_COMBINED WHERE qvalue < %s GROUP BY bait_id, prey_id ORDER BY qvalue ASC;' % (self.max_qvalue), con)
         else:
             sys.exit("Error: Mode for interaction plotting not supported.")
 
+        df = decode_ids(con, df)
+
         return df['interaction_id'].values, df.index+1, df['decoy'].values
 
     def read_interactions_dmeta(self, con):
@@ -235,7 +223,7 @@ class export_tables:
         else:
             df = None
 
-        return df
+        return decode_ids(con, df)
 
     def read_interactions_qmeta(self, con):
         df = None
@@ -245,7 +233,7 @@ class export_tables:
         else:
             df = None
 
-        return df
+        return decode_ids(con, df)
 
     def read_monomer_qmeta(self, con):
         df = None
@@ -255,7 +243,7 @@ class export_tables:
         else:
             df = None
 
-        return df
+        return decode_ids(con, df)
 
     def read_baits(self, con):
         if not check_sqlite_table(con, 'NODE'):
@@ -271,4 +259,6 @@ class export_tables:
 
         df = df.sort_values(by=['pvalue']).reset_index()
 
+        df = decode_ids(con, df)
+
         return df['bait_id'].values, df.index+1
@@ -24,6 +24,8 @@ from pyprophet.stats import pemp, qvalue, pi0est
 
 from hyperopt import hp
 
+from .database import writer, decode_ids
+
 class pyprophet:
     def __init__(self, outfile, apply_model, minimum_abundance_ratio, maximum_sec_shift, cb_decoys, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, xgb_autotune, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, plot_reports, threads, test, export_tables):
 
@@ -87,6 +89,7 @@ class pyprophet:
         runs = self.read_runs()
 
         # Apply separately for each run
+        db = writer(outfile)
         for run in runs.iterrows():
             click.echo("Info: Apply scores to condition %s and replicate %s." %(run[1]['condition_id'], run[1]['replicate_id']))
             data = self.read_data(learning=False, condition_id=run[1]['condition_id'], replicate_id=run[1]['replicate_id'])
@@ -96,9 +99,8 @@ class pyprophet:
             else:
                 scored_data = data.groupby('confidence_bin', group_keys=False).apply(self.apply, condition_id=run[1]['condition_id'], replicate_id=run[1]['replicate_id'])
 
-            con = sqlite3.connect(outfile)
-            scored_data.to_sql('FEATURE_SCORED', con, index=False, if_exists='append')
-            con.close()
+            db.write('FEATURE_SCORED', scored_data, if_exists='append')
+        db.close()
 
     def has_learning(self):
         con = sqlite3.connect(self.outfile)
@@ -121,11 +123,11 @@ class pyprophet:
     def read_data(self, learning=False, condition_id=None, replicate_id=None):
         con = sqlite3.connect(self.outfile)
         if learning and condition_id is None and replicate_id is None:
-            df = pd.read_sql('SELECT *, condition_id || "_" || replicate_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_feature_id, condition_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_metafeature_id FROM FEATURE WHERE learning==1 OR decoy==1 ORDER BY pyprophet_metafeature_id;', con)
+            df = pd.read_sql('SELECT *, condition_id || "_" || replicate_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_feature_id, condition_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_metafeature_id FROM FEATURE WHERE learning==1 OR decoy==1 ORDER BY condition_id, bait_id, prey_id, decoy;', con)
         elif condition_id is not None and replicate_id is not None:
-            df = pd.read_sql('SELECT *, condition_id || "_" || replicate_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_feature_id, condition_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_metafeature_id FROM FEATURE WHERE learning==0 AND condition_id=="%s" AND replicate_id=="%s" ORDER BY pyprophet_metafeature_id;' % (condition_id, replicate_id), con)
+            df = pd.read_sql('SELECT *, condition_id || "_" || replicate_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_feature_id, condition_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_metafeature_id FROM FEATURE WHERE learning==0 AND condition_id=="%s" AND replicate_id=="%s" ORDER BY condition_id, bait_id, prey_id, decoy;' % (condition_id, replicate_id), con)
         else:
-            df = pd.read_sql('SELECT *, condition_id || "_" || replicate_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_feature_id, condition_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_metafeature_id FROM FEATURE ORDER BY pyprophet_metafeature_id;', con)
+            df = pd.read_sql('SELECT *, condition_id || "_" || replicate_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_feature_id, condition_id || "_" || bait_id || "_" || prey_id || "_" || decoy AS pyprophet_metafeature_id FROM FEATURE ORDER BY condition_id, bait_id, prey_id, decoy;', con)
         con.close()
 
         # Filter according to boundaries
@@ -135,6 +137,10 @@ class pyprophet:
 
         df = pd.merge(df, df_filter[["bait_id","prey_id","decoy"]], on=["bait_id","prey_id","decoy"])
 
+        # Queries skipped by the MIC/TIC prefilter of score must not pass the filter
+        if df['var_mic'].isnull().any() or df['var_tic'].isnull().any():
+            sys.exit("Error: %s queries without MIC/TIC scores pass the filter. Run 'secat score' with '--no-prefilter' or prefilter thresholds not stricter than '--minimum_abundance_ratio %s --maximum_sec_shift %s'." % ((df['var_mic'].isnull() | df['var_tic'].isnull()).sum(), self.minimum_abundance_ratio, self.maximum_sec_shift))
+
         # We need to generate a kickstart score for semi-supervised learning that selects for the very best interaction heterodimers: perfect shape, co-elution and overlap
         df['main_var_kickstart'] = (df['var_xcorr_shape'] * df['var_total_abundance_ratio']) / (df['var_xcorr_shift'] + 1)
 
@@ -174,7 +180,9 @@ class pyprophet:
 
         if self.export_tables:
             file_name = os.path.splitext(os.path.basename(self.outfile))[0]+"_learn_int_scored.csv"
-            result.scored_tables.to_csv(file_name, index=False)
+            con = sqlite3.connect(self.outfile)
+            decode_ids(con, result.scored_tables).to_csv(file_name, index=False)
+            con.close()
 
         self.plot(result, scorer.pi0, "learning")
         self.plot_scores(result.scored_tables, "learning")
@@ -4,16 +4,20 @@ from sqlite3 import connect
 from os import remove, path
 from sys import exit
 from shutil import copyfile
+from concurrent.futures import ProcessPoolExecutor
 
-from pandas import concat, read_sql
+from pandas import DataFrame, concat, read_sql
 from numpy import power
 
-from .preprocess import uniprot, net, sec, quantification, normalization, meta, query
-from .score import monomer, scoring
+from .preprocess import uniprot, net, sec, quantification, concat_quantification, normalization, meta, query, dictionary
+from .reference import build_reference, reference_bundle, read_reference_network
+from .score import monomer, scoring, mic_prefilter, parameter_hash, query_hash, input_hash
 from .learn import pyprophet, combine
 from .quantify import quantitative_matrix, enrichment_test
-from .plot import plot_features, check_sqlite_table
+from .plot import plot_features
 from .export import export_tables
+from .database import writer, check_sqlite_table, decode_ids
+from .cube import build_cube, cube_current
 
 from pyprophet.data_handling import transform_threads, transform_pi0_lambda
 
@@ -37,12 +41,14 @@ def cli():
 @click.option('--net', 'netfile', required=False, type=click.Path(exists=True), help='Reference binary protein-protein interaction file in STRING-DB or HUPO-PSI MITAB (2.5-2.7) format.')
 @click.option('--posnet', 'posnetfile', required=False, type=click.Path(exists=True), help='Reference binary positive protein-protein interaction file in STRING-DB or HUPO-PSI MITAB (2.5-2.7) format.')
 @click.option('--negnet', 'negnetfile', required=False, type=click.Path(exists=True), help='Reference binary negative protein-protein interaction file in STRING-DB or HUPO-PSI MITAB (2.5-2.7) format.')
-@click.option('--uniprot', 'uniprotfile', required=True, type=click.Path(exists=True), help='Reference molecular weights file in UniProt XML format.')
+@click.option('--uniprot', 'uniprotfile', required=False, type=click.Path(exists=True), help='Reference molecular weights file in UniProt XML format.')
+@click.option('--reference', 'referencedir', required=False, type=click.Path(exists=True), help='Reference bundle generated by "secat reference" replacing the UniProt XML file and compiled network files. Ignored if --uniprot is a different UniProt XML file than the one the bundle was built from.')
 @click.option('--columns', default=["run_id","sec_id","sec_mw","condition_id","replicate_id","run_id","protein_id","peptide_id","peptide_intensity"], show_default=True, type=(str,str,str,str,str,str,str,str,str), help='Column names for SEC & peptide quantification files')
 
 
 # Parameters for normalization
 @click.option('--normalize/--no-normalize', default=True, show_default=True, help='Normalize quantification data by sliding window cycling LOWESS normaklization.')
+@click.option('--normalize_method', 'normalize_method', default='cyclicloess', show_default=True, type=click.Choice(['cyclicloess', 'median', 'quantile', 'reference']), help='Either "cyclicloess", "median", "quantile" or "reference"; the method applied to each sliding window. median centers runs on their median intensity, quantile maps runs to the average intensity distribution and reference regresses runs against the run with most quantified peptides.')
 @click.option('--normalize_window','normalize_window', default=5, show_default=True, type=int, help='Number of SEC fractions per sliding window.')
 @click.option('--normalize_padded/--no-normalize_padded', default=True, show_default=True, help='Use padding for first and last SEC fractions.')
 # Parameters for decoys
@@ -51,115 +57,169 @@ def cli():
 @click.option('--decoy_right_sec_bins', 'decoy_right_sec_bins', default=1, show_default=True, type=int, help='Number of decoy bins for right SEC fraction.')
 @click.option('--decoy_oversample','decoy_oversample', default=2, show_default=True, type=int, help='Number of iterations to sample decoys.')
 @click.option('--decoy_subsample/--no-decoy_subsample', default=False, show_default=True, help='Whether decoys should be subsampled to be approximately of similar number as targets.')
+@click.option('--decoy_seed', 'decoy_seed', default=0, show_default=True, type=int, help='Seed of the random number generator used to sample decoys.')
 # @click.option('--decoy_exclude/--no-decoy_exclude', default=True, show_default=True, help='Whether decoy interactions also covered by targets should be excluded.')
 @click.option('--min_interaction_confidence', 'min_interaction_confidence', default=0.0, show_default=True, type=float, help='Minimum interaction confidence for prior information from network.')
 @click.option('--interaction_confidence_bins', 'interaction_confidence_bins', default=100, show_default=True, type=int, help='Number of interaction confidence bins for grouped error rate estimation.')
 @click.option('--interaction_confidence_quantile/--no-interaction_confidence_quantile', default=True, show_default=True, help='Whether interaction confidence bins should be grouped by quantiles.')
 @click.option('--use_cached_uniprot', 'cache', default=True, required=False, show_default=True, type=bool, help='Whether to use the Uniprot table parsed from a previous run')
-def preprocess(infiles, outfile, secfile, netfile, posnetfile, negnetfile, uniprotfile, columns, normalize, normalize_window, normalize_padded, decoy_intensity_bins, decoy_left_sec_bins, decoy_right_sec_bins, decoy_oversample, decoy_subsample, min_interaction_confidence, interaction_confidence_bins, interaction_confidence_quantile, cache): # decoy_exclude
+@click.option('--threads', default=-1, show_default=True, type=int, help='Number of processes used for parallel parsing and normalization. -1 means all available CPUs.', callback=transform_threads)
+def preprocess(infiles, outfile, secfile, netfile, posnetfile, negnetfile, uniprotfile, referencedir, columns, normalize, normalize_method, normalize_window, normalize_padded, decoy_intensity_bins, decoy_left_sec_bins, decoy_right_sec_bins, decoy_oversample, decoy_subsample, decoy_seed, min_interaction_confidence, interaction_confidence_bins, interaction_confidence_quantile, cache, threads): # decoy_exclude
     """
     Import and preprocess SEC data.
     """
 
+    if uniprotfile is None and referencedir is None:
+        exit("Error: Either a UniProt XML file or a reference bundle is required.")
+
+    # Load reference bundle; bundles built from a different UniProt XML file are ignored
+    if referencedir is not None:
+        reference_data = reference_bundle(referencedir)
+        if uniprotfile is not None and not reference_data.built_from(uniprotfile):
+            click.echo("Info: Reference bundle %s was not built from UniProt XML file %s. Parsing UniProt XML and network files instead." % (referencedir, uniprotfile))
+            reference_data = None
+        else:
+            click.echo("Info: Using reference bundle %s." % referencedir)
+    else:
+        reference_data = None
+
     # Prepare output file
     try:
         remove(outfile)
     except OSError:
         pass
 
-    con = connect(outfile)
+    db = writer(outfile)
 
-    # Generate SEC definition table
+    # Parse SEC definition table
     click.echo("Info: Parsing SEC definition file %s." % secfile)
     sec_data = sec(secfile, columns)
-    sec_data.to_df().to_sql('SEC', con, index=False)
 
     # Generate Peptide quantification table
     run_ids = sec_data.to_df()['run_id'].unique() # Extract valid run_ids from SEC definition table
 
-    quantification_list = []
-    for infile in infiles:
-        click.echo("Info: Parsing peptide quantification file %s." % infile)
-        quantification_list.append(quantification(infile, columns, run_ids).to_df())
-    quantification_data = concat(quantification_list)
-
-    # Normalize quantitative data
-    if normalize:
-        click.echo("Info: Normalizing quantitative data.")
-        quantification_data = normalization(quantification_data, sec_data.to_df(), normalize_window, normalize_padded, outfile).to_df()
-
-    # Store quantification data
-    quantification_data.to_sql('QUANTIFICATION' ,con, index=False, if_exists='append')
-
-    # Generate peptide and protein meta data over all conditions and replicates
-    click.echo("Info: Generating peptide and protein meta data.")
-    meta_data = meta(quantification_data, sec_data.to_df(), decoy_intensity_bins, decoy_left_sec_bins, decoy_right_sec_bins)
-    meta_data.peptide_meta.to_sql('PEPTIDE_META', con, index=False)
-    meta_data.protein_meta.to_sql('PROTEIN_META', con, index=False)
-
-    # Generate UniProt table
-    click.echo("Info: Parsing UniProt XML file %s." % uniprotfile)
-    uniprot_data = uniprot(uniprotfile, cache)
-    uniprot_data.to_df().to_sql('PROTEIN', con, index=False)
-
-    # Generate Network table
-    if netfile != None:
-        click.echo("Info: Parsing network file %s." % netfile)
-    else:
-        click.echo("Info: No reference network file was provided.")
-        # decoy_exclude = False
-    net_data = net(netfile, uniprot_data, meta_data)
-    net_data.to_df().to_sql('NETWORK', con, index=False)
-
-    # Generate Positive Network table
-    if posnetfile != None:
-        click.echo("Info: Parsing positive network file %s." % posnetfile)
-        posnet_data = net(posnetfile, uniprot_data, meta_data)
-        posnet_data.to_df().to_sql('POSITIVE_NETWORK', con, index=False)
-    else:
-        posnet_data = None
-
-    # Generate Negative Network table
-    if negnetfile != None:
-        click.echo("Info: Parsing negative network file %s." % negnetfile)
-        negnet_data = net(negnetfile, uniprot_data, meta_data)
-        negnet_data.to_df().to_sql('NEGATIVE_NETWORK', con, index=False)
-    else:
-        negnet_data = None
+    # Independent parsers run concurrently and are only joined where their data is needed
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        quantification_futures = []
+        for infile in infiles:
+            click.echo("Info: Parsing peptide quantification file %s." % infile)
+            quantification_futures.append(executor.submit(quantification, infile, columns, run_ids, max(1, threads // len(infiles))))
+        quantification_data = concat_quantification([f.result().to_df() for f in quantification_futures])
+
+        protein_ids = quantification_data['protein_id'].unique()
+
+        # Generate UniProt table (restricted to proteins covered by LC-MS/MS data)
+        if reference_data is None:
+            click.echo("Info: Parsing UniProt XML file %s." % uniprotfile)
+        uniprot_future = executor.submit(uniprot, uniprotfile, cache, protein_ids, reference_data)
+
+        # Parse network files (restricted to proteins covered by LC-MS/MS data)
+        if netfile != None:
+            click.echo("Info: Parsing network file %s." % netfile)
+        else:
+            click.echo("Info: No reference network file was provided.")
+            # decoy_exclude = False
+        network_futures = {}
+        for networkfile in [netfile, posnetfile, negnetfile]:
+            if networkfile != None and networkfile not in network_futures:
+                network_futures[networkfile] = executor.submit(read_reference_network, networkfile, protein_ids, reference_data)
+        if posnetfile != None:
+            click.echo("Info: Parsing positive network file %s." % posnetfile)
+        if negnetfile != None:
+            click.echo("Info: Parsing negative network file %s." % negnetfile)
+
+        # Normalize quantitative data with the processes not used by pending parsers
+        if normalize:
+            click.echo("Info: Normalizing quantitative data.")
+            busy = sum(not f.done() for f in [uniprot_future] + list(network_futures.values()))
+            quantification_data = normalization(quantification_data, sec_data.to_df(), normalize_window, normalize_padded, outfile, max(1, threads - busy), normalize_method).to_df()
+
+        # Generate integer keys for run, protein and peptide identifiers covered by LC-MS/MS data
+        dictionary_data = dictionary(quantification_data['run_id'], quantification_data['protein_id'], quantification_data['peptide_id'])
+        dictionary_data.store(db)
+
+        # Store SEC definition and quantification data (entries without identifiers in the dictionary are not written)
+        db.write('SEC', dictionary_data.encode(sec_data.to_df()))
+        db.write('QUANTIFICATION', dictionary_data.encode(quantification_data))
+
+        # Generate peptide and protein meta data over all conditions and replicates
+        click.echo("Info: Generating peptide and protein meta data.")
+        meta_data = meta(quantification_data, sec_data.to_df(), decoy_intensity_bins, decoy_left_sec_bins, decoy_right_sec_bins)
+        db.write('PEPTIDE_META', dictionary_data.encode(meta_data.peptide_meta))
+        db.write('PROTEIN_META', dictionary_data.encode(meta_data.protein_meta))
+
+        uniprot_data = uniprot_future.result()
+        db.write('PROTEIN', dictionary_data.encode(uniprot_data.to_df()))
+
+        # Generate Network table
+        net_data = net(netfile, uniprot_data, meta_data, *(network_futures[netfile].result() if netfile != None else (None, False)))
+        db.write('NETWORK', dictionary_data.encode(net_data.to_df()))
+
+        # Generate Positive Network table
+        if posnetfile != None:
+            posnet_data = net(posnetfile, uniprot_data, meta_data, *network_futures[posnetfile].result())
+            db.write('POSITIVE_NETWORK', dictionary_data.encode(posnet_data.to_df()))
+        else:
+            posnet_data = None
+
+        # Generate Negative Network table
+        if negnetfile != None:
+            negnet_data = net(negnetfile, uniprot_data, meta_data, *network_futures[negnetfile].result())
+            db.write('NEGATIVE_NETWORK', dictionary_data.encode(negnet_data.to_df()))
+        else:
+            negnet_data = None
 
     # Generate interaction query data
     click.echo("Info: Generating interaction query data.")
-    query_data = query(net_data, posnet_data, negnet_data, meta_data.protein_meta, min_interaction_confidence, interaction_confidence_bins, interaction_confidence_quantile, decoy_oversample, decoy_subsample) # decoy_exclude
-    query_data.to_df().to_sql('QUERY', con, index=False)
-
-    # Remove any entries that are not necessary (proteins not covered by LC-MS/MS data)
-    con.execute('DELETE FROM PROTEIN WHERE protein_id NOT IN (SELECT DISTINCT(protein_id) as protein_id FROM QUANTIFICATION);')
-    con.execute('DELETE FROM NETWORK WHERE bait_id NOT IN (SELECT DISTINCT(protein_id) as protein_id FROM QUANTIFICATION) OR prey_id NOT IN (SELECT DISTINCT(protein_id) as protein_id FROM QUANTIFICATION);')
-    con.execute('DELETE FROM SEC WHERE run_id NOT IN (SELECT DISTINCT(run_id) as run_id FROM QUANTIFICATION);')
-    con.execute('DELETE FROM QUERY WHERE bait_id NOT IN (SELECT DISTINCT(protein_id) as protein_id FROM QUANTIFICATION) OR prey_id NOT IN (SELECT DISTINCT(protein_id) as protein_id FROM QUANTIFICATION);')
+    query_data = query(net_data, posnet_data, negnet_data, meta_data.protein_meta, min_interaction_confidence, interaction_confidence_bins, interaction_confidence_quantile, decoy_oversample, decoy_subsample, decoy_seed) # decoy_exclude
+    db.write('QUERY', dictionary_data.encode(query_data.to_df()))
 
     # Add indices
-    con.execute('CREATE INDEX IF NOT EXISTS idx_protein_protein_id ON PROTEIN (protein_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_network_bait_id ON NETWORK (bait_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_network_prey_id ON NETWORK (prey_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_network_bait_id_prey_id ON NETWORK (bait_id, prey_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_quantification_run_id ON QUANTIFICATION (run_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_quantification_protein_id ON QUANTIFICATION (protein_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_quantification_peptide_id ON QUANTIFICATION (peptide_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_peptide_meta_peptide_id ON PEPTIDE_META (peptide_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_protein_meta_protein_id ON PROTEIN_META (protein_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_query_bait_id ON QUERY (bait_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_query_prey_id ON QUERY (prey_id);')
-    con.execute('CREATE INDEX IF NOT EXISTS idx_query_bait_id_prey_id ON QUERY (bait_id, prey_id);')
-    # con.execute('VACUUM;')
-
-    con.commit()
+    db.index('RUN_DICT', ['run_key'])
+    db.index('PROTEIN_DICT', ['protein_key'])
+    db.index('PEPTIDE_DICT', ['peptide_key'])
+    db.index('PROTEIN', ['protein_id'])
+    db.index('NETWORK', ['bait_id'])
+    db.index('NETWORK', ['prey_id'])
+    db.index('NETWORK', ['bait_id', 'prey_id'])
+    db.index('QUANTIFICATION', ['run_id'])
+    db.index('QUANTIFICATION', ['protein_id'])
+    db.index('QUANTIFICATION', ['peptide_id'])
+    db.index('PEPTIDE_META', ['peptide_id'])
+    db.index('PROTEIN_META', ['protein_id'])
+    db.index('QUERY', ['bait_id'])
+    db.index('QUERY', ['prey_id'])
+    db.index('QUERY', ['bait_id', 'prey_id'])
 
     # Close connection to file
-    con.close()
+    db.close()
 
     click.echo("Info: Data successfully preprocessed and stored in %s." % outfile)
 
+# SECAT build reference bundle
+@cli.command()
+@click.option('--out', 'outdir', required=True, type=click.Path(exists=False), help='Output SECAT reference bundle directory.')
+@click.option('--uniprot', 'uniprotfile', required=True, type=click.Path(exists=True), help='Reference molecular weights file in UniProt XML format.')
+@click.option('--net', 'netfiles', required=False, multiple=True, type=click.Path(exists=True), help='Reference binary protein-protein interaction file in STRING-DB, HUPO-PSI MITAB (2.5-2.7), BioPlex, PrePPI or binary format. Can be specified multiple times.')
+def reference(outdir, uniprotfile, netfiles):
+    """
+    Build reference bundle of UniProt and network data for reuse in preprocess.
+    """
+
+    build_reference(outdir, uniprotfile, netfiles)
+
+def transform_shard(ctx, param, value):
+    # Shards are given as "i/N" with 1 <= i <= N
+    if value is None:
+        return None
+    try:
+        shard_index, shard_count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise click.BadParameter("Shard must be given as 'i/N', e.g. '1/4'.")
+    if shard_count < 1 or shard_index < 1 or shard_index > shard_count:
+        raise click.BadParameter("Shard index must be between 1 and the number of shards, e.g. '1/4'.")
+    return (shard_index, shard_count)
+
 # SECAT score features
 @cli.command()
 @click.option('--in', 'infile', required=True, type=click.Path(exists=True), help='Input SECAT file.')
@@ -169,12 +229,160 @@ def preprocess(infiles, outfile, secfile, netfile, posnetfile, negnetfile, unipr
 @click.option('--maximum_peptides', 'maximum_peptides', default=3, show_default=True, type=int, help='Maximum number of peptides used to score an interaction.')
 @click.option('--peakpicking', default='none', show_default=True, type=click.Choice(['none', 'detrend_zero', 'detrend_drop', 'localmax_conditions', 'localmax_replicates']), help='Either "none", "detrend_zero", "detrend_drop", "localmax_conditions" or "localmax_replicates"; the method for peakpicking of the peptide chromatograms. detrend_drop averages over all fractions with peptides; detrend_zero averages over all fractions (less agressive). localmax_conditions averages peak-picking over replicates of the same conditions; localmax_replicates conducts peak-picking for all samples separately.')
 @click.option('--chunck_size', 'chunck_size', default=50000, show_default=True, type=int, help='Chunck size for processing.')
+@click.option('--block_scoring/--no-block_scoring', default=False, show_default=True, help='Score all queries of a bait as one block of stacked prey profiles. Features are equivalent to scoring each query separately.')
+# Prefiltering
+@click.option('--prefilter/--no-prefilter', default=False, show_default=True, help='Compute MIC/TIC scores only for queries that can pass the learn prefilter. The learn thresholds must not be stricter than the thresholds below.')
+@click.option('--minimum_abundance_ratio', 'minimum_abundance_ratio', default=0.1, show_default=True, type=float, help='Minimum abundance ratio required to compute MIC/TIC scores.')
+@click.option('--maximum_sec_shift', 'maximum_sec_shift', default=10, show_default=True, type=float, help='Maximum lag in SEC units required to compute MIC/TIC scores.')
 @click.option('--threads', default=1, show_default=True, type=int, help='Number of threads used for parallel processing. -1 means all available CPUs.', callback=transform_threads)
-def score(infile, outfile, monomer_threshold_factor, minimum_peptides, maximum_peptides, peakpicking, chunck_size, threads):
+@click.option('--resume/--no-resume', default=False, show_default=True, help='Resume an interrupted run with the same parameters and skip completed chuncks.')
+@click.option('--shard', default=None, type=str, help='Score only shard i of N of the queries, e.g. "1/4", and store the features in a separate shard file. Combine all shards with "secat merge".', callback=transform_shard)
+def score(infile, outfile, monomer_threshold_factor, minimum_peptides, maximum_peptides, peakpicking, chunck_size, block_scoring, prefilter, minimum_abundance_ratio, maximum_sec_shift, threads, resume, shard):
     """
     Score interaction features in SEC data.
     """
 
+    # Define outfile
+    if shard is not None:
+        # Shards only read the input file and store features, monomers and peak boundaries
+        if outfile is None:
+            outfile = "%s_shard%sof%s%s" % (path.splitext(infile)[0], shard[0], shard[1], path.splitext(infile)[1])
+        elif path.abspath(outfile) == path.abspath(infile):
+            exit("Error: Shards must be stored in a separate output file.")
+        if not resume and path.exists(outfile):
+            remove(outfile)
+        source = infile
+    elif outfile is None:
+        outfile = infile
+        source = outfile
+    elif not (resume and path.exists(outfile)):
+        copyfile(infile, outfile)
+        outfile = outfile
+        source = outfile
+    else:
+        source = outfile
+
+    # Completed chuncks are only reused with the same parameters and input data; the query hash also identifies shards
+    queries = query_hash(infile)
+    checkpoint = parameter_hash(input=input_hash(infile, queries), monomer_threshold_factor=monomer_threshold_factor, minimum_peptides=minimum_peptides, maximum_peptides=maximum_peptides, peakpicking=peakpicking, chunck_size=chunck_size, block_scoring=block_scoring, prefilter=prefilter, minimum_abundance_ratio=minimum_abundance_ratio if prefilter else None, maximum_sec_shift=maximum_sec_shift if prefilter else None)
+
+    if resume:
+        con = connect(outfile)
+        if check_sqlite_table(con, 'SCORE_PROGRESS'):
+            checkpoints = read_sql('SELECT DISTINCT parameter_hash FROM SCORE_PROGRESS;', con)['parameter_hash']
+        else:
+            checkpoints = None
+        con.close()
+
+        if checkpoints is None:
+            click.echo("Info: No completed chuncks found. Start scoring.")
+            resume = False
+        elif (checkpoints != checkpoint).any():
+            exit("Error: Completed chuncks were scored with different parameters or input data. Rerun 'secat score' with the same parameters and input file or without '--resume'.")
+
+    if shard is not None:
+        # Shard provenance identifies the shard, its parameters and the queries of the input file
+        shard_data = DataFrame({'shard_index': [shard[0]], 'shard_count': [shard[1]], 'parameter_hash': [checkpoint], 'query_hash': [queries], 'complete': [0]})
+
+        if resume:
+            con = connect(outfile)
+            if check_sqlite_table(con, 'SCORE_SHARD'):
+                shard_progress = read_sql('SELECT shard_index, shard_count, query_hash FROM SCORE_SHARD;', con)
+            else:
+                shard_progress = None
+            con.close()
+
+            if shard_progress is None or shard_progress.shape[0] != 1 or tuple(shard_progress.iloc[0]) != (shard[0], shard[1], queries):
+                exit("Error: %s is not shard %s of %s of %s. Rerun 'secat score' with the same shard or without '--resume'." % (outfile, shard[0], shard[1], infile))
+
+    if not resume:
+        # Find monomer thresholds
+        click.echo("Info: Detect monomers.")
+        monomer_data = monomer(source, monomer_threshold_factor)
+
+        db = writer(outfile)
+        db.write('MONOMER', monomer_data.df, if_exists='replace')
+        db.close()
+
+    # Materialize filtered peptide chromatograms; resumed runs only rebuild a missing or outdated cube
+    if not resume or not cube_current(outfile):
+        click.echo("Info: Build peptide chromatogram cube.")
+        build_cube(outfile, source)
+
+    # Signal processing
+    click.echo("Info: Signal processing.")
+
+    if not resume:
+        # Drop features and progress if they already exist
+        db = writer(outfile)
+        db.execute('DROP TABLE IF EXISTS FEATURE;')
+        db.execute('DROP TABLE IF EXISTS SCORE_PROGRESS;')
+        db.execute('DROP TABLE IF EXISTS SCORE_SHARD;')
+        if shard is not None:
+            db.write('SCORE_SHARD', shard_data)
+        db.close()
+
+    if prefilter:
+        scoring(outfile, chunck_size, threads, minimum_peptides, maximum_peptides, peakpicking, checkpoint, mic_prefilter(maximum_sec_shift, minimum_abundance_ratio), source, shard, block_scoring)
+    else:
+        scoring(outfile, chunck_size, threads, minimum_peptides, maximum_peptides, peakpicking, checkpoint, None, source, shard, block_scoring)
+
+    if shard is not None:
+        # Completed shards can be merged
+        db = writer(outfile)
+        db.execute('UPDATE SCORE_SHARD SET complete = 1;')
+        db.close()
+
+        click.echo("Info: Shard %s of %s completed and stored in %s. Combine all shards with 'secat merge'." % (shard[0], shard[1], outfile))
+    # cProfile.runctx('scoring(outfile, chunck_size, minimum_peptides, maximum_peptides, peakpicking)', globals(), locals = {'outfile': outfile, 'chunck_size': chunck_size, 'minimum_peptides': minimum_peptides, 'maximum_peptides': maximum_peptides, 'peakpicking': peakpicking}, filename="score_performance.cprof")
+
+# SECAT merge shards
+@cli.command()
+@click.argument('shardfiles', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--in', 'infile', required=True, type=click.Path(exists=True), help='Input SECAT file the shards were scored from.')
+@click.option('--out', 'outfile', required=False, type=click.Path(exists=False), help='Output SECAT file.')
+def merge(shardfiles, infile, outfile):
+    """
+    Merge scored shards into a SECAT file.
+    """
+
+    # Read shard provenance
+    shards = []
+    for shardfile in shardfiles:
+        con = connect(shardfile)
+        if check_sqlite_table(con, 'SCORE_SHARD'):
+            shard = read_sql('SELECT * FROM SCORE_SHARD;', con)
+        else:
+            shard = None
+        con.close()
+
+        # Merged files keep the provenance of all their shards
+        if shard is None or shard.shape[0] != 1:
+            exit("Error: %s is not a SECAT shard file." % shardfile)
+        shards.append(shard.assign(shardfile=shardfile))
+    shards = concat(shards, ignore_index=True).sort_values('shard_index')
+
+    # Verify completeness and consistency of the shards
+    if shards['shard_count'].nunique() != 1:
+        exit("Error: Shards were scored with different numbers of shards.")
+    shard_count = shards['shard_count'].iloc[0]
+
+    if shards['shard_index'].duplicated().any():
+        exit("Error: Shards %s were supplied more than once." % ', '.join(shards[shards['shard_index'].duplicated()]['shard_index'].astype(str).unique()))
+    missing = sorted(set(range(1, shard_count + 1)) - set(shards['shard_index']))
+    if len(missing) > 0:
+        exit("Error: Shards %s of %s are missing." % (', '.join(map(str, missing)), shard_count))
+
+    incomplete = shards[shards['complete'] != 1]
+    if incomplete.shape[0] > 0:
+        exit("Error: Shards %s are incomplete. Resume them with 'secat score --resume'." % ', '.join(incomplete['shardfile']))
+
+    if shards['parameter_hash'].nunique() != 1:
+        exit("Error: Shards were scored with different parameters.")
+
+    if (shards['query_hash'] != query_hash(infile)).any():
+        exit("Error: Shards were not scored from %s." % infile)
+
     # Define outfile
     if outfile is None:
         outfile = infile
@@ -183,25 +391,26 @@ def score(infile, outfile, monomer_threshold_factor, minimum_peptides, maximum_p
         copyfile(infile, outfile)
         outfile = outfile
 
-    # Find monomer thresholds
-    click.echo("Info: Detect monomers.")
-    monomer_data = monomer(outfile, monomer_threshold_factor)
+    db = writer(outfile)
+    db.execute('DROP TABLE IF EXISTS FEATURE;')
+    db.execute('DROP TABLE IF EXISTS SCORE_PROGRESS;')
 
-    con = connect(outfile)
-    monomer_data.df.to_sql('MONOMER', con, index=False, if_exists='replace')
-    con.close()
+    # Monomers and peak boundaries are identical in all shards
+    db.copy(shards['shardfile'].iloc[0], 'MONOMER', if_exists='replace')
+    db.copy(shards['shardfile'].iloc[0], 'PROTEIN_PEAKS', if_exists='replace')
 
-    # Signal processing
-    click.echo("Info: Signal processing.")
+    for shard in shards.itertuples():
+        click.echo("Info: Merge shard %s of %s from %s." % (shard.shard_index, shard_count, shard.shardfile))
+        db.copy(shard.shardfile, 'FEATURE', if_exists='append')
 
-    # Drop features if they already exist
-    con = connect(outfile)
-    c = con.cursor()
-    c.execute('DROP TABLE IF EXISTS FEATURE;')
-    con.close()
+    db.write('SCORE_SHARD', shards, if_exists='replace')
+    db.close()
 
-    scoring(outfile, chunck_size, threads, minimum_peptides, maximum_peptides, peakpicking)
-    # cProfile.runctx('scoring(outfile, chunck_size, minimum_peptides, maximum_peptides, peakpicking)', globals(), locals = {'outfile': outfile, 'chunck_size': chunck_size, 'minimum_peptides': minimum_peptides, 'maximum_peptides': maximum_peptides, 'peakpicking': peakpicking}, filename="score_performance.cprof")
+    # Materialize filtered peptide chromatograms for the merged monomers
+    click.echo("Info: Build peptide chromatogram cube.")
+    build_cube(outfile)
+
+    click.echo("Info: %s shards merged and stored in %s." % (shard_count, outfile))
 
 # SECAT learn features
 @cli.command()
@@ -253,10 +462,9 @@ def learn(infile, outfile, apply_model, minimum_abundance_ratio, maximum_sec_shi
     click.echo("Info: Running PyProphet.")
 
     # Drop feature scores if they already exist
-    con = connect(outfile)
-    c = con.cursor()
-    c.execute('DROP TABLE IF EXISTS FEATURE_SCORED;')
-    con.close()
+    db = writer(outfile)
+    db.execute('DROP TABLE IF EXISTS FEATURE_SCORED;')
+    db.close()
 
     pyprophet(outfile, apply_model, minimum_abundance_ratio, maximum_sec_shift, cb_decoys, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, xgb_autotune, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, plot_reports, threads, test, export_tables)
 
@@ -265,12 +473,15 @@ def learn(infile, outfile, apply_model, minimum_abundance_ratio, maximum_sec_shi
 
     combined_data = combine(outfile, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, pfdr)
 
-    con = connect(outfile)
     if export_tables != False:
+        con = connect(outfile)
         network_interaction_name = path.splitext(infile)[0] + "_net_int_scored.csv"
-        combined_data.df.to_csv(network_interaction_name, index=False)
-    combined_data.df.to_sql('FEATURE_SCORED_COMBINED', con, index=False, if_exists='replace')
-    con.close()
+        decode_ids(con, combined_data.df).to_csv(network_interaction_name, index=False)
+        con.close()
+
+    db = writer(outfile)
+    db.write('FEATURE_SCORED_COMBINED', combined_data.df, if_exists='replace')
+    db.close()
 
 # SECAT quantify features
 @cli.command()
@@ -301,23 +512,22 @@ def quantify(infile, outfile, control_condition, paired, maximum_interaction_qva
     click.echo("Info: Prepare quantitative matrices.")
     qm = quantitative_matrix(outfile, maximum_interaction_qvalue, minimum_peptides, maximum_peptides)
 
-    con = connect(outfile)
-    qm.monomer_peptide.to_sql('MONOMER_QM', con, index=False, if_exists='replace')
-    qm.complex_peptide.to_sql('COMPLEX_QM', con, index=False, if_exists='replace')
-    con.close()
+    db = writer(outfile)
+    db.write('MONOMER_QM', qm.monomer_peptide, if_exists='replace')
+    db.write('COMPLEX_QM', qm.complex_peptide, if_exists='replace')
+    db.close()
 
     click.echo("Info: Assess differential features.")
     et = enrichment_test(outfile, control_condition, paired, min_abs_log2fx, missing_peptides, peptide_log2fx, threads)
 
 
-    con = connect(outfile)
-    et.edge.to_sql('EDGE', con, index=False, if_exists='replace')
-    et.edge_level.to_sql('EDGE_LEVEL', con, index=False, if_exists='replace')
-    et.node.to_sql('NODE', con, index=False, if_exists='replace')
-    et.node_level.to_sql('NODE_LEVEL', con, index=False, if_exists='replace')
-    et.protein_level.to_sql('PROTEIN_LEVEL', con, index=False, if_exists='replace')
-
-    con.close()
+    db = writer(outfile)
+    db.write('EDGE', et.edge, if_exists='replace')
+    db.write('EDGE_LEVEL', et.edge_level, if_exists='replace')
+    db.write('NODE', et.node, if_exists='replace')
+    db.write('NODE_LEVEL', et.node_level, if_exists='replace')
+    db.write('PROTEIN_LEVEL', et.protein_level, if_exists='replace')
+    db.close()
 
 # SECAT export features
 @cli.command()
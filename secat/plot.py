@@ -5,6 +5,9 @@ import sqlite3
 import os
 import sys
 
+from .cube import chromatogram_cube
+from .database import check_sqlite_table, decode_ids, encode_protein_ids
+
 try:
     import matplotlib
     matplotlib.use('Agg')
@@ -14,18 +17,6 @@ try:
 except ImportError:
     plt = None
 
-def check_sqlite_table(con, table):
-    table_present = False
-    c = con.cursor()
-    c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="%s"' % table)
-    if c.fetchone()[0] == 1:
-        table_present = True
-    else:
-        table_present = False
-    c.fetchall()
-
-    return(table_present)
-
 class plot_features:
 
     def __init__(self, infile, level, id, max_qvalue, min_abs_log2fx, mode, combined, peptide_rank):
@@ -43,7 +34,7 @@ class plot_features:
 
         # Read peptide and feature data
         self.feature_data = self.read_features()
-        self.peptide_data = self.read_peptides()
+        self.cube = chromatogram_cube(self.infile, fallback=True)
         self.protein_data = self.read_proteins()
 
         # Read meta data if available
@@ -69,13 +60,11 @@ class plot_features:
         feature_data = self.feature_data
         protein_data = self.protein_data
         protein_data['picked'] = True
-        peptide_data = self.peptide_data
 
         bait_id, prey_id = interaction_id.split("_")
 
         feature_data = feature_data[feature_data['interaction_id'] == interaction_id]
-        proteins = pd.DataFrame({"protein_id": [bait_id, prey_id]}).drop_duplicates()
-        peptide_data = pd.merge(peptide_data, proteins, how='inner', on='protein_id')
+        peptide_data = self.read_peptides([bait_id, prey_id])
 
         peptide_data = pd.merge(peptide_data, protein_data, on=['condition_id', 'replicate_id', 'protein_id', 'sec_id'], how='left')
         peptide_data.loc[peptide_data['picked'].isnull(), 'picked'] = False
@@ -94,14 +83,15 @@ class plot_features:
         feature_data = self.feature_data
         protein_data = self.protein_data
         protein_data['picked'] = True
-        peptide_data = self.peptide_data
-
-        peptide_data = pd.merge(peptide_data, protein_data, on=['condition_id', 'replicate_id', 'protein_id', 'sec_id'], how='left')
-        peptide_data.loc[peptide_data['picked'].isnull(), 'picked'] = False
 
         interaction_data = self.interactions_dmeta[['bait_id','prey_id','interaction_id']].drop_duplicates()
         interaction_data = interaction_data[(interaction_data['bait_id'] == bait_id) | (interaction_data['prey_id'] == bait_id)]
 
+        # Peptides of the bait and its interactors
+        peptide_data = self.read_peptides([bait_id] + interaction_data['bait_id'].tolist() + interaction_data['prey_id'].tolist())
+        peptide_data = pd.merge(peptide_data, protein_data, on=['condition_id', 'replicate_id', 'protein_id', 'sec_id'], how='left')
+        peptide_data.loc[peptide_data['picked'].isnull(), 'picked'] = False
+
         # Add monomer
         interaction_data = pd.concat([pd.DataFrame({'bait_id': [bait_id], 'prey_id': [bait_id], 'interaction_id': [bait_id + "_" + bait_id]}), interaction_data], sort=False)
 
@@ -136,6 +126,8 @@ class plot_features:
 
         df = pd.read_sql('SELECT *, condition_id || "_" || replicate_id AS tag, bait_id || "_" || prey_id AS interaction_id FROM FEATURE_SCORED;', con)
 
+        df = decode_ids(con, df)
+
         con.close()
 
         return df
@@ -145,14 +137,19 @@ class plot_features:
 
         df = pd.read_sql('SELECT * FROM PROTEIN_PEAKS;', con)
 
+        df = decode_ids(con, df)
+
         con.close()
 
         return df
 
-    def read_peptides(self):
+    def read_peptides(self, protein_ids):
         con = sqlite3.connect(self.infile)
 
-        df = pd.read_sql('SELECT SEC.condition_id || "_" || SEC.replicate_id AS tag, SEC.condition_id, SEC.replicate_id, SEC.sec_id, QUANTIFICATION.protein_id, QUANTIFICATION.peptide_id, peptide_intensity, MONOMER.sec_id AS monomer_sec_id FROM QUANTIFICATION INNER JOIN PROTEIN_META ON QUANTIFICATION.protein_id = PROTEIN_META.protein_id INNER JOIN PEPTIDE_META ON QUANTIFICATION.peptide_id = PEPTIDE_META.peptide_id INNER JOIN SEC ON QUANTIFICATION.RUN_ID = SEC.RUN_ID INNER JOIN MONOMER ON QUANTIFICATION.protein_id = MONOMER.protein_id and SEC.condition_id = MONOMER.condition_id AND SEC.replicate_id = MONOMER.replicate_id WHERE peptide_rank <= %s;' % (self.peptide_rank), con)
+        df = self.cube.to_df(encode_protein_ids(con, list(set(protein_ids))), maximum_peptides=self.peptide_rank)
+        df.insert(0, 'tag', df['condition_id'] + "_" + df['replicate_id'])
+
+        df = decode_ids(con, df)
 
         con.close()
 
@@ -167,12 +164,14 @@ class plot_features:
             table = 'EDGE_LEVEL'
 
         if check_sqlite_table(con, 'EDGE') and self.mode == 'quantitative':
-            df = pd.read_sql('SELECT DISTINCT bait_id || "_" || prey_id AS interaction_id, 0 as decoy FROM %s WHERE pvalue_adjusted < %s AND abs_log2fx > %s ORDER BY pvalue ASC;' % (table, self.max_qvalue, self.min_abs_log2fx), con)
+            df = pd.read_sql('SELECT DISTINCT bait_id, prey_id, bait_id || "_" || prey_id AS interaction_id, 0 as decoy FROM %s WHERE pvalue_adjusted < %s AND abs_log2fx > %s ORDER BY pvalue ASC;' % (table, self.max_qvalue, self.min_abs_log2fx), con)
         elif self.mode == 'detection':
-            df = pd.read_sql('SELECT DISTINCT bait_id || "_" || prey_id AS interaction_id, decoy FROM FEATURE_SCORED_COMBINED WHERE qvalue < %s GROUP BY bait_id, prey_id ORDER BY qvalue ASC;' % (self.max_qvalue), con)
+            df = pd.read_sql('SELECT DISTINCT bait_id, prey_id, bait_id || "_" || prey_id AS interaction_id, decoy FROM FEATURE_SCORED_COMBINED WHERE qvalue < %s GROUP BY bait_id, prey_id ORDER BY qvalue ASC;' % (self.max_qvalue), con)
         else:
             sys.exit("Error: Mode for interaction plotting not supported.")
 
+        df = decode_ids(con, df)
+
         con.close()
 
         return df['interaction_id'].values, df.index+1, df['decoy'].values
@@ -187,6 +186,8 @@ class plot_features:
         else:
             df = None
 
+        df = decode_ids(con, df)
+
         con.close()
 
         return df
@@ -201,6 +202,8 @@ class plot_features:
         else:
             df = None
 
+        df = decode_ids(con, df)
+
         con.close()
 
         return df
@@ -215,6 +218,8 @@ class plot_features:
         else:
             df = None
 
+        df = decode_ids(con, df)
+
         con.close()
 
         return df
@@ -233,6 +238,8 @@ class plot_features:
         if self.mode == 'quantitative':
             df = pd.read_sql('SELECT DISTINCT bait_id, min(pvalue) as pvalue FROM %s WHERE pvalue_adjusted < %s AND abs_log2fx > %s GROUP BY bait_id;' % (table, self.max_qvalue, self.min_abs_log2fx), con)
 
+        df = decode_ids(con, df)
+
         con.close()
 
         df = df.sort_values(by=['pvalue']).reset_index()
@@ -1,4 +1,5 @@
 import multiprocessing
+from multiprocessing import shared_memory
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
@@ -7,12 +8,20 @@ from sklearn import preprocessing
 import statsmodels.api as sm
 import sys
 import os
+import time
+import gzip
+import hashlib
+import csv
 import numpy as np
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from lxml import etree
 import itertools
+from math import comb
 
-from pandas.api.types import is_numeric_dtype
+from pandas.api.types import is_numeric_dtype, union_categoricals
 
 try:
     import matplotlib
@@ -22,64 +31,107 @@ try:
 except ImportError:
     plt = None
 
+# Upper bound of the estimated relative rounding error of the fast LOWESS expansion before fitting directly
+LOWESS_TOLERANCE = 1e-8
+
+def file_hash(filename):
+    # Content hash of a file for cache and reference keys
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
 class uniprot:
-    def __init__(self, uniprotfile, cache):
+    def __init__(self, uniprotfile, cache, protein_ids=None, reference=None):
         self.namespaces = {'uniprot': "http://uniprot.org/uniprot"}
         self.cache = cache
+        self.protein_ids = None if protein_ids is None else set(protein_ids)
+        self.reference = reference
         self.df = self.read(uniprotfile)
-    
+
     def read(self, uniprotfile):
-        if uniprotfile.endswith("xml.gz"):
-            cache_filename = uniprotfile.strip("xml.gz") + "parquet"
-        elif uniprotfile.endswith("xml"):
-            cache_filename = uniprotfile.strip("xml") + "parquet"
-        
-        if self.cache and os.path.exists(cache_filename):
-            print("Found cached table")
-            return pd.read_parquet(cache_filename)
-        
+        # Use precompiled reference bundle
+        if self.reference is not None:
+            return self.reference.proteins(self.protein_ids)
+
+        if not self.cache:
+            return self.parse(uniprotfile, self.protein_ids)
+
+        # The cache holds the full table and is keyed by file content
+        for suffix in [".xml.gz", ".xml", ".gz"]:
+            if uniprotfile.endswith(suffix):
+                cache_filename = uniprotfile[:-len(suffix)]
+                break
+        else:
+            cache_filename = uniprotfile
+        cache_filename = "%s.%s.parquet" % (cache_filename, file_hash(uniprotfile)[:16])
+
+        if os.path.exists(cache_filename):
+            click.echo("Info: Using cached UniProt table %s." % cache_filename)
+            df = pd.read_parquet(cache_filename)
+            df['ensembl_id'] = df['ensembl_id'].apply(list)
+        else:
+            df = self.parse(uniprotfile, None)
+            df.to_parquet(cache_filename, index=False)
+
+        if self.protein_ids is not None:
+            df = df[df['protein_id'].isin(self.protein_ids)].reset_index(drop=True)
+        return df
+
+    def parse(self, uniprotfile, protein_ids):
         def _extract(lst):
             if len(lst) >= 1:
                 return lst[0]
             else:
                 return None
 
-        df = pd.DataFrame(columns=["protein_id", "protein_name", "gene", "ensembl_id", "protein_mw"])
-
-        root = etree.parse(uniprotfile)
-
-        mw = root.xpath('//uniprot:entry/uniprot:sequence/@mass', namespaces = self.namespaces)
-        if root.xpath('//uniprot:entry/uniprot:organism/uniprot:dbReference[@type="NCBI Taxonomy"]/@id', namespaces = self.namespaces)[0] == '559292':
-            ensembl = root.xpath('//uniprot:entry/uniprot:gene/uniprot:name[@type = "ordered locus"]/text()', namespaces = self.namespaces)
-            ensembl_path = './uniprot:gene/uniprot:name[@type = "ordered locus"]/text()'
+        # Entries are streamed and cleared after use, so that memory usage does not grow with the size of the XML file
+        if uniprotfile.endswith(".gz"):
+            handle = gzip.open(uniprotfile, 'rb')
         else:
-            ensembl = root.xpath('//uniprot:entry/uniprot:dbReference[@type="Ensembl"]/uniprot:property[@type="protein sequence ID"]/@value', namespaces = self.namespaces)
-            ensembl_path = './uniprot:dbReference[@type="Ensembl"]/uniprot:property[@type="protein sequence ID"]/@value'
-
-        # TODO: Need to make this parsing more memory efficient
-        entries = root.xpath('//uniprot:entry', namespaces = self.namespaces)
-        rows = []
-        for entry in tqdm(entries, total=len(entries)):
-            accession = entry.xpath('./uniprot:accession/text()', namespaces = self.namespaces)
-            name = entry.xpath('./uniprot:name/text()', namespaces = self.namespaces)
-            gene = entry.xpath('./uniprot:gene/uniprot:name/text()', namespaces = self.namespaces)
-            mw = entry.xpath('./uniprot:sequence/@mass', namespaces = self.namespaces)
-            ensembl = entry.xpath(ensembl_path, namespaces = self.namespaces)
-
-            # To keep Ensembl IDs backwards compatible, ignore the version specifier
-            ensembl = [e.split(".")[0] for e in ensembl]
-
-            row = pd.Series({
-                'protein_id': _extract(accession), 
-                'protein_name': _extract(name), 
-                'gene': _extract(gene), 
-                'ensembl_id': ensembl, 
-                'protein_mw': float(_extract(mw))
-            })
-            rows.append(row)
-        
-        # Append each Series object as a new row to df
-        df = pd.concat([df, *[row.to_frame().T for row in rows]], ignore_index=True)
+            handle = open(uniprotfile, 'rb')
+
+        protein_id = []
+        protein_name = []
+        gene = []
+        ensembl_id = []
+        protein_mw = array('d')
+
+        ensembl_path = None
+        with handle:
+            for _, entry in tqdm(etree.iterparse(handle, events=('end',), tag='{%s}entry' % self.namespaces['uniprot'])):
+                # The organism of the first entry defines how Ensembl identifiers are mapped
+                if ensembl_path is None:
+                    if _extract(entry.xpath('./uniprot:organism/uniprot:dbReference[@type="NCBI Taxonomy"]/@id', namespaces = self.namespaces)) == '559292':
+                        ensembl_path = './uniprot:gene/uniprot:name[@type = "ordered locus"]/text()'
+                    else:
+                        ensembl_path = './uniprot:dbReference[@type="Ensembl"]/uniprot:property[@type="protein sequence ID"]/@value'
+
+                accession = _extract(entry.xpath('./uniprot:accession/text()', namespaces = self.namespaces))
+
+                if protein_ids is None or accession in protein_ids:
+                    # To keep Ensembl IDs backwards compatible, ignore the version specifier
+                    ensembl = [e.split(".")[0] for e in entry.xpath(ensembl_path, namespaces = self.namespaces)]
+
+                    protein_id.append(accession)
+                    protein_name.append(_extract(entry.xpath('./uniprot:name/text()', namespaces = self.namespaces)))
+                    gene.append(_extract(entry.xpath('./uniprot:gene/uniprot:name/text()', namespaces = self.namespaces)))
+                    ensembl_id.append(ensembl)
+                    protein_mw.append(float(_extract(entry.xpath('./uniprot:sequence/@mass', namespaces = self.namespaces))))
+
+                # Release the parsed entry and all preceding siblings
+                entry.clear()
+                while entry.getprevious() is not None:
+                    del entry.getparent()[0]
+
+        df = pd.DataFrame({
+            'protein_id': pd.Series(protein_id, dtype='object'),
+            'protein_name': pd.Series(protein_name, dtype='object'),
+            'gene': pd.Series(gene, dtype='object'),
+            'ensembl_id': pd.Series(ensembl_id, dtype='object'),
+            'protein_mw': np.array(protein_mw, dtype=np.float64)
+        })
 
         return df
 
@@ -87,78 +139,91 @@ class uniprot:
         return self.df[['protein_id','protein_name', 'gene', 'protein_mw']]
 
     def expand(self):
-        ensembl = self.df.apply(
-            lambda x: pd.Series(x['ensembl_id'], dtype='object'),
-            axis=1
-        ).stack().reset_index(level=1, drop=True)
-        ensembl.name = 'ensembl_id'
-
-        return self.df.drop('ensembl_id', axis=1).join(ensembl).reset_index(drop=True)[["protein_id", "protein_name", "gene", "ensembl_id", "protein_mw"]]
+        return self.df.explode('ensembl_id').reset_index(drop=True)[["protein_id", "protein_name", "gene", "ensembl_id", "protein_mw"]]
 
 class mitab:
-    def __init__(self, mitabfile):
+    def __init__(self, mitabfile, protein_ids=None, chunksize=1000000):
+        self.protein_ids = None if protein_ids is None else set(protein_ids)
+        self.chunksize = chunksize
         self.df = self.read(mitabfile)
 
     def read(self, mitabfile):
-        def _extract_uniprotkb(string):
-            return [i.split("uniprotkb:")[1].split("-")[0] for i in [u for u in string.split("|") if "uniprotkb" in u]]
-
-        def _extract_score(string):
-            if 'intact-miscore:' in string:
-                return float([u for u in string.split("|") if "intact-miscore" in u][0].split("intact-miscore:")[1])
-            elif 'score:' in string:
-                return float([u for u in string.split("|") if "score" in u][0].split("score:")[1])
-            else:
-                return 0
-
-        df = pd.read_csv(mitabfile, sep="\t", header = None, usecols=[0,1,2,3,14], engine='c')
-        df.columns = ["bait_id","prey_id","bait_id_alt","prey_id_alt","interaction_confidence"]
-
-        df['bait_id_alt'] = df['bait_id_alt'].replace(np.nan,'',regex=True)
-        df['prey_id_alt'] = df['prey_id_alt'].replace(np.nan,'',regex=True)
-
-        df['bait_id'] = df['bait_id'] + "|" + df['bait_id_alt']
-        df['prey_id'] = df['prey_id'] + "|" + df['prey_id_alt']
-        df = df.drop(columns=['bait_id_alt','prey_id_alt'])
-
-        # Reduce DB to UniProtKB entries with scores
-        df = df[df['bait_id'].str.contains('uniprotkb:') & df['prey_id'].str.contains('uniprotkb:') & (df['interaction_confidence'].str.contains('score:') | df['interaction_confidence'].str.contains('shortestPath:'))]
-
-        if df.shape[0] == 0:
+        def _extract_uniprotkb(ids):
+            # Long format of all UniProtKB identifiers (ignoring isoforms) per row
+            ids = ids.str.extractall(r'uniprotkb:([^|\-]*)')[0].reset_index(level=1, drop=True)
+            if self.protein_ids is not None:
+                ids = ids[ids.isin(self.protein_ids)]
+            return ids
+
+        def _extract_score(scores):
+            miscore = scores.str.extract(r'intact-miscore:([^|]*)', expand=False)
+            score = scores.str.extract(r'(?:^|\|)[^|]*?score:([^|]*)', expand=False)
+            return miscore.fillna(score).fillna(0).astype(float)
+
+        reader = pd.read_csv(mitabfile, sep="\t", header = None, usecols=[0,1,2,3,14], dtype=str, chunksize=self.chunksize, engine='c')
+
+        num_entries = 0
+        num_interactions = 0
+        chunks = []
+        score_min = np.inf
+        score_max = -np.inf
+        for chunk in reader:
+            chunk.columns = ["bait_id","prey_id","bait_id_alt","prey_id_alt","interaction_confidence"]
+
+            bait_ids = chunk['bait_id'].fillna('') + "|" + chunk['bait_id_alt'].fillna('')
+            prey_ids = chunk['prey_id'].fillna('') + "|" + chunk['prey_id_alt'].fillna('')
+            scores = chunk['interaction_confidence'].fillna('')
+
+            # Reduce DB to UniProtKB entries with scores
+            valid = bait_ids.str.contains('uniprotkb:', regex=False) & prey_ids.str.contains('uniprotkb:', regex=False) & (scores.str.contains('score:', regex=False) | scores.str.contains('shortestPath:', regex=False))
+            num_entries += valid.sum()
+            if not valid.any():
+                continue
+
+            # Extract score
+            scores = _extract_score(scores[valid])
+            score_min = min(score_min, scores.min())
+            score_max = max(score_max, scores.max())
+
+            # Extract UniProtKB ids of quantified proteins and combine all alternative identifiers
+            bait_ids = _extract_uniprotkb(bait_ids[valid])
+            prey_ids = _extract_uniprotkb(prey_ids[valid])
+
+            df = pd.merge(bait_ids.rename('bait_id'), prey_ids.rename('prey_id'), left_index=True, right_index=True)
+            df['interaction_confidence'] = scores.loc[df.index].values
+            num_interactions += df.shape[0]
+
+            chunks.append(df.groupby(["bait_id","prey_id"])["interaction_confidence"].max().reset_index())
+
+        if num_entries == 0:
             sys.exit("Error: the MITAB file doesn't contain any valid entries.")
         else:
-            click.echo("Info: MITAB file contains %s entries." % df.shape[0])
+            click.echo("Info: MITAB file contains %s entries." % num_entries)
 
-        # Extract UniProtKB ids
-        df.bait_id = df.bait_id.apply(_extract_uniprotkb)
-        df.prey_id = df.prey_id.apply(_extract_uniprotkb)
+        click.echo("Info: MITAB file contains %s relevant entries considering all alternative identifiers." % num_interactions)
 
-        # Explode lists
-        df = df.explode('bait_id').reset_index(drop=True)
-        df = df.explode('prey_id').reset_index(drop=True)
-
-        click.echo("Info: MITAB file contains %s entries considering all alternative identifiers." % df.shape[0])
-
-        # Extract score
-        df.interaction_confidence = df.interaction_confidence.apply(_extract_score)
-
-        df = df.groupby(["bait_id","prey_id"])["interaction_confidence"].max().reset_index()
-        click.echo("Info: MITAB file contains %s unique entries." % df.shape[0])
+        if len(chunks) > 0:
+            df = pd.concat(chunks).groupby(["bait_id","prey_id"])["interaction_confidence"].max().reset_index()
+        else:
+            df = pd.DataFrame({'bait_id': pd.Series(dtype='object'), 'prey_id': pd.Series(dtype='object'), 'interaction_confidence': pd.Series(dtype=np.float64)})
+        click.echo("Info: MITAB file contains %s unique relevant entries." % df.shape[0])
 
-        # Normalize score
-        if df.interaction_confidence.max() > 1 or df.interaction_confidence.min() < 0:
+        # Normalize score using the range observed over all entries
+        if score_max > 1 or score_min < 0:
             scaler = preprocessing.MinMaxScaler()
-            scores = np.array(np.transpose([df.interaction_confidence.values]))
-            scaler.fit(scores)
-            df.interaction_confidence = scaler.transform(scores)
+            scaler.fit(np.array([[score_min],[score_max]]))
+            df.interaction_confidence = scaler.transform(np.array(np.transpose([df.interaction_confidence.values])))
 
         return df
 
 class stringdb:
-    def __init__(self, stringdbfile, uniprot):
-        self.df = self.read(stringdbfile, uniprot)
+    def __init__(self, stringdbfile, uniprot=None):
+        self.df = self.read(stringdbfile)
+
+        if uniprot is not None:
+            self.df = map_ensembl_ids(self.df, uniprot)
 
-    def read(self, stringdbfile, uniprot):
+    def read(self, stringdbfile):
         df = pd.read_csv(stringdbfile, sep=" ", engine='c')
 
         df[['protein1o','protein1s']] = df.protein1.str.split('.', expand=True)
@@ -167,15 +232,18 @@ class stringdb:
         df = df[['protein1s','protein2s','combined_score']]
         df['combined_score'] = df['combined_score'] / 1000.0
 
-        #Map protein 1
-        df = pd.merge(df, uniprot.expand(), left_on='protein1s', right_on='ensembl_id')[['protein_id','protein2s','combined_score']]
-        df.columns = ["bait_id","protein2s","combined_score"]
-        #Map protein 2
-        df = pd.merge(df, uniprot.expand(), left_on='protein2s', right_on='ensembl_id')[['bait_id','protein_id','combined_score']]
-        df.columns = ["bait_id","prey_id","interaction_confidence"]
+        return df
 
+def map_ensembl_ids(df, uniprot):
+    ensembl = uniprot.expand()
+    #Map protein 1
+    df = pd.merge(df, ensembl, left_on='protein1s', right_on='ensembl_id')[['protein_id','protein2s','combined_score']]
+    df.columns = ["bait_id","protein2s","combined_score"]
+    #Map protein 2
+    df = pd.merge(df, ensembl, left_on='protein2s', right_on='ensembl_id')[['bait_id','protein_id','combined_score']]
+    df.columns = ["bait_id","prey_id","interaction_confidence"]
 
-        return df
+    return df
 
 class bioplex:
     def __init__(self, bioplexfile):
@@ -219,79 +287,114 @@ class binary:
 
         return df
 
+def identify_network(netfile):
+    if netfile == None:
+        return 'none'
+
+    header = pd.read_csv(netfile, sep=None, nrows=1, engine='python')
+
+    columns = list(header.columns.values)
+
+    # STRING-DB
+    if columns == ['protein1', 'protein2', 'combined_score']:
+        return 'stringdb'
+    # BioPlex
+    elif columns == ['GeneA','GeneB','UniprotA','UniprotB','SymbolA','SymbolB','p(Wrong)','p(No Interaction)','p(Interaction)']:
+        return 'bioplex'
+    # PrePPI
+    elif columns == ['prot1','prot2','str_score','protpep_score','str_max_score','red_score','ort_score','phy_score','coexp_score','go_score','total_score','dbs','pubs','exp_score','final_score']:
+        return 'preppi'
+    # MITAB 2.5, 2.6, 2.7
+    elif len(header.columns) in [11, 15, 35, 36, 42]:
+        return 'mitab'
+    # Binary
+    elif len(header.columns) == 2:
+        return 'binary'
+    else:
+        sys.exit("Error: Reference network file format is not supported.")
+
+def read_network(netfile, protein_ids):
+    # Parse network file independently of UniProt and meta data; STRING-DB identifiers are mapped by net
+    format = identify_network(netfile)
+
+    if format == 'mitab':
+        return mitab(netfile, protein_ids).df
+    elif format == 'stringdb':
+        return stringdb(netfile).df
+    elif format == 'bioplex':
+        return bioplex(netfile).df
+    elif format == 'preppi':
+        return preppi(netfile).df
+    elif format == 'binary':
+        return binary(netfile).df
+    elif format == 'none':
+        return None
+
 class net:
-    def __init__(self, netfile, uniprot, meta):
-        self.formats = ['mitab','stringdb','bioplex','preppi', 'binary','none']
-        self.format = self.identify(netfile)
-
-        if self.format == 'mitab':
-            network = mitab(netfile).df
-        elif self.format == 'stringdb':
-            network = stringdb(netfile, uniprot).df
-        elif self.format == 'bioplex':
-            network = bioplex(netfile).df
-        elif self.format == 'preppi':
-            network = preppi(netfile).df
-        elif self.format == 'binary':
-            network = binary(netfile).df
+    def __init__(self, netfile, uniprot, meta, network=None, mapped=False):
+        self.format = identify_network(netfile)
+
+        # Parse network file unless it was read in advance
+        if network is None:
+            network = read_network(netfile, meta.protein_meta['protein_id'].unique())
+
+        # Networks compiled into a reference bundle are already mapped to UniProt
+        if self.format == 'stringdb' and not mapped:
+            network = map_ensembl_ids(network, uniprot)
         elif self.format == 'none':
-            protein_ids = sorted(list(meta.protein_meta['protein_id'].unique()))
-            full_queries = list(itertools.combinations(protein_ids, 2))
-            click.echo("Info: Assessing all %s potential interactions of the %s proteins." % (len(full_queries), len(protein_ids)))
-            network = pd.DataFrame(full_queries, columns=['bait_id', 'prey_id'])
-            network['interaction_confidence'] = 1
+            network = self.overlapping_interactions(meta.protein_meta)
+            click.echo("Info: Assessing %s potential interactions of the %s proteins with overlapping elution ranges." % (network.shape[0], meta.protein_meta.shape[0]))
 
         # Ensure that interactions are unique
-        df = self.unique_interactions(network)
+        if self.format == 'none':
+            df = network
+        else:
+            df = self.unique_interactions(network)
 
         # Remove interactions between same baits and preys
         df = df[df['bait_id'] != df['prey_id']]
 
         self.df = df
 
-    def identify(self, netfile):
-        if netfile == None:
-            return self.formats[5]
+    def overlapping_interactions(self, protein_meta):
+        # Proteins without identifier or eluting in less than three fractions can't be scored
+        protein_meta = protein_meta.loc[protein_meta['protein_id'].notna() & ((protein_meta['max_sec'] - protein_meta['min_sec']) >= 2)]
 
-        header = pd.read_csv(netfile, sep=None, nrows=1, engine='python')
+        # Protein codes follow lexicographic order to orient pairs
+        protein_ids = np.sort(protein_meta['protein_id'].astype(str).values)
+        codes = np.searchsorted(protein_ids, protein_meta['protein_id'].astype(str).values)
 
-        columns = list(header.columns.values)
+        # Interval index sorted by the start of the elution ranges
+        order = np.argsort(protein_meta['min_sec'].values, kind='stable')
+        codes = codes[order]
+        min_sec = protein_meta['min_sec'].values[order]
+        max_sec = protein_meta['max_sec'].values[order]
 
-        # STRING-DB
-        if columns == ['protein1', 'protein2', 'combined_score']:
-            return self.formats[1]
-        # BioPlex
-        elif columns == ['GeneA','GeneB','UniprotA','UniprotB','SymbolA','SymbolB','p(Wrong)','p(No Interaction)','p(Interaction)']:
-            return self.formats[2]
-        # PrePPI
-        elif columns == ['prot1','prot2','str_score','protpep_score','str_max_score','red_score','ort_score','phy_score','coexp_score','go_score','total_score','dbs','pubs','exp_score','final_score']:
-            return self.formats[3]
-        # MITAB 2.5, 2.6, 2.7
-        elif len(header.columns) in [11, 15, 35, 36, 42]:
-            return self.formats[0]
-        # Binary
-        elif len(header.columns) == 2:
-            return self.formats[4]
-        else:
-            sys.exit("Error: Reference network file format is not supported.")
+        # Proteins starting at most two fractions before the end of an elution range overlap with it by at least three fractions
+        end = np.searchsorted(min_sec, max_sec - 2, side='right')
+        counts = np.maximum(end - np.arange(1, len(codes) + 1), 0)
+
+        # Pairs of each protein with all later starting proteins within its overlap window
+        left = np.repeat(np.arange(len(codes)), counts)
+        right = np.arange(left.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts) + left + 1
+
+        return pd.DataFrame({'bait_id': protein_ids[np.minimum(codes[left], codes[right])], 'prey_id': protein_ids[np.maximum(codes[left], codes[right])], 'interaction_confidence': 1})
 
-    def get_interaction_id(self, x):
-        return '__'.join(sorted([x[0], x[1]]))
-    
     def unique_interactions(self, network):
-        # Subset network to bait_id and prey_id columns
-        bait_prey = network[["bait_id", "prey_id"]]
-        
-        # Turn subset into list of lists where each sublist is of length 2 (one bait_id one prey_id) 
-        bait_prey = bait_prey.values.tolist()
-        
-        # Use multiprocessing.Pool to distribute get_interaction_id() across list of lists
-        with multiprocessing.Pool(os.cpu_count()) as p:
-            network['interaction_id'] = p.map(self.get_interaction_id, bait_prey)
-        
-        network = network.groupby('interaction_id')['interaction_confidence'].max().reset_index()
-        network[['bait_id','prey_id']] = network.interaction_id.str.split('__', expand=True)
-        return network[['bait_id','prey_id','interaction_confidence']]
+        # Interactions with missing identifiers (e.g. unmapped STRING-DB proteins) are removed, as factorize codes them as -1
+        network = network.dropna(subset=['bait_id', 'prey_id'])
+
+        # Factorize protein identifiers to integer codes in lexicographic order
+        codes, protein_ids = pd.factorize(np.concatenate([network['bait_id'].values, network['prey_id'].values]), sort=True)
+        bait_codes = codes[:network.shape[0]].astype(np.int64)
+        prey_codes = codes[network.shape[0]:].astype(np.int64)
+
+        # Canonicalize undirected interactions by ordering the codes of each pair
+        interaction_id = np.minimum(bait_codes, prey_codes) * len(protein_ids) + np.maximum(bait_codes, prey_codes)
+
+        confidence = pd.Series(network['interaction_confidence'].values).groupby(interaction_id).max()
+
+        return pd.DataFrame({'bait_id': protein_ids[confidence.index.values // len(protein_ids)], 'prey_id': protein_ids[confidence.index.values % len(protein_ids)], 'interaction_confidence': confidence.values})
 
     def to_df(self):
         return self.df
@@ -344,12 +447,15 @@ class sec:
         return self.df
 
 class quantification:
-    def __init__(self, infile, columns, run_ids):
+    def __init__(self, infile, columns, run_ids, threads=1, chunksize=1000000):
         self.run_id_col = columns[5]
         self.protein_id_col = columns[6]
         self.peptide_id_col = columns[7]
         self.intensity_id_col = columns[8]
         self.formats = ['matrix','long']
+        self.threads = threads
+        self.chunksize = chunksize
+        self.sep = self.sniff(infile)
         self.format, self.header = self.identify(infile)
         self.run_ids = run_ids
 
@@ -358,123 +464,387 @@ class quantification:
         elif self.format == 'long':
             self.df = self.read_long(infile)
 
+    def sniff(self, infile):
+        # Infer the delimiter once from the first lines of the file
+        with (gzip.open(infile, 'rt') if infile.endswith(".gz") else open(infile, 'r')) as f:
+            sample = "".join(itertools.islice(f, 5))
+
+        try:
+            return csv.Sniffer().sniff(sample, delimiters="\t,; ").delimiter
+        except csv.Error:
+            return "\t"
+
     def identify(self, infile):
-        header = pd.read_csv(infile, sep=None, nrows=1, engine='python')
+        header = pd.read_csv(infile, sep=self.sep, nrows=1, engine='c')
 
         columns = list(header.columns.values)
 
         # Matrix
         if self.run_id_col not in columns and self.protein_id_col in columns and self.peptide_id_col in columns:
-            return self.formats[0], columns
+            format = self.formats[0]
         # Long list
         elif self.run_id_col in columns and self.protein_id_col in columns and self.peptide_id_col and self.intensity_id_col in columns:
-            return self.formats[1], columns
+            format = self.formats[1]
         else:
             sys.exit("Error: Peptide quantification file format is not supported. Try changing the 'columns' parameter.")
 
-    def read_matrix(self, infile):
-        # Identify run_ids in header
-        run_id_columns = set(self.run_ids).intersection(self.header)
-
-        # Read data
-        mx = pd.read_csv(infile, sep=None, engine='python')
+        # The first protein identifier defines how proteotypic peptides are annotated
+        self.protein_id_prefixed = "/" in str(header[self.protein_id_col].iloc[0])
+
+        return format, columns
+
+    def read_chunks(self, infile, usecols, dtype, process):
+        reader = pd.read_csv(infile, sep=self.sep, usecols=usecols, dtype=dtype, chunksize=self.chunksize, engine='c')
+
+        # Parse chunks sequentially and process them in parallel, keeping only a bounded number of raw chunks in memory
+        chunks = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for chunk in reader:
+                pending.append(executor.submit(process, chunk))
+                while len(pending) > self.threads:
+                    chunks.append(pending.popleft().result())
+            while len(pending) > 0:
+                chunks.append(pending.popleft().result())
+
+        if len(chunks) == 0:
+            sys.exit("Error: Peptide quantification file %s does not contain any data." % infile)
+
+        # Merge chunks with shared categories
+        df = pd.DataFrame({
+            'run_id': union_categoricals([c['run_id'].values for c in chunks], sort_categories=True).remove_unused_categories(),
+            'protein_id': union_categoricals([c['protein_id'].values for c in chunks], sort_categories=True).remove_unused_categories(),
+            'peptide_id': union_categoricals([c['peptide_id'].values for c in chunks], sort_categories=True).remove_unused_categories(),
+            'peptide_intensity': np.concatenate([c['peptide_intensity'].values for c in chunks])
+        })
+
+        return df.sort_values(by=['protein_id','peptide_id','run_id']).reset_index(drop=True)
+
+    def match_run_ids(self, values):
+        # Link run identifiers to the SEC definition, also accepting numeric and path representations
+        run_ids = set(self.run_ids)
+
+        matched = []
+        for value in values:
+            candidates = [value, os.path.basename(value)]
+            try:
+                number = float(value)
+                candidates.append(str(int(number)) if number.is_integer() else str(number))
+            except ValueError:
+                pass
+            matched.append(next((c for c in candidates if c in run_ids), np.nan))
+
+        return matched
+
+    def parse_protein_ids(self, values, parse_uniprot):
+        protein_ids = pd.Series(values, dtype='object')
 
-        df = pd.melt(mx, id_vars=[self.protein_id_col, self.peptide_id_col], value_vars=run_id_columns, var_name=self.run_id_col, value_name=self.intensity_id_col)
-
-        # Organize and rename columns
-        df = df[[self.run_id_col, self.protein_id_col, self.peptide_id_col, self.intensity_id_col]]
-        df.columns = ['run_id', 'protein_id', 'peptide_id', 'peptide_intensity']
+        # Proteotypic peptides only
+        if self.protein_id_prefixed:
+            protein_ids = protein_ids.where(protein_ids.str.startswith("1/")).str[2:]
+        else:
+            protein_ids = protein_ids.where(protein_ids.str.find(';')==-1)
 
-        # run_id, condition_id and replicate_id are categorial values, peptide_intensity must be float
-        if sum([1 for id in df['run_id'] if not isinstance(id, str)]) > 0:
-            df['run_id'] = df['run_id'].apply(lambda x: os.path.basename(str(x)))
-        df['protein_id'] = df['protein_id'].apply(str)
-        df['peptide_id'] = df['peptide_id'].apply(str)
-        df['peptide_intensity'] = df['peptide_intensity'].apply(float)
+        # Parse protein identifiers if necessary
+        if parse_uniprot:
+            protein_ids = protein_ids.where(~protein_ids.str.contains('sp|', regex=False, na=False), protein_ids.str.split('|').str[1])
 
-        df = df.sort_values(by=['protein_id','peptide_id','run_id'])
+        return protein_ids.values
 
-        # Proteotypic peptides only
-        if "/" in df['protein_id'][0]:
-            df = df.loc[df['protein_id'].str.startswith("1/")]
-            df.protein_id = df.protein_id.str[2:]
-        else:
-            df = df.loc[df['protein_id'].str.find(';')==-1]
+    def read_matrix(self, infile):
+        # Identify run_ids in header
+        run_id_columns = sorted(set(self.run_ids).intersection(self.header))
 
         # Simple validation
         if len(run_id_columns) < 10:
             sys.exit("Error: Peptide quantification file could not be linked to SEC definition file. Try changing the 'columns' parameter.")
 
-        # Remove zero values to save space
-        df = df[df['peptide_intensity'] > 0]
+        def process(chunk):
+            intensities = chunk[run_id_columns].to_numpy(dtype=np.float64)
 
-        return df
+            # Remove zero values to save space
+            rows, runs = np.nonzero(intensities > 0)
 
-    def read_long(self, infile):
-        def parse_protein_id(x):
-            if 'sp|' in x:
-                return x.split('|')[1]
-            else:
-                return x
+            df = pd.DataFrame({
+                'run_id': pd.Categorical.from_codes(runs, categories=run_id_columns),
+                'protein_id': _recode(chunk[self.protein_id_col].values, self.parse_protein_ids(chunk[self.protein_id_col].cat.categories, False))[rows],
+                'peptide_id': chunk[self.peptide_id_col].values[rows],
+                'peptide_intensity': intensities[rows, runs]
+            })
 
-        # Read data
-        df = pd.read_csv(infile, sep="\t", engine='c')
+            return df[df['protein_id'].notna()]
 
-        # Exclude decoys if present
-        if 'decoy' in df.columns:
-            df = df.loc[df['decoy'] == 0]
+        dtype = {self.protein_id_col: 'category', self.peptide_id_col: 'category'}
+        dtype.update({run_id: np.float64 for run_id in run_id_columns})
 
-        # Organize and rename columns
-        df = df[[self.run_id_col, self.protein_id_col, self.peptide_id_col, self.intensity_id_col]]
-        df.columns = ['run_id', 'protein_id', 'peptide_id', 'peptide_intensity']
+        return self.read_chunks(infile, [self.protein_id_col, self.peptide_id_col] + run_id_columns, dtype, process)
 
-        # run_id, condition_id and replicate_id are categorial values, peptide_intensity must be float
-        if sum([1 for id in df['run_id'] if not isinstance(id, str)]) > 0:
-            df['run_id'] = df['run_id'].apply(lambda x: os.path.basename(str(x)))
-        df['protein_id'] = df['protein_id'].apply(str)
-        df['peptide_id'] = df['peptide_id'].apply(str)
-        df['peptide_intensity'] = df['peptide_intensity'].apply(float)
+    def read_long(self, infile):
+        def process(chunk):
+            # Exclude decoys if present
+            if 'decoy' in chunk.columns:
+                chunk = chunk.loc[chunk['decoy'] == 0]
+
+            df = pd.DataFrame({
+                'run_id': _recode(chunk[self.run_id_col].values, self.match_run_ids(chunk[self.run_id_col].cat.categories)),
+                'protein_id': _recode(chunk[self.protein_id_col].values, self.parse_protein_ids(chunk[self.protein_id_col].cat.categories, True)),
+                'peptide_id': chunk[self.peptide_id_col].values,
+                'peptide_intensity': chunk[self.intensity_id_col].values
+            })
 
-        df = df.sort_values(by=['protein_id','peptide_id','run_id'])
+            # Remove runs not covered by SEC definition, non-proteotypic peptides and zero values to save space
+            return df[df['run_id'].notna() & df['protein_id'].notna() & (df['peptide_intensity'] > 0)]
 
-        # Proteotypic peptides only
-        if "/" in df['protein_id'][0]:
-            df = df.loc[df['protein_id'].str.startswith("1/")]
-            df.protein_id = df.protein_id.str[2:]
-        else:
-            df = df.loc[df['protein_id'].str.find(';')==-1]
+        usecols = [self.run_id_col, self.protein_id_col, self.peptide_id_col, self.intensity_id_col]
+        if 'decoy' in self.header:
+            usecols.append('decoy')
 
-        # Parse protein identifiers if necessary
-        df['protein_id'] = df['protein_id'].apply(parse_protein_id)
+        df = self.read_chunks(infile, usecols, {self.run_id_col: 'category', self.protein_id_col: 'category', self.peptide_id_col: 'category', self.intensity_id_col: np.float64}, process)
 
         # Simple validation
-        run_id_columns = set(self.run_ids).intersection(set(df['run_id'].unique()))
-
-        if len(run_id_columns) < 10:
+        if len(df['run_id'].cat.categories) < 10:
             sys.exit("Error: Peptide quantification file could not be linked to SEC definition file. Try changing the 'columns' parameter.")
 
-        # Remove zero values to save space
-        df = df[df['peptide_intensity'] > 0]
-
         return df
 
     def to_df(self):
         return self.df
 
+def _recode(values, mapped):
+    # Relabel categorical values by mapping their categories once instead of every element; missing labels are set to NaN
+    codes, categories = pd.factorize(pd.Series(mapped, dtype='object'))
+    return pd.Categorical.from_codes(np.where(values.codes >= 0, codes[values.codes], -1), categories=categories)
+
+def concat_quantification(quantification_list):
+    # Concatenate quantification tables of several files while keeping the categorical representation
+    return pd.DataFrame({
+        'run_id': union_categoricals([df['run_id'].values for df in quantification_list], sort_categories=True),
+        'protein_id': union_categoricals([df['protein_id'].values for df in quantification_list], sort_categories=True),
+        'peptide_id': union_categoricals([df['peptide_id'].values for df in quantification_list], sort_categories=True),
+        'peptide_intensity': np.concatenate([df['peptide_intensity'].values for df in quantification_list])
+    })
+
+def _lowess_fit(x, y, resid_weights, xval, radius, y_default):
+    # Weighted local linear regression of a single neighborhood
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = (1.0 - (np.abs(x - xval) / radius) ** 3) ** 3 * resid_weights
+
+    # Regressions with less than two points of positive weight return the original value
+    if np.sum(weights > 1e-12) < 2:
+        return y_default
+
+    weights = weights / np.sum(weights)
+    mean_x = np.sum(weights * x)
+    sqdev_x = max(np.sum(weights * (x - mean_x) ** 2), 1e-12)
+    return np.sum(weights * (1.0 + (xval - mean_x) * (x - mean_x) / sqdev_x) * y)
+
+def lowess_sorted(y, x, frac=0.7, it=3, delta=0.0):
+    # LOWESS following the statsmodels algorithm for x sorted in ascending order
+    n = len(x)
+
+    # Robustness weights of very small data sets are dominated by rounding; keep the reference implementation
+    if n < 100:
+        return sm.nonparametric.lowess(endog=y, exog=x, frac=frac, it=it, delta=delta, is_sorted=True, return_sorted=False)
+
+    k = min(max(int(frac * n + 1e-10), 2), n)
+
+    # Regressions are only fitted at anchors; the skipping rule depends on x and delta alone
+    tie_end = np.searchsorted(x, x, side='right') - 1
+    cut_end = np.searchsorted(x, x + delta, side='right')
+    anchors = []
+    i = 0
+    while True:
+        anchors.append(i)
+        last_fit_i = tie_end[i]
+        if last_fit_i >= n - 1:
+            break
+        i = max(min(cut_end[i], n - 1) - 1, last_fit_i + 1)
+    anchors = np.array(anchors)
+    xval = x[anchors]
+
+    # Neighborhoods of k points closest to the anchors and their radius
+    left_end = np.minimum(np.searchsorted(x[:n - k] + x[k:], 2 * xval, side='left'), n - k)
+    right_end = left_end + k
+    radius = np.maximum(xval - x[left_end], x[right_end - 1] - xval)
+    split = np.clip(np.searchsorted(x, xval, side='right'), left_end, right_end)
+    inner_left = np.maximum(np.searchsorted(x, xval - 0.99 * radius, side='right'), left_end)
+    inner_right = np.minimum(np.searchsorted(x, xval + 0.99 * radius, side='left'), right_end)
+
+    # Rescale x to [-1, 1] so that the polynomial expansion of the weights remains well-conditioned
+    center = (x[0] + x[-1]) / 2.0
+    scale = max((x[-1] - x[0]) / 2.0, np.finfo(np.float64).tiny)
+    u = (x - center) / scale
+    uval = (xval - center) / scale
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho_inv = np.where(radius > 0, scale / radius, 0.0)
+
+    # Coefficients of the tricube weights (1 - |u - uval|^3 / rho^3)^3 as polynomial in u, left and right of the anchor
+    coef_left = np.zeros((10, len(anchors)))
+    coef_right = np.zeros((10, len(anchors)))
+    for m in range(0, 4):
+        for q in range(0, 3 * m + 1):
+            term = comb(3, m) * comb(3 * m, q) * (-1) ** q * uval ** (3 * m - q) * rho_inv ** (3 * m)
+            coef_left[q] += (-1) ** m * term
+            coef_right[q] += term
+    coef_norm = np.maximum(np.sum(np.abs(coef_left), axis=0), np.sum(np.abs(coef_right), axis=0))
+
+    powers = np.ones((12, n))
+    for p in range(1, 12):
+        powers[p] = powers[p - 1] * u
+
+    wp = np.zeros((12, n + 1))
+    wyp = np.zeros((11, n + 1))
+    resid_weights = np.ones(n)
+    for iteration in range(0, it + 1):
+        # Prefix sums of weighted powers of u, with and without y
+        np.cumsum(powers * resid_weights, axis=1, out=wp[:, 1:])
+        np.cumsum(powers[:11] * (resid_weights * y), axis=1, out=wyp[:, 1:])
+        nonzero = np.concatenate([[0], np.cumsum(resid_weights > 1e-6)])
+
+        def _weighted_sums(prefix, p):
+            return np.sum(coef_left * (prefix[p:p + 10, split] - prefix[p:p + 10, left_end]) + coef_right * (prefix[p:p + 10, right_end] - prefix[p:p + 10, split]), axis=0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_weights = _weighted_sums(wp, 0)
+            mean_u = _weighted_sums(wp, 1) / sum_weights
+            sqdev_u = np.maximum(_weighted_sums(wp, 2) / sum_weights - mean_u ** 2, 1e-12 / scale ** 2)
+            mean_y = _weighted_sums(wyp, 0) / sum_weights
+            cov_uy = _weighted_sums(wyp, 1) / sum_weights - mean_u * mean_y
+            y_anchor = mean_y + (uval - mean_u) * cov_uy / sqdev_u
+
+        # Neighborhoods with few points of relevant weight, or narrow relative to the range of x (e.g. heavy tails or outliers),
+        # are fitted directly, as the cancellation in the expansion dominates the weighted sums for them
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            rounding = np.finfo(np.float64).eps * n * coef_norm / sum_weights * (1.0 + 1.0 / sqdev_u)
+        precise = (nonzero[inner_right] - nonzero[inner_left] >= 2) & (sum_weights >= 1e-3 * k) & (rounding < LOWESS_TOLERANCE)
+        for j in np.nonzero(~precise)[0]:
+            y_anchor[j] = _lowess_fit(x[left_end[j]:right_end[j]], y[left_end[j]:right_end[j]], resid_weights[left_end[j]:right_end[j]], xval[j], radius[j], y[anchors[j]])
+
+        # Interpolate between anchors
+        y_fit = np.interp(x, xval, y_anchor)
+
+        # Robustness weights
+        resid = np.abs(y - y_fit)
+        median = np.median(resid)
+        if median == 0:
+            resid = (resid > 0).astype(np.float64)
+        else:
+            resid = np.minimum(resid / (6.0 * median), 1.0)
+        resid_weights = (1.0 - resid ** 2) ** 2
+
+    return y_fit
+
+def normalize_cyclic_loess(x, span=0.7, iterations = 3):
+    for k in range(0,iterations):
+        a = np.nanmean(x, axis=1)
+
+        # Sort average intensities once per iteration and fit all runs against them
+        order = np.argsort(a, kind='stable')
+        a_sorted = a[order]
+        m = x[order] - a_sorted[:, np.newaxis]
+
+        lw = np.full(x.shape, np.nan)
+        for i in range(0,x.shape[1]):
+            valid = np.isfinite(m[:,i]) & np.isfinite(a_sorted)
+            if np.sum(valid) == 0:
+                continue
+
+            # Fit lowess model
+            lwd = 0.01 * (np.max(m[valid,i]) - np.min(m[valid,i]))
+            lw[order[valid],i] = lowess_sorted(m[valid,i], a_sorted[valid], frac=span, it=3, delta=lwd)
+
+        x = x - lw
+    return x
+
+def normalize_median(x):
+    # Center runs on the average median intensity
+    medians = np.nanmedian(x, axis=0)
+    return x - medians + np.mean(medians)
+
+def normalize_quantile(x):
+    # Map values of each run to the average quantile function of all runs at the same relative rank
+    counts = np.sum(~np.isnan(x), axis=0)
+    sorted_x = np.sort(x, axis=0)
+    grid = np.linspace(0, 1, max(np.max(counts), 2))
+
+    def _quantiles(p):
+        # Linear interpolation of the quantile functions of all runs at relative ranks p
+        position = p * (counts - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts - 1)
+        columns = np.arange(x.shape[1])
+        return sorted_x[lower, columns] + (position - lower) * (sorted_x[upper, columns] - sorted_x[lower, columns])
+
+    reference = np.mean(_quantiles(grid[:, np.newaxis]), axis=1)
+
+    ranks = np.argsort(np.argsort(x, axis=0, kind='stable'), axis=0, kind='stable')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(counts > 1, ranks / (counts - 1), 0.5)
+    return np.where(np.isnan(x), np.nan, np.interp(p, grid, reference))
+
+def normalize_reference(x):
+    # Regress the run with most quantified peptides on all other runs using their shared peptides
+    reference = x[:, np.argmax(np.sum(~np.isnan(x), axis=0))][:, np.newaxis]
+    shared = ~np.isnan(x) & ~np.isnan(reference)
+    n = np.sum(shared, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = np.sum(np.where(shared, x, 0), axis=0) / n
+        mean_ref = np.sum(np.where(shared, reference, 0), axis=0) / n
+        sqdev_x = np.sum(np.where(shared, (x - mean_x) ** 2, 0), axis=0)
+        codev = np.sum(np.where(shared, (x - mean_x) * (reference - mean_ref), 0), axis=0)
+        slope = np.where((n > 2) & (sqdev_x > 0), codev / sqdev_x, 1.0)
+
+    # Runs without shared peptides are left unchanged
+    intercept = np.where(n > 0, mean_ref - slope * mean_x, 0.0)
+    return intercept + slope * x
+
+def _attach_normalization_buffers(buffers):
+    # Attach worker processes to the shared quantification, sum and count matrices
+    global _normalization_buffers
+    _normalization_buffers = []
+    for name, shape, dtype in buffers:
+        shm = shared_memory.SharedMemory(name=name)
+        _normalization_buffers.append((shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)))
+
+def _normalize_window(window):
+    (_, data), (_, sums), (_, counts) = _normalization_buffers
+    start, stop, method = window
+
+    # Restrict window to peptides quantified in any of its runs
+    rows = np.nonzero(~np.all(np.isnan(data[:, start:stop]), axis=1))[0]
+    if method == 'cyclicloess':
+        x = normalize_cyclic_loess(data[rows, start:stop])
+    elif method == 'median':
+        x = normalize_median(data[rows, start:stop])
+    elif method == 'quantile':
+        x = normalize_quantile(data[rows, start:stop])
+    elif method == 'reference':
+        x = normalize_reference(data[rows, start:stop])
+
+    # Accumulate results in place; concurrent windows never share runs
+    valid = ~np.isnan(x)
+    sums[rows, start:stop] += np.where(valid, x, 0)
+    counts[rows, start:stop] += valid
 
 class normalization:
-    def __init__(self, quantification_data, sec_data, window_size, padded, outfile):
+    def __init__(self, quantification_data, sec_data, window_size, padded, outfile, threads=1, method='cyclicloess'):
         self.quantification_data = quantification_data
         self.sec_data = sec_data
         self.window_size = window_size
+        self.threads = threads
+        self.method = method
+
+        start = time.time()
         self.df = self.slide_normalize(padded)
+        click.echo("Info: Normalized quantitative data by %s normalization in %.2f seconds." % (self.method, time.time() - start))
 
         # plot input data
-        self.plot(self.quantification_data, self.sec_data, os.path.splitext(os.path.basename(outfile))[0]+"_raw.pdf")
+        self.plot(self.quantification_data, self.sec_data, os.path.splitext(os.path.basename(outfile))[0]+"_raw.pdf", "raw")
         # plot normalized data
-        self.plot(self.df, self.sec_data, os.path.splitext(os.path.basename(outfile))[0]+"_norm.pdf")
+        self.plot(self.df, self.sec_data, os.path.splitext(os.path.basename(outfile))[0]+"_norm.pdf", "%s normalization" % self.method)
         # plot number of pep identifications
-        self.plot_count(self.df, self.sec_data, os.path.splitext(os.path.basename(outfile))[0]+"_count.pdf")
+        self.plot_count(self.df, self.sec_data, os.path.splitext(os.path.basename(outfile))[0]+"_count.pdf", "%s normalization" % self.method)
 
     def slide_normalize(self, padded):
         def window(seq, n=2):
@@ -488,9 +858,20 @@ class normalization:
                 result = result[1:] + (elem,)
                 yield result
 
-        quantification_data = self.quantification_data.copy()
-        quantification_data['peptide_intensity'] = np.log2(quantification_data['peptide_intensity'])
-        quantification_list = []
+        quantification_data = self.quantification_data
+
+        # Peptides in lexicographic order define the rows of the matrix
+        rows = quantification_data.groupby(['protein_id','peptide_id'], observed=True, sort=True).ngroup().values
+        peptides = np.zeros(rows.max() + 1, dtype=np.int64)
+        peptides[rows] = np.arange(len(rows))
+
+        # Runs ordered by SEC fraction define the columns, so that each window is a contiguous slice
+        run_ids = pd.Series(quantification_data['run_id'].astype(str).unique())
+        sec_ids = run_ids.map(self.sec_data.drop_duplicates('run_id').set_index('run_id')['sec_id']).values
+        order = np.lexsort((run_ids.values, sec_ids))
+        run_ids = run_ids.values[order]
+        sec_ids = sec_ids[order]
+        columns = pd.Series(np.arange(len(run_ids)), index=run_ids)[quantification_data['run_id'].astype(str).values].values
 
         if padded:
             # Add padding to lower and upper boundaries to ensure that each fractions is covered by equal number of windows
@@ -499,53 +880,54 @@ class normalization:
         else:
             min_sec_id = min(self.sec_data['sec_id'])
             max_sec_id = max(self.sec_data['sec_id'])+1
-        
-        windows = [w for w in window(range(min_sec_id, max_sec_id),  n=self.window_size)]
-        mx_to_normalize = []
-        for w in windows:
-            runs = self.sec_data.loc[self.sec_data['sec_id'].isin(w)]['run_id']
-            mx = quantification_data.loc[quantification_data['run_id'].isin(runs)]
-            mx_to_normalize.append(mx)
-        
-        # With multiprocessing
-        with multiprocessing.Pool(os.cpu_count()) as p:
-            quantification_list = p.map(self.normalize, mx_to_normalize)
-        
-        quantification_norm = pd.concat(quantification_list)
-        quantification_norm = quantification_norm.groupby(['run_id','protein_id','peptide_id'])['peptide_intensity'].mean().reset_index()
 
-        quantification_norm['peptide_intensity'] = np.exp2(quantification_norm['peptide_intensity'])
-        
+        windows = [(np.searchsorted(sec_ids, w[0], side='left'), np.searchsorted(sec_ids, w[-1], side='right')) for w in window(range(min_sec_id, max_sec_id),  n=self.window_size)]
+
+        # Allocate log-transformed peptide x run matrix and accumulators in shared memory
+        shape = (len(peptides), len(run_ids))
+        buffers = []
+        for dtype in [np.float64, np.float64, np.uint16]:
+            buffers.append(shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)))
+
+        try:
+            data = np.ndarray(shape, dtype=np.float64, buffer=buffers[0].buf)
+            data[:] = np.nan
+            data[rows, columns] = np.log2(quantification_data['peptide_intensity'].values)
+            np.ndarray(shape, dtype=np.float64, buffer=buffers[1].buf)[:] = 0
+            np.ndarray(shape, dtype=np.uint16, buffer=buffers[2].buf)[:] = 0
+
+            # Windows that are window_size apart cover disjoint runs and can be normalized concurrently
+            with multiprocessing.Pool(self.threads, initializer=_attach_normalization_buffers, initargs=([(b.name, shape, dtype) for b, dtype in zip(buffers, [np.float64, np.float64, np.uint16])],)) as p:
+                for offset in range(0, self.window_size):
+                    p.map(_normalize_window, [(w[0], w[1], self.method) for w in windows[offset::self.window_size] if w[1] > w[0]])
+
+            sums = np.ndarray(shape, dtype=np.float64, buffer=buffers[1].buf)
+            counts = np.ndarray(shape, dtype=np.uint16, buffer=buffers[2].buf)
+
+            # Average over windows in long format sorted by run, protein and peptide
+            run_order = np.argsort(run_ids, kind='stable')
+            run_idx, peptide_idx = np.nonzero(counts.T[run_order] > 0)
+            run_idx = run_order[run_idx]
+
+            quantification_norm = pd.DataFrame({
+                'run_id': pd.Categorical(run_ids[run_idx], categories=np.sort(run_ids)),
+                'protein_id': quantification_data['protein_id'].values[peptides[peptide_idx]],
+                'peptide_id': quantification_data['peptide_id'].values[peptides[peptide_idx]],
+                'peptide_intensity': np.exp2(sums[peptide_idx, run_idx] / counts[peptide_idx, run_idx])
+            })
+        finally:
+            data = sums = counts = None
+            for b in buffers:
+                b.close()
+                b.unlink()
+
         return(quantification_norm)
  
-    def normalize(self, quantification_data):
-        def normalizeCyclicLoess(x, span=0.7, iterations = 3):
-            n = len(x.columns)
-            for k in range(0,iterations):
-                a = x.mean(axis=1, skipna=True)
-                for i in range(0,n):
-                    m = x.iloc[:,i] - a
-
-                    # Fit lowess model
-                    lwd = 0.01 * np.diff([np.nanmin(m),np.nanmax(m)])
-                    lw = sm.nonparametric.lowess(endog=m.values, exog=a.values, frac=span, it=3, delta=lwd, return_sorted=False)
-                    x.iloc[:,i] = x.iloc[:,i].values - lw
-            return x
-
-        mx = pd.pivot_table(quantification_data, values='peptide_intensity', index=['protein_id','peptide_id'], columns='run_id').reset_index()
-        mx_idx = mx[['protein_id','peptide_id']]
-        mx = mx.drop(['protein_id','peptide_id'], axis=1)
-
-        mx_norm = normalizeCyclicLoess(mx)
-        mx_new = pd.merge(mx_idx, mx_norm, left_index=True, right_index=True)
-        quantification_data_new = mx_new.melt(id_vars=['protein_id','peptide_id'], var_name='run_id', value_name='peptide_intensity')
-        return quantification_data_new.dropna()[quantification_data.columns]
-
-    def plot(self, quantification_data, sec_data, filename):
+    def plot(self, quantification_data, sec_data, filename, title):
         if plt is None:
             raise ImportError("Error: The matplotlib package is required to create a report.")
 
-        quantification_sum = quantification_data.groupby(['run_id'])['peptide_intensity'].sum().reset_index()
+        quantification_sum = quantification_data.groupby(['run_id'], observed=True)['peptide_intensity'].sum().reset_index()
 
         dfsum = pd.merge(quantification_sum, sec_data, on='run_id')
         dfsum['sample_id'] = dfsum['condition_id'].astype(str) + '_' + dfsum['replicate_id'].astype(str)
@@ -559,15 +941,16 @@ class normalization:
             plt.legend()
             plt.xlabel("SEC fraction")
             plt.ylabel("total intensity")
+            plt.title(title)
             pdf.savefig()
             plt.clf()
             plt.close()
 
-    def plot_count(self, quantification_data, sec_data, filename):
+    def plot_count(self, quantification_data, sec_data, filename, title):
         if plt is None:
             raise ImportError("Error: The matplotlib package is required to create a report.")
         
-        quantification_count = quantification_data.groupby(['run_id'])['peptide_intensity'].count().reset_index() #edit
+        quantification_count = quantification_data.groupby(['run_id'], observed=True)['peptide_intensity'].count().reset_index() #edit
         dfcount = pd.merge(quantification_count, sec_data, on='run_id') #edit
         dfcount['sample_id'] = dfcount['condition_id'].astype(str) + '_' + dfcount['replicate_id'].astype(str) #edit
         dfplot_count = pd.pivot_table(dfcount, values='peptide_intensity', index='sec_id', columns='sample_id').reset_index() #edit
@@ -579,6 +962,7 @@ class normalization:
             plt.legend()
             plt.xlabel("SEC fraction")
             plt.ylabel("number of peptides")
+            plt.title(title)
             pdf.savefig()
             plt.clf()
             plt.close()
@@ -595,64 +979,131 @@ class meta:
         self.peptide_meta, self.protein_meta = self.generate(quantification_data, sec_data)
  
     def generate(self, quantification_data, sec_data):
-        df = pd.merge(quantification_data, sec_data, on='run_id')
+        # Integer codes of the categorical quantification data replace merges on identifiers
+        run_codes = quantification_data['run_id'].values.codes
+        protein_codes = quantification_data['protein_id'].values.codes
+        peptide_codes = quantification_data['peptide_id'].values.codes
+        intensities = quantification_data['peptide_intensity'].values
+
+        # SEC fraction of each data point through a lookup by run code; runs missing from the SEC definition are dropped
+        run_sec = sec_data.drop_duplicates('run_id')
+        run_sec = pd.Series(run_sec['sec_id'].values, index=run_sec['run_id'].astype(str)).reindex(quantification_data['run_id'].cat.categories.astype(str))
+        valid = (run_codes >= 0) & (protein_codes >= 0) & (peptide_codes >= 0)
+        valid[valid] = run_sec.notna().values[run_codes[valid]]
+        if not valid.all():
+            run_codes, protein_codes, peptide_codes, intensities = run_codes[valid], protein_codes[valid], peptide_codes[valid], intensities[valid]
+        sec_ids = run_sec.fillna(0).values.astype(sec_data['sec_id'].dtype)[run_codes]
 
         # Peptide-level meta data
-        top_pep_tg = df.groupby(['peptide_id'])
-        top_pep = top_pep_tg['peptide_intensity'].sum().reset_index()
-        top_pep.columns = ['peptide_id','sumIntensity']
-        top_pep_merged = pd.merge(df[['peptide_id','protein_id']], top_pep, on='peptide_id', how='inner')
-        top_pep_rank = top_pep_merged[['protein_id','peptide_id','sumIntensity']].drop_duplicates()
-        top_pep_rank['peptide_rank'] = top_pep_rank.groupby(['protein_id'])['sumIntensity'].rank(ascending=False)
+        peptide_sums = pd.Series(intensities).groupby(peptide_codes).sum()
+        num_peptides = len(quantification_data['peptide_id'].cat.categories)
+        pairs = pd.unique(protein_codes.astype(np.int64) * num_peptides + peptide_codes)
+        top_pep_rank = pd.DataFrame({'protein_code': pairs // num_peptides, 'peptide_code': pairs % num_peptides})
+        top_pep_rank['sumIntensity'] = peptide_sums.reindex(top_pep_rank['peptide_code']).values
+        top_pep_rank['peptide_rank'] = top_pep_rank.groupby('protein_code')['sumIntensity'].rank(ascending=False)
 
         # Store peptide-level meta data
-        peptide_meta = top_pep_rank[['peptide_id','peptide_rank']]
+        peptide_meta = pd.DataFrame({
+            'peptide_id': pd.Categorical.from_codes(top_pep_rank['peptide_code'].values, dtype=quantification_data['peptide_id'].dtype),
+            'peptide_rank': top_pep_rank['peptide_rank'].values
+        })
 
-        # Protein-level meta data
-        num_pep = top_pep_rank.groupby(['protein_id'])['peptide_id'].count().reset_index()
-        num_pep.columns = ['protein_id','peptide_count']
+        # Protein-level statistics in a single grouped pass
+        protein_stats = pd.DataFrame({'sum_intensity': intensities, 'min_sec': sec_ids, 'max_sec': sec_ids}).groupby(protein_codes).agg({'sum_intensity': 'sum', 'min_sec': 'min', 'max_sec': 'max'})
+        protein_stats['peptide_count'] = top_pep_rank.groupby('protein_code').size().reindex(protein_stats.index).values
 
         # Generate intensity bins
-        inpep_intensity = df.groupby(['protein_id'])
-        inpep_intensity_ranks = inpep_intensity['peptide_intensity'].sum().reset_index()
-        inpep_intensity_ranks.columns = ['protein_id','sum_intensity']
-        inpep_intensity_ranks['intensity_rank'] = inpep_intensity_ranks['sum_intensity'].rank(ascending=False)
-        inpep_intensity_ranks['intensity_bin'] = pd.cut(inpep_intensity_ranks['intensity_rank'], bins=self.decoy_intensity_bins, right=False, labels=False)
+        intensity_rank = protein_stats['sum_intensity'].rank(ascending=False)
+        protein_stats['intensity_bin'] = pd.cut(intensity_rank, bins=self.decoy_intensity_bins, right=False, labels=False)
 
         # Generate left sec bins
-        inpep_min_sec = df.groupby(['protein_id'])
-        inpep_min_sec_ranks = inpep_min_sec['sec_id'].min().reset_index()
-        inpep_min_sec_ranks.columns = ['protein_id','min_sec']
-        inpep_min_sec_ranks['sec_min_rank'] = inpep_min_sec_ranks['min_sec'].rank(ascending=False)
-        inpep_min_sec_ranks['sec_min_bin'] = pd.cut(inpep_min_sec_ranks['sec_min_rank'], bins=self.decoy_left_sec_bins, right=False, labels=False)
+        sec_min_rank = protein_stats['min_sec'].rank(ascending=False)
+        protein_stats['sec_min_bin'] = pd.cut(sec_min_rank, bins=self.decoy_left_sec_bins, right=False, labels=False)
 
         # Generate right sec bins
-        inpep_max_sec = df.groupby(['protein_id'])
-        inpep_max_sec_ranks = inpep_max_sec['sec_id'].max().reset_index()
-        inpep_max_sec_ranks.columns = ['protein_id','max_sec']
-        inpep_max_sec_ranks['sec_max_rank'] = inpep_max_sec_ranks['max_sec'].rank(ascending=False)
-        inpep_max_sec_ranks['sec_max_bin'] = pd.cut(inpep_max_sec_ranks['sec_max_rank'], bins=self.decoy_right_sec_bins, right=False, labels=False)
+        sec_max_rank = protein_stats['max_sec'].rank(ascending=False)
+        protein_stats['sec_max_bin'] = pd.cut(sec_max_rank, bins=self.decoy_right_sec_bins, right=False, labels=False)
 
         # Store protein-level meta data
-        protein_meta = pd.merge(pd.merge(pd.merge(num_pep[['protein_id','peptide_count']], inpep_intensity_ranks[['protein_id','intensity_bin']], on='protein_id', how='inner'), inpep_min_sec_ranks[['protein_id','sec_min_bin','min_sec']], on='protein_id', how='inner'), inpep_max_sec_ranks[['protein_id','sec_max_bin','max_sec']], on='protein_id', how='inner')
+        protein_meta = pd.DataFrame({
+            'protein_id': pd.Categorical.from_codes(protein_stats.index.values, dtype=quantification_data['protein_id'].dtype),
+            'peptide_count': protein_stats['peptide_count'].values,
+            'intensity_bin': protein_stats['intensity_bin'].values,
+            'sec_min_bin': protein_stats['sec_min_bin'].values,
+            'min_sec': protein_stats['min_sec'].values,
+            'sec_max_bin': protein_stats['sec_max_bin'].values,
+            'max_sec': protein_stats['max_sec'].values
+        })
 
         return peptide_meta, protein_meta
 
+def sample_decoys(queries, strata, oversample, rng, max_rounds=100):
+    # Rows are ordered by stratum, so that permutations within strata reduce to a single sort
+    group = queries.groupby(strata, sort=False, observed=True).ngroup().values
+    order = np.argsort(group, kind='stable')
+    group = group[order].astype(np.int64)
+    sizes = np.bincount(group)
+
+    codes, ids = pd.factorize(pd.concat([queries['bait_id'], queries['prey_id']], ignore_index=True))
+    num_ids = max(len(ids), 1)
+    bait = codes[:len(order)].astype(np.int64)[order]
+    prey = codes[len(order):].astype(np.int64)[order]
+
+    # Unique non-self pairs that can be formed within each stratum
+    bait_keys = pd.unique(group * num_ids + bait)
+    prey_keys = pd.unique(group * num_ids + prey)
+    possible = np.bincount(bait_keys // num_ids, minlength=len(sizes)) * np.bincount(prey_keys // num_ids, minlength=len(sizes)) - np.bincount(bait_keys[np.isin(bait_keys, prey_keys)] // num_ids, minlength=len(sizes))
+    target = np.minimum(oversample * sizes, possible)
+
+    keys = np.empty(0, dtype=np.int64)
+    rows = np.empty(0, dtype=np.int64)
+    pending = target > 0
+    total_rounds = 0
+    while pending.any() and total_rounds < max_rounds:
+        # An additional round absorbs self pairs and collisions
+        rounds = min(oversample + 1, max_rounds - total_rounds)
+        active = np.flatnonzero(pending[group])
+
+        # Baits are permuted within each stratum and round by sorting on random keys below the block index
+        pos = np.tile(active, rounds)
+        block = np.repeat(np.arange(rounds, dtype=np.int64), active.shape[0]) * len(sizes) + group[pos]
+        shuffled = bait[pos[np.argsort((block << 32) | rng.integers(0, 2**32, pos.shape[0], dtype=np.int64))]]
+
+        nonself = shuffled != prey[pos]
+        keys = np.concatenate([keys, ((group[pos] * num_ids + shuffled) * num_ids + prey[pos])[nonself]])
+        rows = np.concatenate([rows, pos[nonself]])
+
+        # Keep first occurrence of each pair in drawing order
+        first = ~pd.Series(keys).duplicated().values
+        keys = keys[first]
+        rows = rows[first]
+
+        pending = np.bincount(group[rows], minlength=len(sizes)) < target
+        total_rounds += rounds
+
+    # Select the requested number of decoys per stratum
+    selection = np.argsort(group[rows], kind='stable')
+    selected_group = group[rows][selection]
+    rank = np.arange(selection.shape[0]) - np.searchsorted(selected_group, np.arange(len(sizes)))[selected_group]
+    selection = np.sort(selection[rank < target[selected_group]])
+
+    decoys = queries.iloc[order[rows[selection]]].reset_index(drop=True)
+    decoys['bait_id'] = ids.take((keys[selection] // num_ids) % num_ids).values
+
+    return decoys, target.sum(), (oversample * sizes).sum()
+
 class query:
-    def __init__(self, net_data, posnet_data, negnet_data, protein_meta_data, min_interaction_confidence, interaction_confidence_bins, interaction_confidence_quantile, decoy_oversample, decoy_subsample): # decoy_exclude
+    def __init__(self, net_data, posnet_data, negnet_data, protein_meta_data, min_interaction_confidence, interaction_confidence_bins, interaction_confidence_quantile, decoy_oversample, decoy_subsample, decoy_seed=None): # decoy_exclude
         self.min_interaction_confidence = min_interaction_confidence
         self.interaction_confidence_bins = interaction_confidence_bins
         self.interaction_confidence_quantile = interaction_confidence_quantile
         self.decoy_oversample = decoy_oversample
         self.decoy_subsample = decoy_subsample
         # self.decoy_exclude = decoy_exclude
+        self.rng = np.random.default_rng(decoy_seed)
         self.df = self.generate_query(net_data, posnet_data, negnet_data, protein_meta_data)
  
     def generate_query(self, net_data, posnet_data, negnet_data, protein_meta_data):
-        def _random_nonidentical_array(data):
-            np.random.shuffle(data['bait_id'].values)
-            return data
-
         # Merge data
         queries = pd.merge(net_data.to_df(), protein_meta_data, left_on='prey_id', right_on='protein_id', how='inner')
         queries['decoy'] = False
@@ -677,15 +1128,9 @@ class query:
 
         # Append decoys
         if negnet_data is None:
-            decoy_queries = queries.copy()
-            decoy_queries = decoy_queries.groupby(['learning','confidence_bin','intensity_bin','sec_min_bin','sec_max_bin'])
-
-            for it in range(0, self.decoy_oversample):
-                if it == 0:
-                    decoy_queries_shuffled = decoy_queries.apply(_random_nonidentical_array).reset_index()
-                else:
-                    decoy_queries_shuffled = pd.concat([decoy_queries_shuffled, decoy_queries.apply(_random_nonidentical_array).reset_index()])
-            decoy_queries = decoy_queries_shuffled.drop(['decoy'], axis=1).drop_duplicates()
+            decoy_queries, num_decoys, num_requested = sample_decoys(queries, ['learning','confidence_bin','intensity_bin','sec_min_bin','sec_max_bin'], self.decoy_oversample, self.rng)
+            if num_decoys < num_requested:
+                click.echo("Info: Sampled %s of %s requested decoys; the remaining strata are too small to provide more unique pairs." % (num_decoys, num_requested))
         else:
             decoy_queries = pd.merge(negnet_data.to_df(), protein_meta_data, left_on='prey_id', right_on='protein_id', how='inner')
             decoy_queries['learning'] = False
@@ -705,11 +1150,11 @@ class query:
         queries = queries[queries['interaction_confidence'] >= self.min_interaction_confidence]
         decoy_queries = decoy_queries[decoy_queries['bait_id'] != decoy_queries['prey_id']]
         if (decoy_queries.shape[0] > queries.shape[0]) and self.decoy_subsample:
-            decoy_queries = decoy_queries.sample(queries.shape[0]) # Same number of decoys as targets
+            decoy_queries = decoy_queries.sample(queries.shape[0], random_state=self.rng) # Same number of decoys as targets
 
         # Add confidence bin from target network if negative network is provided
         if negnet_data is not None:
-            decoy_queries['confidence_bin'] = queries.sample(decoy_queries.shape[0], replace=True)['confidence_bin'].values
+            decoy_queries['confidence_bin'] = queries.sample(decoy_queries.shape[0], replace=True, random_state=self.rng)['confidence_bin'].values
 
         # Add learning flag to decoys
         if posnet_data is not None:
@@ -723,3 +1168,38 @@ class query:
 
     def to_df(self):
         return self.df
+
+class dictionary:
+    def __init__(self, run_ids, protein_ids, peptide_ids):
+        # Integer keys follow the lexicographic order of the identifiers, which keeps bait_id < prey_id
+        self.runs = self.index(run_ids)
+        self.proteins = self.index(protein_ids)
+        self.peptides = self.index(peptide_ids)
+
+        self.columns = {'run_id': self.runs, 'protein_id': self.proteins, 'bait_id': self.proteins, 'prey_id': self.proteins, 'peptide_id': self.peptides}
+
+    def index(self, ids):
+        ids = pd.Series(ids)
+        if isinstance(ids.dtype, pd.CategoricalDtype):
+            ids = ids.cat.remove_unused_categories().cat.categories.to_series()
+        return pd.Index(np.unique(ids.dropna().values.astype(str)))
+
+    def encode(self, df):
+        # Replace identifiers by integer keys and drop rows referring to identifiers not covered by the dictionary
+        keys = {}
+        valid = np.ones(df.shape[0], dtype=bool)
+        for column in df.columns.intersection(list(self.columns.keys())):
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                codes, labels = df[column].cat.codes.values, df[column].cat.categories
+            else:
+                codes, labels = pd.factorize(df[column])
+            # Missing values (code -1) are mapped to the appended -1 key
+            keys[column] = np.append(self.columns[column].get_indexer(pd.Index(labels).astype(str)), -1)[codes]
+            valid &= keys[column] >= 0
+
+        return df.assign(**keys)[valid]
+
+    def store(self, db):
+        db.write('RUN_DICT', pd.DataFrame({'run_key': np.arange(len(self.runs)), 'run_id': self.runs}))
+        db.write('PROTEIN_DICT', pd.DataFrame({'protein_key': np.arange(len(self.proteins)), 'protein_id': self.proteins}))
+        db.write('PEPTIDE_DICT', pd.DataFrame({'peptide_key': np.arange(len(self.peptides)), 'peptide_id': self.peptides}))
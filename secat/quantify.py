@@ -8,6 +8,7 @@ from decoupler.method_viper import run_viper
 import os
 
 from .EmpiricalBrownsMethod import EmpiricalBrownsMethod
+from .cube import chromatogram_cube
 import itertools
 
 from scipy.stats import ttest_ind, ttest_rel
@@ -21,7 +22,7 @@ class quantitative_matrix:
         self.minimum_peptides = minimum_peptides
         self.maximum_peptides = maximum_peptides
 
-        self.interactions, self.detections, self.chromatograms, self.peaks = self.read()
+        self.interactions, self.detections, self.cube, self.peaks = self.read()
         self.monomer_peptide = self.quantify_monomers()
         self.complex_peptide = self.quantify_complexes()
 
@@ -59,26 +60,7 @@ class quantitative_matrix:
         )
 
         click.echo("Getting chromatograms table")
-        chromatograms = pd.read_sql(
-            f"""
-            SELECT 
-                SEC.condition_id, 
-                SEC.replicate_id, 
-                SEC.sec_id, 
-                QUANTIFICATION.protein_id, 
-                QUANTIFICATION.peptide_id, 
-                peptide_intensity, 
-                MONOMER.sec_id AS monomer_sec_id 
-            FROM QUANTIFICATION 
-            INNER JOIN PROTEIN_META ON QUANTIFICATION.protein_id = PROTEIN_META.protein_id 
-            INNER JOIN PEPTIDE_META ON QUANTIFICATION.peptide_id = PEPTIDE_META.peptide_id 
-            INNER JOIN SEC ON QUANTIFICATION.RUN_ID = SEC.RUN_ID 
-            INNER JOIN MONOMER ON QUANTIFICATION.protein_id = MONOMER.protein_id AND SEC.condition_id = MONOMER.condition_id AND SEC.replicate_id = MONOMER.replicate_id 
-            WHERE peptide_count >= {self.minimum_peptides} 
-            AND peptide_rank <= {self.maximum_peptides};
-            """, 
-            con
-        )
+        cube = chromatogram_cube(self.outfile, fallback=True)
 
         # TODO: Consider replacing pd.read_sql with https://github.com/sfu-db/connector-x to improve read speeds and utilize concurrency
         click.echo("Getting peaks table")
@@ -86,34 +68,22 @@ class quantitative_matrix:
 
         con.close()
 
-        return interactions, detections, chromatograms, peaks
+        return interactions, detections, cube, peaks
 
-    def quantify_monomers(self):
-        def sec_summarize(df):
-            def aggregate(x):
-                peptide_ix = (x['peptide_intensity']-x['peptide_intensity'].max()).abs().argsort()[:self.maximum_peptides]
-                return pd.DataFrame({'peptide_id': x.iloc[peptide_ix]['peptide_id'], 'peptide_intensity': x.iloc[peptide_ix]['peptide_intensity'], 'total_peptide_intensity': x.iloc[peptide_ix]['total_peptide_intensity']})
-
-            # Summarize total peptide intensities
-            peptide_total = df.groupby(['peptide_id'])['peptide_intensity'].sum().reset_index()
-            peptide_total.columns = ['peptide_id','total_peptide_intensity']
-
-            # Summarize monomer peptide intensities
-            if df[df['sec_id'] >= df['monomer_sec_id']].shape[0] > 0:
-                peptide_mono = df[df['sec_id'] >= df['monomer_sec_id']].groupby(['peptide_id'])['peptide_intensity'].sum().reset_index()
-                peptide_mono.columns = ['peptide_id','peptide_intensity']
-            else:
-                peptide_mono = pd.DataFrame({'peptide_id': df['peptide_id'].unique(), 'peptide_intensity': 0})
-
-            peptide = pd.merge(peptide_mono, peptide_total, on='peptide_id')
+    def peptide_rows(self):
+        # Cube rows passing the peptide filters and their first and last row per protein
+        rows = self.cube.peptides(self.minimum_peptides, self.maximum_peptides)
+        protein_index = np.searchsorted(self.cube.protein_id, self.cube.peptide_protein_id[rows])
+        protein_starts = np.flatnonzero(np.diff(protein_index, prepend=-1))
+        protein_stops = np.append(protein_starts[1:], len(rows))
 
-            # Ensure that minimum peptides are present
-            if peptide.shape[0] >= self.minimum_peptides:
-                # Select representative closest to max and aggregate
-                peptide = aggregate(peptide)
+        return rows, protein_index, protein_starts, protein_stops
 
-                return peptide
+    def aggregate(self, peptide_intensity):
+        # Select representatives closest to max
+        return np.argsort(np.abs(peptide_intensity - peptide_intensity.max()))[:self.maximum_peptides]
 
+    def quantify_monomers(self):
         def peptide_summarize(df):
             # Aggregate to peptide level
             peptide = df[['condition_id','replicate_id','bait_id','prey_id','is_bait','peptide_id']].copy()
@@ -123,44 +93,42 @@ class quantitative_matrix:
 
             return peptide
 
-        # Quantify monomers
-        monomers = self.chromatograms.copy()
-        monomers['bait_id'] = monomers['protein_id']
-        monomers['prey_id'] = monomers['protein_id']
-        monomers['is_bait'] = True
-
-        monomers_sec = monomers.groupby(['condition_id','replicate_id','bait_id','prey_id','is_bait']).apply(sec_summarize).reset_index(level=['condition_id','replicate_id','bait_id','prey_id','is_bait'])
+        rows, protein_index, protein_starts, protein_stops = self.peptide_rows()
+
+        # Quantify monomers from the per-run peptide chromatograms of the cube
+        monomers_sec = []
+        for run in range(self.cube.runs.shape[0]):
+            intensity = self.cube.intensity[run][rows].astype(np.float64)
+            detected = ~np.isnan(intensity)
+            intensity = np.nan_to_num(intensity)
+            monomer = detected & (self.cube.sec_id >= self.cube.monomer_sec_id[run, protein_index][:, None])
+
+            # Summarize total and monomer peptide intensities
+            total_peptide_intensity = intensity.sum(axis=1)
+            peptide_intensity = np.where(monomer, intensity, 0).sum(axis=1)
+
+            for start, stop in zip(protein_starts, protein_stops):
+                # Peptides with monomer data points, or all peptides of proteins without any
+                peptides = monomer[start:stop].any(axis=1)
+                if not peptides.any():
+                    peptides = detected[start:stop].any(axis=1)
+                peptides = start + peptides.nonzero()[0]
+
+                # Ensure that minimum peptides are present
+                if len(peptides) > 0 and len(peptides) >= self.minimum_peptides:
+                    peptides = peptides[self.aggregate(peptide_intensity[peptides])]
+                    protein_id = self.cube.peptide_protein_id[rows[start]]
+                    monomers_sec.append(pd.DataFrame({'condition_id': self.cube.runs['condition_id'].values[run], 'replicate_id': self.cube.runs['replicate_id'].values[run], 'bait_id': protein_id, 'prey_id': protein_id, 'is_bait': True, 'peptide_id': self.cube.peptide_id[rows[peptides]], 'peptide_intensity': peptide_intensity[peptides], 'total_peptide_intensity': total_peptide_intensity[peptides]}))
+
+        if len(monomers_sec) == 0:
+            monomers_sec = pd.DataFrame(columns=['condition_id','replicate_id','bait_id','prey_id','is_bait','peptide_id','peptide_intensity','total_peptide_intensity'])
+        else:
+            monomers_sec = pd.concat(monomers_sec, ignore_index=True)
         monomers_peptides = peptide_summarize(monomers_sec)
 
         return monomers_peptides
 
     def quantify_complexes(self):
-        def sec_summarize(df):
-            def aggregate(x):
-                peptide_ix = (x['peptide_intensity'] - x['peptide_intensity'].max()).abs().argsort().iloc[:self.maximum_peptides]
-                return pd.DataFrame({'peptide_id': x.iloc[peptide_ix]['peptide_id'], 'peptide_intensity': x.iloc[peptide_ix]['peptide_intensity']})
-
-            # Remove monomer fractions for complex-centric quantification
-            df = df[df['sec_id'] < df['monomer_sec_id']]
-            # Find SEC intersections
-            bait_sec = df[df['is_bait']]['sec_id'].unique()
-            prey_sec = df[~df['is_bait']]['sec_id'].unique()
-            intersection = pd.DataFrame({'sec_id': list(set(bait_sec) & set(prey_sec))})
-            # There needs to be at least one fraction where peptides from both proteins are measured.
-            if intersection.shape[0] > 0:
-                # Summarize intersection peptide intensities
-                df_is = pd.merge(df, intersection, on='sec_id')
-                peptide_is = df_is.groupby(['peptide_id'])['peptide_intensity'].sum().reset_index()
-                peptide_is.columns = ['peptide_id','peptide_intensity']
-
-                peptide = pd.merge(df[['condition_id','replicate_id','bait_id','prey_id','is_bait','peptide_id']].drop_duplicates(), peptide_is, on='peptide_id')
-                # Ensure that minimum peptides are present for both interactors for quantification.
-                if peptide[peptide['is_bait']].shape[0] >= self.minimum_peptides and peptide[~peptide['is_bait']].shape[0] >= self.minimum_peptides:
-                    # Select representative closest to max and aggregate
-                    peptide = peptide.groupby(['is_bait'], group_keys=True).apply(aggregate).reset_index(level=['is_bait'])
-                    
-                    return peptide
-
         def peptide_summarize(df):
             # Aggregate to peptide level
             peptide = df[['condition_id','replicate_id','bait_id','prey_id','is_bait','peptide_id']].copy()
@@ -168,18 +136,52 @@ class quantitative_matrix:
 
             return peptide
 
-        # Restrict chromatographic data to selected peaks only
-        chromatograms = pd.merge(self.chromatograms, self.peaks, on=['condition_id','replicate_id','protein_id','sec_id'])
+        rows, protein_index, protein_starts, protein_stops = self.peptide_rows()
+        proteins = self.cube.peptide_protein_id[rows[protein_starts]]
+
+        # Selected peaks per run, protein and SEC fraction
+        peaks = pd.merge(self.peaks, self.cube.runs.reset_index().rename(columns={'index': 'run'}), on=['condition_id','replicate_id'])
+        peaks = peaks[peaks['protein_id'].isin(self.cube.protein_id)]
+        picked = np.zeros((self.cube.runs.shape[0], len(self.cube.protein_id), len(self.cube.sec_id)), dtype=bool)
+        picked[peaks['run'].values, np.searchsorted(self.cube.protein_id, peaks['protein_id'].values), peaks['sec_id'].values - self.cube.sec_id[0]] = True
+
+        # Interactions with both interactors in the cube
+        interactions = self.interactions.sort_values(['bait_id','prey_id'])
+        interactions = interactions[interactions['bait_id'].isin(proteins) & interactions['prey_id'].isin(proteins)]
+        bait_index = np.searchsorted(proteins, interactions['bait_id'].values)
+        prey_index = np.searchsorted(proteins, interactions['prey_id'].values)
+
+        complexes_sec = []
+        for run in range(self.cube.runs.shape[0]):
+            # Restrict chromatographic data to selected peaks only and remove monomer fractions for complex-centric quantification
+            intensity = self.cube.intensity[run][rows].astype(np.float64)
+            points = ~np.isnan(intensity) & picked[run, protein_index] & (self.cube.sec_id < self.cube.monomer_sec_id[run, protein_index][:, None])
+            intensity = np.where(points, intensity, 0)
+            fractions = np.logical_or.reduceat(points, protein_starts, axis=0) if len(rows) > 0 else np.zeros((0, len(self.cube.sec_id)), dtype=bool)
+
+            for bait_id, prey_id, bait_ix, prey_ix in zip(interactions['bait_id'].values, interactions['prey_id'].values, bait_index, prey_index):
+                # There needs to be at least one fraction where peptides from both proteins are measured.
+                intersection = fractions[bait_ix] & fractions[prey_ix]
+                if not intersection.any():
+                    continue
 
-        # Quantify interactions
-        baits = pd.merge(self.interactions, chromatograms, left_on=['bait_id'], right_on=['protein_id']).drop(columns=['protein_id'])
-        baits['is_bait'] = True
+                # Summarize intersection peptide intensities
+                interactors = []
+                for is_bait, protein_ix in [(False, prey_ix), (True, bait_ix)]:
+                    start, stop = protein_starts[protein_ix], protein_stops[protein_ix]
+                    peptides = start + points[start:stop][:, intersection].any(axis=1).nonzero()[0]
+                    interactors.append((is_bait, peptides, intensity[peptides][:, intersection].sum(axis=1)))
 
-        preys = pd.merge(self.interactions, chromatograms, left_on=['prey_id'], right_on=['protein_id']).drop(columns=['protein_id'])
-        preys['is_bait'] = False
+                # Ensure that minimum peptides are present for both interactors for quantification.
+                if all(len(peptides) >= self.minimum_peptides for _, peptides, _ in interactors):
+                    for is_bait, peptides, peptide_intensity in interactors:
+                        peptide_ix = self.aggregate(peptide_intensity)
+                        complexes_sec.append(pd.DataFrame({'condition_id': self.cube.runs['condition_id'].values[run], 'replicate_id': self.cube.runs['replicate_id'].values[run], 'bait_id': bait_id, 'prey_id': prey_id, 'is_bait': is_bait, 'peptide_id': self.cube.peptide_id[rows[peptides[peptide_ix]]], 'peptide_intensity': peptide_intensity[peptide_ix]}))
 
-        complexes = pd.concat([baits, preys]).reset_index()
-        complexes_sec = complexes.groupby(['condition_id','replicate_id','bait_id','prey_id']).apply(sec_summarize).reset_index(level=['condition_id','replicate_id','bait_id','prey_id'])
+        if len(complexes_sec) == 0:
+            complexes_sec = pd.DataFrame(columns=['condition_id','replicate_id','bait_id','prey_id','is_bait','peptide_id','peptide_intensity'])
+        else:
+            complexes_sec = pd.concat(complexes_sec, ignore_index=True)
         complexes_peptides = peptide_summarize(complexes_sec)
 
         return complexes_peptides
@@ -246,8 +248,8 @@ class enrichment_test:
                         dat = state[state['interactor_abundance'] > 0].copy()
                         dat = dat.rename(index=str, columns={"interactor_abundance": level})
 
-                    dat['query_id'] = dat['bait_id'] + '_' + dat['prey_id']
-                    dat['query_peptide_id'] = dat['bait_id'] + '_' + dat['prey_id'] + '_' + dat['peptide_id']
+                    dat['query_id'] = dat['bait_id'].astype(str) + '_' + dat['prey_id'].astype(str)
+                    dat['query_peptide_id'] = dat['query_id'] + '_' + dat['peptide_id'].astype(str)
                     dat['quantification_id'] = 'viper_' + dat['condition_id'] + '_' + dat['replicate_id']
                     dat['run_id'] = dat['condition_id'] + '_' + dat['replicate_id']
                     qm_ids = dat[['quantification_id','condition_id','replicate_id']].drop_duplicates()
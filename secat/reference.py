@@ -0,0 +1,152 @@
+import json
+import hashlib
+import os
+import sys
+import click
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+
+from .preprocess import uniprot, net, read_network, identify_network, file_hash
+
+REFERENCE_VERSION = 1
+
+def build_reference(outdir, uniprotfile, netfiles):
+    # Bundles are identified by their format version and the content of all source files
+    sources = [{'file': os.path.basename(f), 'sha256': file_hash(f)} for f in [uniprotfile] + list(netfiles)]
+    bundle_id = hashlib.sha256(json.dumps({'version': REFERENCE_VERSION, 'sources': [s['sha256'] for s in sources]}).encode()).hexdigest()
+
+    manifest_file = os.path.join(outdir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            if json.load(f).get('id') == bundle_id:
+                click.echo("Info: Reference bundle %s is up to date." % outdir)
+                return bundle_id
+
+    os.makedirs(outdir, exist_ok=True)
+
+    click.echo("Info: Parsing UniProt XML file %s." % uniprotfile)
+    uniprot_data = uniprot(uniprotfile, False)
+
+    networks = []
+    for netfile in netfiles:
+        click.echo("Info: Parsing network file %s." % netfile)
+        networks.append((identify_network(netfile), net(netfile, uniprot_data, None, read_network(netfile, None)).to_df()))
+
+    # Integer codes follow the lexicographic order of all UniProt and network identifiers
+    protein_ids = pd.Index(np.unique(np.concatenate([uniprot_data.df['protein_id'].values.astype(str)] + [np.concatenate([df['bait_id'].values.astype(str), df['prey_id'].values.astype(str)]) for _, df in networks])))
+    pd.DataFrame({'protein_id': protein_ids}).to_parquet(os.path.join(outdir, 'identifiers.parquet'), index=False)
+
+    proteins = uniprot_data.df
+    pd.DataFrame({
+        'protein_code': protein_ids.get_indexer(proteins['protein_id'].astype(str)).astype(np.int32),
+        'protein_name': proteins['protein_name'],
+        'gene': proteins['gene'],
+        'protein_mw': proteins['protein_mw']
+    }).to_parquet(os.path.join(outdir, 'uniprot.parquet'), index=False)
+
+    ensembl = uniprot_data.expand().dropna(subset=['ensembl_id'])
+    pd.DataFrame({
+        'ensembl_id': ensembl['ensembl_id'].values,
+        'protein_code': protein_ids.get_indexer(ensembl['protein_id'].astype(str)).astype(np.int32)
+    }).to_parquet(os.path.join(outdir, 'ensembl.parquet'), index=False)
+
+    manifest = {'format': 'secat-reference', 'version': REFERENCE_VERSION, 'id': bundle_id, 'created': datetime.now(timezone.utc).isoformat(), 'uniprot': dict(sources[0], proteins=proteins.shape[0]), 'networks': [], 'identifiers': len(protein_ids)}
+    for i, ((format, df), source) in enumerate(zip(networks, sources[1:])):
+        table = 'network_%s.parquet' % i
+        pd.DataFrame({
+            'bait_code': protein_ids.get_indexer(df['bait_id'].astype(str)).astype(np.int32),
+            'prey_code': protein_ids.get_indexer(df['prey_id'].astype(str)).astype(np.int32),
+            'interaction_confidence': df['interaction_confidence'].values
+        }).to_parquet(os.path.join(outdir, table), index=False)
+        manifest['networks'].append(dict(source, format=format, table=table, interactions=df.shape[0]))
+
+    # The manifest is written last, so that incomplete bundles are never used
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    click.echo("Info: Reference bundle %s with %s proteins and %s networks stored in %s." % (bundle_id[:16], proteins.shape[0], len(networks), outdir))
+
+    return bundle_id
+
+class reference_bundle:
+    def __init__(self, bundledir):
+        self.bundledir = bundledir
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        manifest_file = os.path.join(self.bundledir, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            sys.exit("Error: %s is not a SECAT reference bundle." % self.bundledir)
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        if manifest.get('format') != 'secat-reference' or manifest.get('version') != REFERENCE_VERSION:
+            sys.exit("Error: Reference bundle %s was built by an incompatible version of SECAT. Please rebuild it." % self.bundledir)
+
+        return manifest
+
+    def built_from(self, uniprotfile):
+        # Bundles are only valid for the UniProt XML file they were built from
+        return self.manifest['uniprot']['sha256'] == file_hash(uniprotfile)
+
+    def codes(self, protein_ids):
+        # Integer codes of the requested identifiers present in the bundle
+        identifiers = pd.Index(pd.read_parquet(os.path.join(self.bundledir, 'identifiers.parquet'))['protein_id'].values)
+        if protein_ids is None:
+            return identifiers, None
+        codes = identifiers.get_indexer(pd.Index(list(protein_ids)).astype(str))
+        return identifiers, codes[codes >= 0]
+
+    def proteins(self, protein_ids=None):
+        identifiers, codes = self.codes(protein_ids)
+
+        df = pd.read_parquet(os.path.join(self.bundledir, 'uniprot.parquet'))
+        ensembl = pd.read_parquet(os.path.join(self.bundledir, 'ensembl.parquet'))
+        if codes is not None:
+            df = df[df['protein_code'].isin(codes)]
+            ensembl = ensembl[ensembl['protein_code'].isin(codes)]
+
+        ensembl = ensembl.groupby('protein_code')['ensembl_id'].agg(list)
+
+        return pd.DataFrame({
+            'protein_id': pd.Series(identifiers.values[df['protein_code'].values], dtype='object'),
+            'protein_name': df['protein_name'].values,
+            'gene': df['gene'].values,
+            'ensembl_id': pd.Series([ensembl.get(code, []) for code in df['protein_code'].values], dtype='object'),
+            'protein_mw': df['protein_mw'].values
+        })
+
+    def network(self, netfile, protein_ids=None):
+        # Compiled networks are matched by file content
+        sha256 = file_hash(netfile)
+        tables = [n['table'] for n in self.manifest['networks'] if n['sha256'] == sha256]
+        if len(tables) == 0:
+            return None
+
+        identifiers, codes = self.codes(protein_ids)
+
+        df = pd.read_parquet(os.path.join(self.bundledir, tables[0]))
+        if codes is not None:
+            df = df[df['bait_code'].isin(codes) & df['prey_code'].isin(codes)]
+
+        return pd.DataFrame({
+            'bait_id': identifiers.values[df['bait_code'].values],
+            'prey_id': identifiers.values[df['prey_code'].values],
+            'interaction_confidence': df['interaction_confidence'].values
+        })
+
+def read_reference_network(netfile, protein_ids, reference):
+    # Use the compiled network of the reference bundle if available and parse the file otherwise
+    network = None
+    if reference is not None:
+        network = reference.network(netfile, protein_ids)
+
+    if network is None:
+        if reference is not None:
+            click.echo("Info: Network %s is not part of the reference bundle. Parsing it instead." % netfile)
+        return read_network(netfile, protein_ids), False
+    else:
+        click.echo("Info: Using network %s from reference bundle." % netfile)
+        return network, True
@@ -5,14 +5,37 @@ import click
 import sqlite3
 import os
 import sys
+import json
+import hashlib
 
 import multiprocessing
-from functools import partial
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from functools import partial, lru_cache
 from tqdm import tqdm
 
 from scipy.signal import find_peaks, peak_widths
+from numpy.lib.stride_tricks import as_strided
 from minepy import cstats
 
+from .database import writer, background_writer, check_sqlite_table
+from .cube import chromatogram_cube
+
+# Arrays of the peptide profiles of a run
+PROFILE_ARRAYS = ['matrix','offset','count','monomer_sec_id','total','mask','total_abundance','summarized','zscore','abundance','autocorrelation_lag']
+
+# Feature columns and types of the FEATURE table
+FEATURE_COLUMNS = [('var_xcorr_shape', np.float64), ('var_xcorr_shift', np.float64), ('var_abundance_ratio', np.float64), ('var_total_abundance_ratio', np.float64), ('var_mic', np.float64), ('var_tic', np.float64), ('var_sec_overlap', np.float64), ('var_sec_intersection', np.int64), ('var_delta_monomer', np.int64), ('var_apex_monomer', np.float64)]
+
+# Features of the learn filter
+PREFILTER_COLUMNS = ['var_xcorr_shift', 'var_abundance_ratio', 'var_total_abundance_ratio']
+
+# Absolute tolerance of the MIC/TIC prefilter thresholds
+PREFILTER_TOLERANCE = 1e-9
+
+# Maximum number of queries of a bait scored as one block
+BLOCK_SIZE = 512
+
 # np.seterr(divide='ignore', invalid='ignore')
 # np.seterr(all='raise')
 
@@ -40,24 +63,288 @@ class monomer:
 
         return protein_sec_thresholds[['condition_id','replicate_id','protein_id','sec_id']]
 
-def score_chunk(queries, qm, run):
-    scores = []
-    for query_ix, query in queries.iterrows():
-        bait = qm.xs(query['bait_id'], level='protein_id')
-        bait_monomer_sec_id = bait.iloc[0].name[1]
-
-        prey = qm.xs(query['prey_id'], level='protein_id')
-        prey_monomer_sec_id = prey.iloc[0].name[1]
+class profiles:
+    def __init__(self, chromatograms=None, arrays=None, matrix=None, protein_ids=None, monomer_sec_ids=None):
+        if arrays is not None:
+            # Profiles published by another process
+            for key in PROFILE_ARRAYS:
+                setattr(self, key, arrays[key])
+            return
 
-        score = score_interaction(bait.values.copy(), prey.values.copy(), bait_monomer_sec_id, prey_monomer_sec_id)
+        if chromatograms is not None:
+            # Pivot long-format chromatograms to peptide rows with protein key and monomer threshold
+            qm = chromatograms.pivot_table(index=['protein_id','peptide_id','monomer_sec_id'], columns='sec_id', values='peptide_intensity')
+            matrix = qm.values
+            protein_ids = qm.index.get_level_values('protein_id').values
+            monomer_sec_ids = qm.index.get_level_values('monomer_sec_id').values
+
+        # Contiguous peptide x SEC fraction matrix of a run; peptide rows are grouped by protein
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+
+        # Row offset, row count and monomer threshold indexed by protein key
+        protein_id, offset, count = np.unique(protein_ids, return_index=True, return_counts=True)
+        num_protein_ids = protein_id.max() + 1 if len(protein_id) > 0 else 0
+        self.offset = np.zeros(num_protein_ids, dtype=np.int64)
+        self.count = np.zeros(num_protein_ids, dtype=np.int64)
+        self.monomer_sec_id = np.full(num_protein_ids, -1, dtype=np.int64)
+        self.offset[protein_id] = offset
+        self.count[protein_id] = count
+        self.monomer_sec_id[protein_id] = np.asarray(monomer_sec_ids)[offset]
+
+        self.summarize()
+
+    def summarize(self):
+        # Protein-level features shared by all queries of the run
+        num_protein_ids = len(self.count)
+        self.total = np.nan_to_num(self.matrix)
+        self.mask = np.zeros((num_protein_ids, self.matrix.shape[1]), dtype=bool)
+        self.total_abundance = np.full(num_protein_ids, np.nan)
+
+        # Features of profiles restricted to an intersection covering the elution mask
+        self.summarized = np.zeros(num_protein_ids, dtype=bool)
+        self.zscore = np.full(self.matrix.shape, np.nan)
+        self.abundance = np.full(num_protein_ids, np.nan)
+        self.autocorrelation_lag = np.full(num_protein_ids, np.nan)
+
+        for protein_id in self.proteins():
+            profile = self.profile(protein_id)
+            total = self.total[self.offset[protein_id]:self.offset[protein_id]+self.count[protein_id]]
+
+            self.mask[protein_id] = np.nansum(profile, axis=0) > 0
+            self.total_abundance[protein_id] = mean_abundance(total)
+
+            # Restricting is a no-op if all peptides and no data points outside of the mask are retained
+            if np.all(np.nansum(np.where(self.mask[protein_id], profile, np.nan), axis=1) > 0) and not np.any(total[:,~self.mask[protein_id]]):
+                _, zscore, abundance, autocorrelation_lag = summarize_profile(total)
+                self.summarized[protein_id] = True
+                self.zscore[self.offset[protein_id]:self.offset[protein_id]+self.count[protein_id]] = zscore
+                self.abundance[protein_id] = abundance
+                self.autocorrelation_lag[protein_id] = autocorrelation_lag
+
+    def proteins(self):
+        return self.count.nonzero()[0]
+
+    def profile(self, protein_id):
+        # Zero-copy view of the peptide profiles of a protein
+        return self.matrix[self.offset[protein_id]:self.offset[protein_id]+self.count[protein_id]]
+
+    def restricted(self, protein_id, intersection):
+        # Peptide profiles, z-scores, abundance and autocorrelation lag restricted to the intersection
+        if self.summarized[protein_id] and not np.any(self.mask[protein_id] & ~intersection):
+            rows = slice(self.offset[protein_id], self.offset[protein_id]+self.count[protein_id])
+            return self.total[rows], self.zscore[rows], self.abundance[protein_id], self.autocorrelation_lag[protein_id]
+
+        return summarize_profile(self.intersected(protein_id, intersection))
+
+    def intersected(self, protein_id, intersection):
+        # Remove non-overlapping segments
+        profile = np.where(intersection, self.profile(protein_id), np.nan)
+
+        # Remove completely empty peptides
+        profile = profile[(np.nansum(profile,axis=1) > 0),:]
+
+        # Replace nan with 0
+        return np.nan_to_num(profile)
+
+def parameter_hash(**parameters):
+    # Identifies the scoring parameters of checkpointed chunks
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+def query_hash(infile, chunksize=1000000):
+    # Identifies the queries of a SECAT file to match shards to their input file; queries are hashed in chunks in the order read by scoring
+    sha1 = hashlib.sha1()
+    con = sqlite3.connect(infile)
+    for chunk in pd.read_sql('SELECT * FROM QUERY;', con, chunksize=chunksize):
+        sha1.update(pd.util.hash_pandas_object(chunk, index=False).values.tobytes())
+    con.close()
+
+    return sha1.hexdigest()
+
+def input_hash(infile, queries=None):
+    # Identifies the input data of checkpointed chunks by its queries, SEC definition and quantification summary; the query hash may be passed if known
+    if queries is None:
+        queries = query_hash(infile)
+
+    con = sqlite3.connect(infile)
+    sec = pd.read_sql('SELECT * FROM SEC;', con)
+    quantification = pd.read_sql('SELECT COUNT(*) AS peptide_count, TOTAL(peptide_intensity) AS peptide_intensity FROM QUANTIFICATION;', con)
+    con.close()
+
+    return hashlib.sha1((queries + json.dumps([sec.to_dict(orient='list'), quantification.iloc[0].tolist()], sort_keys=True, default=str)).encode()).hexdigest()
+
+def query_shards(bait_ids, prey_ids, num_shards):
+    # Deterministic shard of each query by the splitmix64 hash of its protein pair; duplicate pairs share a shard
+    x = bait_ids.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + prey_ids.astype(np.uint64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+
+    return (x % np.uint64(num_shards)).astype(np.int64)
+
+class mic_prefilter:
+    def __init__(self, maximum_sec_shift, minimum_abundance_ratio):
+        self.maximum_sec_shift = maximum_sec_shift
+        self.minimum_abundance_ratio = minimum_abundance_ratio
+
+        # Queries whose mean features over all runs pass the learn filter, indexed by query
+        self.pairs = None
+
+    def passes(self, xcorr_shift, abundance_ratio, total_abundance_ratio):
+        # Learn filter; the tolerance keeps MIC/TIC scores of queries at the thresholds despite rounding of means
+        return (xcorr_shift <= self.maximum_sec_shift + PREFILTER_TOLERANCE) & (abundance_ratio >= self.minimum_abundance_ratio - PREFILTER_TOLERANCE) & (total_abundance_ratio >= self.minimum_abundance_ratio - PREFILTER_TOLERANCE)
+
+    def mic(self, query_ix, score):
+        # MIC/TIC scores are required if either the query in this run or its mean over all runs can pass the learn filter
+        return self.pairs[query_ix] or self.passes(score['var_xcorr_shift'], score['var_abundance_ratio'], score['var_total_abundance_ratio'])
+
+def prefilter_chunk(query_ids, bait_ids, prey_ids, qm, blocks=False):
+    # Features of all queries without MIC/TIC scores
+    if blocks:
+        return block_chunk(query_ids, bait_ids, prey_ids, qm, mic=lambda query_ix, score: False)
+
+    num_scored = 0
+    scores = {'query_ix': np.empty(len(query_ids), dtype=np.int64)}
+    for column, dtype in FEATURE_COLUMNS:
+        scores[column] = np.empty(len(query_ids), dtype=dtype)
+
+    for query_ix, bait_id, prey_id in zip(query_ids, bait_ids, prey_ids):
+        score = score_interaction(qm, bait_id, prey_id, mic=lambda score: False)
         if score is not None:
-            score['condition_id'] = run['condition_id']
-            score['replicate_id'] = run['replicate_id']
-            score = {**score, **query}
-            scores.append(score)
-    return(scores)
-
-def score_interaction(bait, prey, bait_monomer_sec_id, prey_monomer_sec_id):
+            scores['query_ix'][num_scored] = query_ix
+            for column, dtype in FEATURE_COLUMNS:
+                scores[column][num_scored] = score[column]
+            num_scored += 1
+
+    return {column: values[:num_scored] for column, values in scores.items()}
+
+def score_chunk(query_ids, bait_ids, prey_ids, qm, mic_prefilter=None, blocks=False):
+    if blocks:
+        return block_chunk(query_ids, bait_ids, prey_ids, qm, mic=None if mic_prefilter is None else mic_prefilter.mic)
+
+    # Typed column buffers of the scored queries
+    num_scored = 0
+    scores = {'query_ix': np.empty(len(query_ids), dtype=np.int64)}
+    for column, dtype in FEATURE_COLUMNS:
+        scores[column] = np.empty(len(query_ids), dtype=dtype)
+
+    for query_ix, bait_id, prey_id in zip(query_ids, bait_ids, prey_ids):
+        if mic_prefilter is None:
+            score = score_interaction(qm, bait_id, prey_id)
+        else:
+            score = score_interaction(qm, bait_id, prey_id, mic=partial(mic_prefilter.mic, query_ix))
+        if score is not None:
+            scores['query_ix'][num_scored] = query_ix
+            for column, dtype in FEATURE_COLUMNS:
+                scores[column][num_scored] = score[column]
+            num_scored += 1
+
+    return {column: values[:num_scored] for column, values in scores.items()}
+
+class shared_arrays:
+    def __init__(self):
+        # Read-only arrays published to worker processes through shared memory
+        self.blocks = []
+
+    def publish(self, array):
+        # Returns the specification used by workers to attach the array
+        array = np.ascontiguousarray(array)
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        self.blocks.append(block)
+        return (block.name, array.shape, array.dtype.str)
+
+    def release(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+# Shared memory blocks attached by a worker process
+attached_blocks = {}
+
+def attach_arrays(spec):
+    # Detach blocks of previous runs
+    names = set(name for name, shape, dtype in spec.values())
+    for name in list(attached_blocks.keys()):
+        if name not in names:
+            attached_blocks.pop(name).close()
+
+    arrays = {}
+    for key, (name, shape, dtype) in spec.items():
+        if name not in attached_blocks:
+            attached_blocks[name] = SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=attached_blocks[name].buf)
+    return arrays
+
+def prefilter_task(task):
+    # Profiles and queries of a task are read from shared memory; only the query range is passed per task
+    spec, start, stop, blocks = task
+    arrays = attach_arrays(spec)
+    result = prefilter_chunk(arrays['query_ix'][start:stop], arrays['bait_id'][start:stop], arrays['prey_id'][start:stop], profiles(arrays=arrays), blocks)
+
+    # Only the features of the learn filter are returned
+    return {column: result[column] for column in ['query_ix'] + PREFILTER_COLUMNS}
+
+def score_task(task):
+    spec, start, stop, blocks, prefilter = task
+    arrays = attach_arrays(spec)
+
+    # Queries passing the learn filter on their mean features are published with the profiles
+    if prefilter is None:
+        prefilter_data = None
+    else:
+        prefilter_data = mic_prefilter(*prefilter)
+        prefilter_data.pairs = arrays['pairs']
+
+    return start, stop, score_chunk(arrays['query_ix'][start:stop], arrays['bait_id'][start:stop], arrays['prey_id'][start:stop], profiles(arrays=arrays), prefilter_data, blocks)
+
+@lru_cache(maxsize=None)
+def triu_indices(n):
+    return np.triu_indices(n)
+
+def zscore(a):
+    return (a - np.mean(a, axis=-1, keepdims=True)) / (np.std(a, axis=-1, keepdims=True))
+
+def normalized_xcorr(a, b):
+    # Cross-correlation of all row pairs of two normalized matrices; leading axes index stacked matrices
+    n = a.shape[-1]
+    center = (n - 1) // 2
+    bt = np.swapaxes(b, -1, -2)
+
+    # Normalized cross-correlation at zero lag
+    nxcorr = np.matmul(a, bt) / n # Normalize by length
+
+    # Cross-correlation at the lags of np.correlate 'same' mode: window k of the zero-padded rows of a is shifted by k - center
+    padded = np.zeros(a.shape[:-1] + (2 * n - 1,))
+    padded[..., n - 1 - center:2 * n - 1 - center] = a
+    lags = as_strided(padded, shape=a.shape[:-1] + (n, n), strides=padded.strides + padded.strides[-1:], writeable=False)
+    lxcorr = np.argmax(np.matmul(lags, bt[..., np.newaxis, :, :]), axis=-2) # Peak
+
+    return nxcorr, lxcorr
+
+def pairs(xcorr, a, b):
+    if np.array_equal(a,b):
+        # Compare all rows of a against all rows of a, including itself (auto-correlation)
+        return xcorr[triu_indices(len(a))]
+    else:
+        # Compare all rows of a against all rows of b
+        return xcorr.ravel()
+
+def mean_abundance(profile):
+    # Sum peptides
+    return np.sum(profile, axis=1, keepdims=True).mean()
+
+def summarize_profile(profile):
+    # Protein-level features of peptide profiles
+    if profile.shape[0] == 0:
+        return None
+
+    profile_zscore = zscore(profile)
+    _, lxcorr = normalized_xcorr(profile_zscore, profile_zscore)
+
+    return profile, profile_zscore, mean_abundance(profile), np.mean(pairs(lxcorr, profile_zscore, profile_zscore))
+
+def score_interaction(qm, bait_id, prey_id, mic=None):
     def longest_intersection(arr):
         # Compute longest continuous stretch
         n = len(arr)
@@ -73,46 +360,19 @@ def score_interaction(bait, prey, bait_monomer_sec_id, prey_monomer_sec_id):
                 ans=max(ans, j-arr[i])
         return ans
 
-    def normalized_xcorr(a, b):
-        # Normalize matrices
-        a = (a - np.mean(a, axis=1, keepdims=True)) / (np.std(a, axis=1, keepdims=True))
-        b = (b - np.mean(b, axis=1, keepdims=True)) / (np.std(b, axis=1, keepdims=True))
-
-        nxcorr = [] # normalized cross-correlation
-        lxcorr = [] # cross-correlation lag
-
-        if np.array_equal(a,b):
-            # Compare all rows of a against all rows of a, including itself (auto-correlation)
-            for i in range(0, len(a)):
-                for j in range(i, len(a)):
-                    nxcorr.append(np.correlate(a[i], a[j], 'valid')[0] / len(a[i])) # Normalize by length
-                    lxcorr.append(np.argmax(np.correlate(a[i], a[j], 'same'))) # Peak
-        else:
-            # Compare all rows of a against all rows of b
-            for i in range(0, len(a)):
-                for j in range(0, len(b)):
-                    nxcorr.append(np.correlate(a[i], b[j], 'valid')[0] / len(a[i])) # Normalize by length
-                    lxcorr.append(np.argmax(np.correlate(a[i], b[j], 'same'))) # Peak
-
-        return np.array(nxcorr), np.array(lxcorr)        
-
-    def sec_xcorr(bm, pm):
-        # Compute SEC xcorr scores
-        bnx, blx = normalized_xcorr(bm, bm)
-        pnx, plx = normalized_xcorr(pm, pm)
-        bpnx, bplx = normalized_xcorr(bm, pm)
+    def sec_xcorr(bm, pm, blx, plx):
+        # Compute SEC xcorr scores of all bait and prey peptide pairs; autocorrelation lags are precomputed
+        nxcorr, lxcorr = normalized_xcorr(bm, pm)
+        bpnx = pairs(nxcorr, bm, pm)
+        bplx = pairs(lxcorr, bm, pm)
 
         xcorr_shape = np.mean(bpnx)
         xcorr_apex = np.mean(bplx)
-        xcorr_shift = max([abs(xcorr_apex - np.mean(blx)), abs(xcorr_apex - np.mean(plx))])
+        xcorr_shift = max([abs(xcorr_apex - blx), abs(xcorr_apex - plx)])
 
         return xcorr_shape, xcorr_shift, xcorr_apex
 
-    def mass_similarity(bm, pm):
-        # Sum bait and prey peptides
-        bpabundance = np.sum(bm, axis=1, keepdims=True).mean()
-        ppabundance = np.sum(pm, axis=1, keepdims=True).mean()
-
+    def mass_similarity(bpabundance, ppabundance):
         # Compute abundance ratio of bait and prey protein
         abundance_ratio = bpabundance / ppabundance
         if abundance_ratio > 1:
@@ -120,209 +380,476 @@ def score_interaction(bait, prey, bait_monomer_sec_id, prey_monomer_sec_id):
 
         return abundance_ratio
 
-
-   # Compute bait and prey overlap
-    overlap = (np.nansum(bait, axis=0) > 0) | (np.nansum(prey, axis=0) > 0)
+    # Compute bait and prey overlap
+    overlap = qm.mask[bait_id] | qm.mask[prey_id]
     total_overlap = np.count_nonzero(overlap)
 
     # Compute bait and prey intersection
-    intersection = (np.nansum(bait, axis=0) > 0) & (np.nansum(prey, axis=0) > 0)
+    intersection = qm.mask[bait_id] & qm.mask[prey_id]
     total_intersection = np.count_nonzero(intersection)
     if total_intersection > 0:
         longest_intersection = longest_intersection(intersection.nonzero()[0])
 
         # Require at least three consecutive overlapping data points
         if longest_intersection > 2:
-            # Prepare total bait and prey profiles & Replace nan with 0
-            total_bait = np.nan_to_num(bait)
-            total_prey = np.nan_to_num(prey)
-
-            # Remove non-overlapping segments
-            bait[:,~intersection] = np.nan
-            prey[:,~intersection] = np.nan
-
-            # Remove completely empty peptides
-            bait = bait[(np.nansum(bait,axis=1) > 0),:]
-            prey = prey[(np.nansum(prey,axis=1) > 0),:]
-
-            # Replace nan with 0
-            bait = np.nan_to_num(bait)
-            prey = np.nan_to_num(prey)
+            bait = qm.restricted(bait_id, intersection)
+            prey = qm.restricted(prey_id, intersection)
 
             # Require at least one remaining peptide for bait and prey
-            if (bait.shape[0] > 0) and (prey.shape[0] > 0):
-                # Compute cross-correlation scores
-                xcorr_shape, xcorr_shift, xcorr_apex = sec_xcorr(bait, prey)
+            if (bait is not None) and (prey is not None):
+                bait, bait_zscore, bait_abundance, bait_autocorrelation_lag = bait
+                prey, prey_zscore, prey_abundance, prey_autocorrelation_lag = prey
 
-                # Compute MIC/TIC scores
-                mic_stat, tic_stat = cstats(bait[:,intersection], prey[:,intersection], est="mic_e")
-                mic = mic_stat.mean(axis=0).mean() # Axis 0: summary for prey peptides / Axis 1: summary for bait peptides
-                tic = tic_stat.mean(axis=0).mean() # Axis 0: summary for prey peptides / Axis 1: summary for bait peptides
+                # Compute cross-correlation scores
+                xcorr_shape, xcorr_shift, xcorr_apex = sec_xcorr(bait_zscore, prey_zscore, bait_autocorrelation_lag, prey_autocorrelation_lag)
 
                 # Compute mass similarity score
-                abundance_ratio = mass_similarity(bait, prey)
+                abundance_ratio = mass_similarity(bait_abundance, prey_abundance)
 
                 # Compute total mass similarity score
-                total_abundance_ratio = mass_similarity(total_bait, total_prey)
+                total_abundance_ratio = mass_similarity(qm.total_abundance[bait_id], qm.total_abundance[prey_id])
+
+                # Compute MIC/TIC scores, optionally only for queries passing the prefilter
+                if mic is None or mic({'var_xcorr_shift': xcorr_shift, 'var_abundance_ratio': abundance_ratio, 'var_total_abundance_ratio': total_abundance_ratio}):
+                    mic_stat, tic_stat = cstats(bait[:,intersection], prey[:,intersection], est="mic_e")
+                    mic_score = mic_stat.mean(axis=0).mean() # Axis 0: summary for prey peptides / Axis 1: summary for bait peptides
+                    tic_score = tic_stat.mean(axis=0).mean() # Axis 0: summary for prey peptides / Axis 1: summary for bait peptides
+                else:
+                    mic_score = np.nan
+                    tic_score = np.nan
 
                 # Compute relative intersection score
                 relative_overlap = total_intersection / total_overlap
 
                 # Compute delta monomer score
+                bait_monomer_sec_id = qm.monomer_sec_id[bait_id]
+                prey_monomer_sec_id = qm.monomer_sec_id[prey_id]
                 delta_monomer = np.abs(bait_monomer_sec_id - prey_monomer_sec_id)
 
                 # Compute apex monomer score
                 apex_monomer = np.min(np.array(bait_monomer_sec_id - xcorr_apex, prey_monomer_sec_id - xcorr_apex))
 
-                return({'var_xcorr_shape': xcorr_shape, 'var_xcorr_shift': xcorr_shift, 'var_abundance_ratio': abundance_ratio, 'var_total_abundance_ratio': total_abundance_ratio, 'var_mic': mic, 'var_tic': tic, 'var_sec_overlap': relative_overlap, 'var_sec_intersection': longest_intersection, 'var_delta_monomer': delta_monomer, 'var_apex_monomer': apex_monomer})
+                return({'var_xcorr_shape': xcorr_shape, 'var_xcorr_shift': xcorr_shift, 'var_abundance_ratio': abundance_ratio, 'var_total_abundance_ratio': total_abundance_ratio, 'var_mic': mic_score, 'var_tic': tic_score, 'var_sec_overlap': relative_overlap, 'var_sec_intersection': longest_intersection, 'var_delta_monomer': delta_monomer, 'var_apex_monomer': apex_monomer})
+
+def pack_masks(masks):
+    # Elution masks as packed uint64 bitsets; bit j % 64 of word j // 64 represents SEC fraction j
+    num_words = (masks.shape[1] + 63) // 64
+    padded = np.zeros((masks.shape[0], num_words * 64), dtype=bool)
+    padded[:, :masks.shape[1]] = masks
+    return np.packbits(padded, axis=1, bitorder='little').view('<u8')
+
+def shift_bits(bitsets, k):
+    # Bitsets shifted by 0 < k < 64 fractions towards the first fraction, carrying bits across words
+    shifted = bitsets >> np.uint64(k)
+    shifted[:, :-1] |= bitsets[:, 1:] << np.uint64(64 - k)
+    return shifted
+
+def viable_queries(bitsets, bait_ids, prey_ids):
+    # Queries with at least three consecutive SEC fractions in the intersection of the bait and prey elution masks
+    intersection = bitsets[bait_ids] & bitsets[prey_ids]
+    return np.any(intersection & shift_bits(intersection, 1) & shift_bits(intersection, 2), axis=1)
+
+def longest_runs(masks):
+    # Longest stretch of consecutive data points of each mask
+    counts = np.cumsum(masks, axis=1)
+    resets = np.maximum.accumulate(np.where(masks, 0, counts), axis=1)
+    return np.max(counts - resets, axis=1, initial=0)
+
+def kept_first(a, kept):
+    # Move kept peptide rows to the front, preserving their order
+    order = np.argsort(~kept, axis=1, kind='stable')
+    return np.take_along_axis(a, order.reshape(order.shape + (1,) * (a.ndim - 2)), axis=1)
+
+def autocorrelation_lags(m, rows, columns):
+    # Mean autocorrelation lags of stacked profiles; like pairs, profiles with undefined z-scores are not equal to themselves and all peptide pairs are averaged
+    lxcorr = normalized_xcorr(m, m)[1]
+    return np.where(np.isnan(m).any(axis=(1, 2)), np.mean(lxcorr.reshape(len(m), -1), axis=1), np.mean(lxcorr[:, rows, columns], axis=1))
+
+def block_xcorr(bait_zscore, prey_zscore, num_bait, num_prey):
+    # SEC xcorr scores of stacked profiles with kept peptides first; pairs with equal peptide counts are scored together like in sec_xcorr
+    xcorr_shape = np.zeros(len(num_bait))
+    xcorr_apex = np.zeros(len(num_bait))
+    bait_autocorrelation_lag = np.zeros(len(num_bait))
+    prey_autocorrelation_lag = np.zeros(len(num_bait))
+
+    for nb, np_ in set(zip(num_bait, num_prey)):
+        block = ((num_bait == nb) & (num_prey == np_)).nonzero()[0]
+        bm = bait_zscore[block, :nb]
+        pm = prey_zscore[block, :np_]
+
+        # Autocorrelation lags of the restricted profiles
+        bait_rows, bait_columns = triu_indices(nb)
+        bait_autocorrelation_lag[block] = autocorrelation_lags(bm, bait_rows, bait_columns)
+        prey_autocorrelation_lag[block] = autocorrelation_lags(pm, *triu_indices(np_))
+
+        nxcorr, lxcorr = normalized_xcorr(bm, pm)
+        xcorr_shape[block] = np.mean(nxcorr.reshape(len(block), -1), axis=1)
+        xcorr_apex[block] = np.mean(lxcorr.reshape(len(block), -1), axis=1)
+
+        # Identical bait and prey profiles are compared like an auto-correlation; as in np.array_equal, NaN z-scores are never identical
+        if nb == np_:
+            same = np.all(bm == pm, axis=(1, 2))
+            xcorr_shape[block[same]] = np.mean(nxcorr[same][:, bait_rows, bait_columns], axis=1)
+            xcorr_apex[block[same]] = np.mean(lxcorr[same][:, bait_rows, bait_columns], axis=1)
+
+    return xcorr_shape, xcorr_apex, bait_autocorrelation_lag, prey_autocorrelation_lag
+
+def restricted_zscore(profiles, kept):
+    # Row-wise z-scores of stacked profiles; removed peptide rows are zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(kept[:, :, np.newaxis], zscore(profiles), 0.0)
+
+def score_block(qm, bait_id, prey_ids, mic=None):
+    # Scores of all preys of a bait with stacked [prey, peptide, sec] profiles; equivalent to score_interaction for each prey
+    scores = {column: np.zeros(len(prey_ids), dtype=dtype) for column, dtype in FEATURE_COLUMNS}
+
+    # Compute bait and prey overlap and intersection
+    total_overlap = np.count_nonzero(qm.mask[bait_id] | qm.mask[prey_ids], axis=1)
+    intersection = qm.mask[bait_id] & qm.mask[prey_ids]
+    total_intersection = np.count_nonzero(intersection, axis=1)
+    longest_intersection = longest_runs(intersection)
+
+    # Require at least three consecutive overlapping data points
+    scored = longest_intersection > 2
+    if not np.any(scored):
+        return scored, scores
+    candidates = scored.nonzero()[0]
+    intersection = intersection[candidates]
+
+    # Remove non-overlapping segments; prey profiles are zero-padded to the largest prey
+    bait = np.where(intersection[:, np.newaxis, :], qm.total[qm.offset[bait_id]:qm.offset[bait_id]+qm.count[bait_id]][np.newaxis], 0.0)
+    rows = np.arange(qm.count[prey_ids[candidates]].max())
+    valid = rows[np.newaxis, :] < qm.count[prey_ids[candidates]][:, np.newaxis]
+    prey = np.where(valid[:, :, np.newaxis] & intersection[:, np.newaxis, :], qm.total[np.where(valid, qm.offset[prey_ids[candidates]][:, np.newaxis] + rows, 0)], 0.0)
+
+    # Remove completely empty peptides and require at least one remaining peptide for bait and prey
+    bait_kept = np.sum(bait, axis=2) > 0
+    prey_kept = np.sum(prey, axis=2) > 0
+    remaining = bait_kept.any(axis=1) & prey_kept.any(axis=1)
+    scored[candidates[~remaining]] = False
+    candidates = candidates[remaining]
+    intersection, bait, prey, bait_kept, prey_kept = intersection[remaining], bait[remaining], prey[remaining], bait_kept[remaining], prey_kept[remaining]
+    prey_ids = prey_ids[candidates]
+    if len(candidates) == 0:
+        return scored, scores
+
+    # Compute cross-correlation scores
+    bait_zscore = kept_first(restricted_zscore(bait, bait_kept), bait_kept)
+    prey_zscore = kept_first(restricted_zscore(prey, prey_kept), prey_kept)
+    xcorr_shape, xcorr_apex, bait_autocorrelation_lag, prey_autocorrelation_lag = block_xcorr(bait_zscore, prey_zscore, np.count_nonzero(bait_kept, axis=1), np.count_nonzero(prey_kept, axis=1))
+    xcorr_shift = np.maximum(np.abs(xcorr_apex - bait_autocorrelation_lag), np.abs(xcorr_apex - prey_autocorrelation_lag))
+
+    # Compute mass similarity scores
+    bait_abundance = np.sum(np.where(bait_kept, np.sum(bait, axis=2), 0), axis=1) / np.count_nonzero(bait_kept, axis=1)
+    prey_abundance = np.sum(np.where(prey_kept, np.sum(prey, axis=2), 0), axis=1) / np.count_nonzero(prey_kept, axis=1)
+    abundance_ratio = bait_abundance / prey_abundance
+    abundance_ratio = np.where(abundance_ratio > 1, 1 / abundance_ratio, abundance_ratio)
+    total_abundance_ratio = qm.total_abundance[bait_id] / qm.total_abundance[prey_ids]
+    total_abundance_ratio = np.where(total_abundance_ratio > 1, 1 / total_abundance_ratio, total_abundance_ratio)
+
+    scores['var_xcorr_shape'][candidates] = xcorr_shape
+    scores['var_xcorr_shift'][candidates] = xcorr_shift
+    scores['var_abundance_ratio'][candidates] = abundance_ratio
+    scores['var_total_abundance_ratio'][candidates] = total_abundance_ratio
+    scores['var_sec_overlap'][candidates] = total_intersection[candidates] / total_overlap[candidates]
+    scores['var_sec_intersection'][candidates] = longest_intersection[candidates]
+    scores['var_delta_monomer'][candidates] = np.abs(qm.monomer_sec_id[bait_id] - qm.monomer_sec_id[prey_ids])
+    # Like score_interaction, only the bait monomer threshold is used
+    scores['var_apex_monomer'][candidates] = qm.monomer_sec_id[bait_id] - xcorr_apex
+
+    # Compute MIC/TIC scores, optionally only for queries passing the prefilter
+    scores['var_mic'][:] = np.nan
+    scores['var_tic'][:] = np.nan
+    for ix, candidate in enumerate(candidates):
+        if mic is None or mic(candidate, {'var_xcorr_shift': xcorr_shift[ix], 'var_abundance_ratio': abundance_ratio[ix], 'var_total_abundance_ratio': total_abundance_ratio[ix]}):
+            mic_stat, tic_stat = cstats(bait[ix][bait_kept[ix]][:,intersection[ix]], prey[ix][prey_kept[ix]][:,intersection[ix]], est="mic_e")
+            scores['var_mic'][candidate] = mic_stat.mean(axis=0).mean() # Axis 0: summary for prey peptides / Axis 1: summary for bait peptides
+            scores['var_tic'][candidate] = tic_stat.mean(axis=0).mean() # Axis 0: summary for prey peptides / Axis 1: summary for bait peptides
+
+    return scored, scores
+
+def block_chunk(query_ids, bait_ids, prey_ids, qm, mic=None):
+    # Scores of the queries of a chunk in blocks of queries with the same bait; rows keep the query order
+    scored = np.zeros(len(query_ids), dtype=bool)
+    scores = {column: np.empty(len(query_ids), dtype=dtype) for column, dtype in FEATURE_COLUMNS}
+
+    order = np.argsort(bait_ids, kind='stable')
+    bait_starts = np.flatnonzero(np.diff(bait_ids[order], prepend=-1))
+    for bait_start, bait_stop in zip(bait_starts, np.append(bait_starts[1:], len(order))):
+        for start in range(bait_start, bait_stop, BLOCK_SIZE):
+            block = order[start:min(start + BLOCK_SIZE, bait_stop)]
+            if mic is None:
+                block_mic = None
+            else:
+                block_mic = lambda ix, score: mic(query_ids[block[ix]], score)
+            block_scored, block_scores = score_block(qm, bait_ids[block[0]], prey_ids[block], block_mic)
+
+            scored[block] = block_scored
+            for column, dtype in FEATURE_COLUMNS:
+                scores[column][block] = block_scores[column]
+
+    scores = {column: values[scored] for column, values in scores.items()}
+    scores['query_ix'] = np.asarray(query_ids)[scored]
+    return scores
 
 # Scoring
 class scoring:
-    def __init__(self, outfile, chunck_size, threads, minimum_peptides, maximum_peptides, peakpicking):
+    def __init__(self, outfile, chunck_size, threads, minimum_peptides, maximum_peptides, peakpicking, checkpoint, mic_prefilter=None, infile=None, shard=None, blocks=False):
         self.outfile = outfile
+        self.infile = infile if infile is not None else outfile
+        self.shard = shard
+        self.blocks = blocks
+        self.checkpoint = checkpoint
         self.chunck_size = chunck_size
         self.threads = threads
         self.minimum_peptides = minimum_peptides
         self.maximum_peptides = maximum_peptides
         self.peakpicking = peakpicking
-
-        self.sec_boundaries = self.read_sec_boundaries()
+        self.mic_prefilter = mic_prefilter
 
         click.echo("Info: Read peptide chromatograms.")
-        chromatograms = self.read_chromatograms()
+        self.cube = chromatogram_cube(self.outfile)
+        self.rows = self.cube.peptides(self.minimum_peptides, self.maximum_peptides)
+        self.protein_index = np.searchsorted(self.cube.protein_id, self.cube.peptide_protein_id[self.rows])
+        self.protein_starts = np.flatnonzero(np.diff(self.protein_index, prepend=-1))
         click.echo("Info: Filter peptide chromatograms.")
-        self.chromatograms = self.filter_peptides(chromatograms)
+        self.peaks = self.filter_peptides()
         self.store_filtered()
-        click.echo("Info: Read queries and SEC boundaries.")
+        click.echo("Info: Read queries.")
         self.queries = self.read_queries()
 
         click.echo("Info: Score PPI.")
         self.compare()
 
-    def read_chromatograms(self):
-        # Read data
-        con = sqlite3.connect(self.outfile)
-        df = pd.read_sql('SELECT SEC.condition_id, SEC.replicate_id, SEC.sec_id, QUANTIFICATION.protein_id, QUANTIFICATION.peptide_id, peptide_intensity, MONOMER.sec_id AS monomer_sec_id FROM QUANTIFICATION INNER JOIN PROTEIN_META ON QUANTIFICATION.protein_id = PROTEIN_META.protein_id INNER JOIN PEPTIDE_META ON QUANTIFICATION.peptide_id = PEPTIDE_META.peptide_id INNER JOIN SEC ON QUANTIFICATION.RUN_ID = SEC.RUN_ID INNER JOIN MONOMER ON QUANTIFICATION.protein_id = MONOMER.protein_id and SEC.condition_id = MONOMER.condition_id AND SEC.replicate_id = MONOMER.replicate_id WHERE peptide_count >= %s AND peptide_rank <= %s;' % (self.minimum_peptides, self.maximum_peptides), con)
-
-        con.close()
-
-        return df
-
-    def filter_peptides(self, df):
-        def peptide_detrend_zero(x):
-            peptide_mean = np.mean(np.append(x['peptide_intensity'], np.zeros(len(self.sec_boundaries['sec_id'].unique())-x.shape[0])))
-            return x[x['peptide_intensity'] > peptide_mean][['sec_id','peptide_intensity','monomer_sec_id']]
-
-        def peptide_detrend_drop(x):
-            peptide_mean = np.mean(x['peptide_intensity'])
-            return x[x['peptide_intensity'] > peptide_mean][['sec_id','peptide_intensity','monomer_sec_id']]
-
-        def protein_pick(x):
-            xpep = x.groupby(['peptide_id','sec_id'])['peptide_intensity'].mean().reset_index()
-            xprot = xpep.groupby(['sec_id'])['peptide_intensity'].mean().reset_index()
-
-            xall = pd.merge(self.sec_boundaries, xprot[['sec_id','peptide_intensity']], on='sec_id', how='left').sort_values(['sec_id'])
-            xall['peptide_intensity'] = np.nan_to_num(xall['peptide_intensity'].values) # Replace missing values with zeros
-
-            peaks, _ = find_peaks(xall['peptide_intensity'], width=[3,])
-            boundaries = peak_widths(xall['peptide_intensity'], peaks, rel_height=0.9)
-
-            left_boundaries = np.floor(boundaries[2])
-            right_boundaries = np.ceil(boundaries[3])
-
-            sec_list = None
-            for peak in list(zip(left_boundaries, right_boundaries)):
-                if sec_list is None:
-                    sec_list = np.arange(peak[0],peak[1]+1)
-                else:
-                    sec_list = np.append(sec_list, np.arange(peak[0],peak[1]+1))
-
-            if len(x['replicate_id'].unique()) == 1:
-                return x[x['sec_id'].isin(np.unique(sec_list))][['peptide_id','sec_id','peptide_intensity','monomer_sec_id']]
-            else:
-                return x[x['sec_id'].isin(np.unique(sec_list))][['replicate_id','peptide_id','sec_id','peptide_intensity','monomer_sec_id']]
+    def read_chromatograms(self, run):
+        # Peptide chromatograms of a run from the memory-mapped cube
+        return self.cube.intensity[run][self.rows].astype(np.float64)
+
+    def filter_peptides(self):
+        # Retained data points as [run, peptide, sec] mask over the cube rows
+        def report(peaks, stage):
+            click.echo("Info: %s unique peptides %s filtering." % (len(np.unique(self.cube.peptide_id[self.rows][peaks.any(axis=(0,2))])), stage))
+            click.echo("Info: %s peptide chromatograms %s filtering." % (np.count_nonzero(peaks.any(axis=2)), stage))
+            click.echo("Info: %s data points %s filtering." % (np.count_nonzero(peaks), stage))
+
+        def protein_pick(runs, peaks):
+            if len(self.rows) == 0:
+                return
+
+            # Mean over replicates per peptide and SEC fraction, then mean over peptides per protein; missing values are zeros
+            xpep = np.full((len(runs), len(self.rows), len(self.cube.sec_id)), np.nan)
+            for ix, run in enumerate(runs):
+                xpep[ix] = np.where(peaks[run], self.read_chromatograms(run), np.nan)
+            detected = ~np.isnan(xpep)
+            xpep = np.divide(np.nansum(xpep, axis=0), np.sum(detected, axis=0), out=np.full(xpep.shape[1:], np.nan), where=detected.any(axis=0))
+            xprot = np.divide(np.add.reduceat(np.nan_to_num(xpep), self.protein_starts, axis=0), np.add.reduceat(~np.isnan(xpep), self.protein_starts, axis=0))
+            xprot = np.nan_to_num(xprot)
+
+            for ix, (start, stop) in enumerate(zip(self.protein_starts, np.append(self.protein_starts[1:], len(self.rows)))):
+                peaks_ix, _ = find_peaks(xprot[ix], width=[3,])
+                boundaries = peak_widths(xprot[ix], peaks_ix, rel_height=0.9)
+
+                # Peak boundaries are fraction positions and are matched to SEC identifiers as before
+                sec_list = np.concatenate([np.arange(left, right+1) for left, right in zip(np.floor(boundaries[2]), np.ceil(boundaries[3]))] + [[]])
+                peaks[runs, start:stop] &= np.isin(self.cube.sec_id, sec_list)
+
+        peaks = np.empty((self.cube.runs.shape[0], len(self.rows), len(self.cube.sec_id)), dtype=bool)
+        for run in range(peaks.shape[0]):
+            peaks[run] = ~np.isnan(self.cube.intensity[run][self.rows])
 
         # Report statistics before filtering
-        click.echo("Info: %s unique peptides before filtering." % len(df['peptide_id'].unique()))
-        click.echo("Info: %s peptide chromatograms before filtering." % df[['condition_id','replicate_id','protein_id','peptide_id']].drop_duplicates().shape[0])
-        click.echo("Info: %s data points before filtering." % df.shape[0])
+        report(peaks, "before")
 
         # Filter monomers
-        df = df[df['sec_id'] <= df['monomer_sec_id']]
-
-        if self.peakpicking == "detrend_zero":
-            # Remove constant trends from peptides, average over all fractions
-            df = df.groupby(['condition_id','replicate_id','protein_id','peptide_id']).apply(peptide_detrend_zero).reset_index(level=['condition_id','replicate_id','protein_id','peptide_id'])
-        if self.peakpicking == "detrend_drop":
-            # Remove constant trends from peptides, average over fractions with detections
-            df = df.groupby(['condition_id','replicate_id','protein_id','peptide_id']).apply(peptide_detrend_drop).reset_index(level=['condition_id','replicate_id','protein_id','peptide_id'])
+        for run in range(peaks.shape[0]):
+            peaks[run] &= self.cube.sec_id <= self.cube.monomer_sec_id[run, self.protein_index][:, None]
+
+        if self.peakpicking in ["detrend_zero", "detrend_drop"]:
+            for run in range(peaks.shape[0]):
+                intensity = np.where(peaks[run], self.read_chromatograms(run), 0)
+                if self.peakpicking == "detrend_zero":
+                    # Remove constant trends from peptides, average over all fractions
+                    peptide_mean = intensity.sum(axis=1) / len(self.cube.sec_id)
+                else:
+                    # Remove constant trends from peptides, average over fractions with detections
+                    peptide_mean = intensity.sum(axis=1) / np.maximum(np.count_nonzero(peaks[run], axis=1), 1)
+                peaks[run] &= intensity > peptide_mean[:, None]
         elif self.peakpicking == "localmax_conditions":
             # Protein-level peakpicking
-            df = df.groupby(['condition_id','protein_id']).apply(protein_pick).reset_index(level=['condition_id','protein_id'])
+            for condition_id in self.cube.runs['condition_id'].unique():
+                protein_pick(np.flatnonzero(self.cube.runs['condition_id'].values == condition_id), peaks)
         elif self.peakpicking == "localmax_replicates":
             # Protein-level peakpicking
-            df = df.groupby(['condition_id','replicate_id','protein_id']).apply(protein_pick).reset_index(level=['condition_id','replicate_id','protein_id'])
+            for run in range(peaks.shape[0]):
+                protein_pick(np.array([run]), peaks)
 
         # Report statistics after filtering
-        click.echo("Info: %s unique peptides after filtering." % len(df['peptide_id'].unique()))
-        click.echo("Info: %s peptide chromatograms after filtering." % df[['condition_id','replicate_id','protein_id','peptide_id']].drop_duplicates().shape[0])
-        click.echo("Info: %s data points after filtering." % df.shape[0])
+        report(peaks, "after")
 
-        return df
+        return peaks
 
     def store_filtered(self):
-        con = sqlite3.connect(self.outfile)
-        self.chromatograms[['condition_id','replicate_id','protein_id','sec_id']].drop_duplicates().to_sql('PROTEIN_PEAKS', con, index=False, if_exists='replace')
-        con.close()
+        # SEC fractions with retained data points per run and protein
+        dfs = []
+        for run in range(self.peaks.shape[0]):
+            if len(self.rows) == 0:
+                continue
+            protein, fraction = np.logical_or.reduceat(self.peaks[run], self.protein_starts, axis=0).nonzero()
+            dfs.append(pd.DataFrame({'condition_id': self.cube.runs['condition_id'].values[run], 'replicate_id': self.cube.runs['replicate_id'].values[run], 'protein_id': self.cube.peptide_protein_id[self.rows][self.protein_starts][protein], 'sec_id': self.cube.sec_id[fraction]}))
+
+        db = writer(self.outfile)
+        db.write('PROTEIN_PEAKS', pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame({'condition_id': [], 'replicate_id': [], 'protein_id': [], 'sec_id': []}), if_exists='replace')
+        db.close()
 
     def read_queries(self):
         # Read data
-        con = sqlite3.connect(self.outfile)
+        con = sqlite3.connect(self.infile)
         df = pd.read_sql('SELECT * FROM QUERY;', con)
         con.close()
 
+        # Restrict to the queries of the shard
+        if self.shard is not None:
+            shard_index, shard_count = self.shard
+            df = df[query_shards(df['bait_id'].values, df['prey_id'].values, shard_count) == shard_index - 1].reset_index(drop=True)
+            click.echo("Info: %s queries in shard %s of %s." % (df.shape[0], shard_index, shard_count))
+
         return df
 
-    def read_sec_boundaries(self):
-        # Read data
+    def read_progress(self):
+        # Query ranges of completed chunks with the same parameters
         con = sqlite3.connect(self.outfile)
-        df = pd.read_sql('SELECT min(sec_id) AS min_sec_id, max(sec_id) AS max_sec_id FROM SEC;', con)
+        if check_sqlite_table(con, 'SCORE_PROGRESS'):
+            df = pd.read_sql('SELECT condition_id, replicate_id, chunk_start, chunk_stop FROM SCORE_PROGRESS WHERE parameter_hash = ?;', con, params=(self.checkpoint,))
+        else:
+            df = pd.DataFrame({'condition_id': [], 'replicate_id': [], 'chunk_start': [], 'chunk_stop': []})
         con.close()
 
-        return pd.DataFrame({'sec_id': range(df['min_sec_id'].values[0], df['max_sec_id'].values[0]+1)})
-
-    def split_chunks(self, dfm):
-        def index_marks(nrows, chunck_size):
-            return range(1 * chunck_size, (nrows // chunck_size + 1) * chunck_size, chunck_size)
+        return set(zip(df['condition_id'], df['replicate_id'], df['chunk_start'], df['chunk_stop']))
 
-        indices = index_marks(dfm.shape[0], self.chunck_size)
-        return np.split(dfm, indices)
+    def runs(self):
+        # Arrays of a run are published for the workers and released once the run is processed
+        for exp_ix, run in self.cube.runs.iterrows():
+            peaks = self.peaks[exp_ix]
+            if not peaks.any():
+                continue
 
-    def compare(self):
-        # Obtain experimental design
-        exp_design = self.chromatograms[['condition_id','replicate_id']].drop_duplicates()
-
-        # Iterate over experimental design
-        for exp_ix, run in exp_design.iterrows():
-            chromatograms = self.chromatograms[(self.chromatograms['condition_id']==run['condition_id']) & (self.chromatograms['replicate_id']==run['replicate_id'])]
-            qm = chromatograms.pivot_table(index=['protein_id','peptide_id','monomer_sec_id'], columns='sec_id', values='peptide_intensity')
+            # Peptide profiles of the run are built from the cube rows and fractions with retained data points
+            peptides = peaks.any(axis=1)
+            fractions = peaks.any(axis=0)
+            matrix = np.where(peaks, self.read_chromatograms(exp_ix), np.nan)[peptides][:, fractions]
+            qm = profiles(matrix=matrix, protein_ids=self.cube.peptide_protein_id[self.rows][peptides], monomer_sec_ids=self.cube.monomer_sec_id[exp_ix, self.protein_index][peptides])
 
             # Ensure that all queries are covered by chromatograms
-            proteins = chromatograms['protein_id'].unique()
+            proteins = qm.proteins()
             queries = self.queries[self.queries['bait_id'].isin(proteins) & self.queries['prey_id'].isin(proteins)]
 
-            # Split data into chunks for parallel processing
-            queries_chunks = self.split_chunks(queries)
-            click.echo("Info: Total number of queries for condition %s and replicate %s: %s. Split into %s chuncks." % (run['condition_id'], run['replicate_id'], queries.shape[0], len(queries_chunks)))
-            
-            # Initialize multiprocessing
-            pool = multiprocessing.Pool(processes=self.threads)
+            # Queries without three consecutive overlapping SEC fractions are not scored and not dispatched
+            viable = viable_queries(pack_masks(qm.mask), queries['bait_id'].values, queries['prey_id'].values)
+            pruned = queries.shape[0] - np.count_nonzero(viable)
+            queries = queries[viable]
+
+            # Chuncks of bait-major queries cover complete blocks
+            if self.blocks:
+                queries = queries.sort_values('bait_id', kind='stable')
 
-            with tqdm(total=len(queries_chunks)) as pbar:
-                for i, result in tqdm(enumerate(pool.imap_unordered(partial(score_chunk, qm=qm, run=run), queries_chunks))):
+            # Publish profiles and queries of the run once for all workers
+            store = shared_arrays()
+            spec = {key: store.publish(getattr(qm, key)) for key in PROFILE_ARRAYS}
+            spec['bait_id'] = store.publish(queries['bait_id'].values)
+            spec['prey_id'] = store.publish(queries['prey_id'].values)
+            spec['query_ix'] = store.publish(queries.index.values)
 
-                    con = sqlite3.connect(self.outfile)
-                    pd.DataFrame(result).to_sql('FEATURE', con, index=False, if_exists='append')
-                    con.close()
+            # Split queries into ranges for parallel processing
+            ranges = [(start, min(start + self.chunck_size, queries.shape[0])) for start in range(0, queries.shape[0], self.chunck_size)]
 
-                    pbar.update()
+            try:
+                yield run, queries, pruned, spec, ranges
+            finally:
+                store.release()
+
+    def prefilter(self, pool):
+        # Sums and counts of the learn filter features of each query over all runs; missing values are skipped like in learn
+        sums = np.zeros((self.queries.shape[0], 3))
+        counts = np.zeros((self.queries.shape[0], 3))
+
+        for run, queries, pruned, spec, ranges in self.runs():
+            click.echo("Info: Prefilter queries for condition %s and replicate %s." % (run['condition_id'], run['replicate_id']))
+
+            for result in tqdm(pool.imap_unordered(prefilter_task, [(spec, start, stop, self.blocks) for start, stop in ranges]), total=len(ranges)):
+                values = np.column_stack([result[column] for column in PREFILTER_COLUMNS])
+                sums[result['query_ix']] += np.nan_to_num(values)
+                counts[result['query_ix']] += ~np.isnan(values)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+
+        self.mic_prefilter.pairs = self.mic_prefilter.passes(means[:,0], means[:,1], means[:,2])
+
+    def compare(self):
+        # Workers must share the resource tracker of the parent, which owns and unlinks all shared memory blocks
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+
+        # One worker pool for all runs; profiles are shared through shared memory
+        with multiprocessing.Pool(processes=self.threads) as pool:
+            # Queries passing the learn filter on their mean features over all runs are published once for all runs
+            store = shared_arrays()
+            try:
+                self.score(pool, store)
+            finally:
+                store.release()
+
+            pool.close()
+            pool.join()
+
+    def score(self, pool, store):
+        # Only the features of the learn filter are kept by the prefilter; all other features are computed when scoring
+        if self.mic_prefilter is not None:
+            self.prefilter(pool)
+            prefilter = (self.mic_prefilter.maximum_sec_shift, self.mic_prefilter.minimum_abundance_ratio)
+            pairs = store.publish(self.mic_prefilter.pairs)
+        else:
+            prefilter = None
+
+        # Results of all runs are appended by a writer thread through a single connection
+        db = background_writer(self.outfile)
+
+        # Count scored queries and MIC/TIC computations
+        num_scored = 0
+        num_mic = 0
+
+        try:
+            # Skip chunks completed by a previous run
+            completed = self.read_progress()
+
+            # Iterate over experimental design
+            for run, queries, pruned, spec, ranges in self.runs():
+                click.echo("Info: Total number of queries for condition %s and replicate %s: %s. Split into %s chuncks." % (run['condition_id'], run['replicate_id'], queries.shape[0], len(ranges)))
+                click.echo("Info: %s queries without three consecutive overlapping SEC fractions pruned." % pruned)
+
+                pending = [(start, stop) for start, stop in ranges if (run['condition_id'], run['replicate_id'], start, stop) not in completed]
+                if len(pending) < len(ranges):
+                    click.echo("Info: Resume with %s of %s chuncks completed." % (len(ranges) - len(pending), len(ranges)))
+
+                if prefilter is not None:
+                    spec = dict(spec, pairs=pairs)
+
+                for start, stop, result in tqdm(pool.imap_unordered(score_task, [(spec, start, stop, self.blocks, prefilter) for start, stop in pending]), total=len(pending)):
+                    # Add run and query columns to the feature buffers
+                    features = pd.DataFrame({column: result[column] for column, dtype in FEATURE_COLUMNS})
+                    features['condition_id'] = run['condition_id']
+                    features['replicate_id'] = run['replicate_id']
+                    for column in self.queries.columns:
+                        features[column] = self.queries[column].values[result['query_ix']]
+
+                    num_scored += features.shape[0]
+                    num_mic += features['var_mic'].notna().sum()
+
+                    # Features and progress of a chunk are committed together
+                    progress = pd.DataFrame({'condition_id': [run['condition_id']], 'replicate_id': [run['replicate_id']], 'chunk_start': [start], 'chunk_stop': [stop], 'parameter_hash': [self.checkpoint]})
+                    db.transaction([('FEATURE', features, 'append'), ('SCORE_PROGRESS', progress, 'append')])
+        finally:
+            db.close()
+
+        if self.mic_prefilter is not None and num_scored > 0:
+            click.echo("Info: MIC/TIC scores computed for %s of %s scored queries; %.1f%% of MIC/TIC computations avoided." % (num_mic, num_scored, 100.0 * (num_scored - num_mic) / num_scored))
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from secat.score import profiles, score_chunk, mic_prefilter
+
+def _chromatograms(peptides):
+    # Long-format chromatograms of a run from {(protein_id, peptide_id): intensities}
+    rows = []
+    for (protein_id, peptide_id), intensities in peptides.items():
+        for sec_id, intensity in enumerate(intensities):
+            if intensity > 0:
+                rows.append({'protein_id': protein_id, 'peptide_id': peptide_id, 'monomer_sec_id': 20, 'sec_id': sec_id, 'peptide_intensity': float(intensity)})
+    return pd.DataFrame(rows)
+
+def _scores(qm, queries, blocks):
+    # MIC/TIC scores are skipped for all queries
+    prefilter = mic_prefilter(-1, 2)
+    prefilter.pairs = np.zeros(len(queries), dtype=bool)
+    return score_chunk(np.arange(len(queries)), np.array([q[0] for q in queries]), np.array([q[1] for q in queries]), qm, prefilter, blocks=blocks)
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('queries', [[(1, 1)], [(1, 1), (1, 2), (1, 3)], [(2, 2), (3, 3), (2, 3), (3, 1)], [(4, 4), (4, 1), (2, 4)]])
+def test_block_scoring_matches_pairwise_with_constant_rows(queries):
+    # Peptides with constant profiles have undefined z-scores
+    qm = profiles(_chromatograms({
+        (1, 1): [0, 5, 5, 5, 5, 5, 5, 0, 0, 0],
+        (1, 2): [0, 1, 4, 9, 4, 1, 2, 0, 0, 0],
+        (2, 3): [0, 2, 6, 8, 6, 3, 1, 0, 0, 0],
+        (2, 4): [0, 3, 3, 3, 3, 3, 3, 0, 0, 0],
+        (3, 5): [0, 0, 7, 7, 7, 7, 0, 0, 0, 0],
+        (3, 6): [0, 0, 2, 2, 2, 2, 0, 0, 0, 0],
+        (4, 7): [0, 1, 3, 8, 5, 2, 1, 0, 0, 0],
+        (4, 8): [0, 2, 5, 7, 3, 1, 0, 0, 0, 0],
+    }))
+
+    pairwise = _scores(qm, queries, False)
+    block = _scores(qm, queries, True)
+
+    assert pairwise.keys() == block.keys()
+    for column in pairwise:
+        np.testing.assert_allclose(block[column], pairwise[column], rtol=1e-12, atol=1e-15, equal_nan=True, err_msg=column)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import statsmodels.api as sm
+
+from secat.preprocess import lowess_sorted
+
+def _inputs(name, n=3000):
+    rng = np.random.default_rng(0)
+    if name == 'normal':
+        x = rng.normal(20, 2, n)
+    elif name == 'uniform':
+        x = rng.uniform(10, 30, n)
+    elif name.startswith('student_t'):
+        x = rng.standard_t(int(name[-1]), n)
+    elif name == 'narrow_outliers':
+        x = rng.normal(20, 0.3, n)
+        x[:5] = [1, 5, 40, 60, 100]
+    elif name == 'very_narrow_outliers':
+        x = rng.normal(20, 0.05, n)
+        x[:4] = [-1000, -980, 1000, 1020]
+    y = np.sin(x) + 0.1 * x + rng.normal(0, 0.2, n)
+
+    order = np.argsort(x, kind='stable')
+    return x[order], y[order]
+
+@pytest.mark.parametrize('name', ['normal', 'uniform', 'student_t1', 'student_t2', 'student_t3', 'narrow_outliers', 'very_narrow_outliers'])
+@pytest.mark.parametrize('frac', [0.3, 0.7])
+def test_lowess_sorted_matches_statsmodels(name, frac):
+    x, y = _inputs(name)
+    delta = 0.01 * (np.max(y) - np.min(y))
+
+    expected = sm.nonparametric.lowess(endog=y, exog=x, frac=frac, it=3, delta=delta, is_sorted=True, return_sorted=False)
+    np.testing.assert_allclose(lowess_sorted(y, x, frac=frac, it=3, delta=delta), expected, rtol=0, atol=1e-8)
+
+def test_lowess_sorted_ties():
+    rng = np.random.default_rng(1)
+    x = np.sort(np.round(rng.normal(20, 2, 2000), 1))
+    y = rng.normal(0, 1, 2000)
+
+    expected = sm.nonparametric.lowess(endog=y, exog=x, frac=0.7, it=3, delta=0.0, is_sorted=True, return_sorted=False)
+    np.testing.assert_allclose(lowess_sorted(y, x, frac=0.7, it=3, delta=0.0), expected, rtol=0, atol=1e-8)
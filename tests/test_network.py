@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+from secat.preprocess import net
+
+def test_unique_interactions_missing_ids(tmp_path):
+    netfile = tmp_path / 'network.tsv'
+    netfile.write_text('protein1\tprotein2\nP1\tP2\n')
+
+    network = pd.DataFrame({
+        'bait_id': ['P1', 'P2', None, 'P3', 'P1', 'P4'],
+        'prey_id': ['P2', 'P1', 'P3', np.nan, 'P3', 'P4'],
+        'interaction_confidence': [0.2, 0.9, 1.0, 1.0, 0.5, 1.0],
+    })
+
+    df = net(str(netfile), None, None, network).to_df().sort_values(['bait_id', 'prey_id']).reset_index(drop=True)
+
+    expected = pd.DataFrame({'bait_id': ['P1', 'P1'], 'prey_id': ['P2', 'P3'], 'interaction_confidence': [0.9, 0.5]})
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
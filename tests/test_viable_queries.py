@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from secat.score import pack_masks, viable_queries, longest_runs
+
+def _queries(masks, rng, n=500):
+    # Random bait/prey pairs, including self-pairs
+    bait_ids = rng.integers(0, masks.shape[0], n)
+    prey_ids = rng.integers(0, masks.shape[0], n)
+    return np.concatenate([bait_ids, np.arange(masks.shape[0])]), np.concatenate([prey_ids, np.arange(masks.shape[0])])
+
+@pytest.mark.parametrize('num_fractions', [1, 2, 3, 4, 31, 63, 64, 65, 66, 100, 127, 128, 129, 130, 191, 192, 200])
+@pytest.mark.parametrize('density', [0.3, 0.6, 0.9])
+def test_viable_queries_matches_longest_runs(num_fractions, density):
+    rng = np.random.default_rng(num_fractions)
+    masks = rng.random((60, num_fractions)) < density
+    bait_ids, prey_ids = _queries(masks, rng)
+
+    expected = longest_runs(masks[bait_ids] & masks[prey_ids]) > 2
+    np.testing.assert_array_equal(viable_queries(pack_masks(masks), bait_ids, prey_ids), expected)
+
+@pytest.mark.parametrize('num_fractions', [66, 130, 200])
+def test_viable_queries_runs_across_words(num_fractions):
+    # Runs of two and three fractions at every position, including those crossing 64-bit word boundaries
+    masks = []
+    for length in [2, 3]:
+        for start in range(num_fractions - length + 1):
+            mask = np.zeros(num_fractions, dtype=bool)
+            mask[start:start + length] = True
+            masks.append(mask)
+    masks = np.array(masks)
+    ids = np.arange(masks.shape[0])
+
+    expected = longest_runs(masks) > 2
+    assert expected.sum() == num_fractions - 2
+    np.testing.assert_array_equal(viable_queries(pack_masks(masks), ids, ids), expected)